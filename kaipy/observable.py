@@ -14,8 +14,10 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import itertools
 import numpy as np
-import math
+from kaipy.statistic import Accumulator, correlation, next_fast_len
+from kaipy.util import h5md_pos_particle_blocks
 
 def second_legendre(pos1, pos2, direction):
     """ Calculate the second legendre polonomial.
@@ -42,86 +44,230 @@ def second_legendre(pos1, pos2, direction):
         If direction is not ('x', 'y' or 'z')
 
     """
-    vec1 = pos1 - pos2
-    try:
-        if (direction == 'x'):
-            vec2 = np.array([1, 0, 0])
-        elif (direction == 'y'):
-            vec2 = np.array([0, 1, 0])
-        elif (direction == 'z'):
-            vec2 = np.array([0, 0, 1])
-        v1_norm = np.sqrt((vec1 * vec1).sum())
-        v2_norm = np.sqrt((vec2 * vec2).sum())
-        cos_angle = np.dot(vec1, vec2) / (v1_norm * v2_norm)
-        second_legendre = 0.5 * (3 * cos_angle * cos_angle - 1)
-        return second_legendre
-    except:
+    if direction not in ('x', 'y', 'z'):
         raise ValueError("Argument must be 'x','y' or 'z'")
-    
+    return second_legendre_bonds(np.asarray(pos1) - np.asarray(pos2),
+                                 direction)
+
+
+def second_legendre_bonds(vectors, direction):
+    """ Second legendre polonomial for many bond vectors.
+
+    Calculates the second legendre polonomial P2(cos(theta)) of the
+    angles between all `vectors` (e.g. from `bond_vectors`) and
+    `direction` at once. Their mean, the order parameter, is returned
+    by `orientational_order`.
+
+    Parameters
+    ----------
+    vectors : array_like
+        Array of shape [..., 3].
+    direction : str or array_like
+        Direction ('x', 'y', 'z' or a vector of length 3).
+
+    Returns
+    -------
+    float or array_like
+        Array of shape vectors.shape[:-1].
+
+    Raises
+    ------
+    ValueError
+        If direction is neither ('x', 'y' or 'z') nor a vector.
+
+    """
+    direction = _direction_vector(direction)
+    vectors = np.asarray(vectors, dtype=float)
+    cos_angle = np.dot(vectors, direction) / np.linalg.norm(vectors, axis=-1)
+    return 0.5 * (3 * cos_angle * cos_angle - 1)
+
+
+def orientational_order(vectors, direction, axis=None):
+    """ Orientational order parameter along a direction.
+
+    Calculates the mean <P2(cos(theta))> of the second legendre
+    polynomial of the angles between `vectors` (e.g. from
+    `bond_vectors`) and `direction` (see `second_legendre_bonds`).
+
+    Parameters
+    ----------
+    vectors : array_like
+        Array of shape [..., 3].
+    direction : str or array_like
+        Direction ('x', 'y', 'z' or a vector of length 3).
+    axis : None or int or tuple of ints
+        Axes of `vectors` averaged over. Defaults to all vectors.
+
+    Returns
+    -------
+    float or array_like
+        Order parameter of the remaining leading dimensions.
+
+    """
+    vectors = np.asarray(vectors, dtype=float)
+    return np.mean(second_legendre_bonds(vectors, direction),
+                   axis=_vector_axes(vectors, axis))
+
+
+def _vector_axes(vectors, axis):
+    """ Axes of `vectors` without the components as a tuple. """
+    n_axes = vectors.ndim - 1
+    if axis is None:
+        return tuple(range(n_axes))
+    axes = tuple(a % vectors.ndim for a in np.atleast_1d(axis))
+    if any(a >= n_axes for a in axes):
+        raise ValueError("The components of the vectors are no axis to "
+                         "average over.")
+    return axes
+
+
+def _direction_vector(direction):
+    """ Unit vector for 'x', 'y', 'z' or a vector of length 3. """
+    axes = {'x': 0, 'y': 1, 'z': 2}
+    if isinstance(direction, str):
+        if direction not in axes:
+            raise ValueError("Argument must be 'x','y' or 'z'")
+        return np.eye(3)[axes[direction]]
+    direction = np.asarray(direction, dtype=float)
+    if direction.shape != (3,) or not np.any(direction):
+        raise ValueError("Argument must be 'x','y', 'z' or a non-zero vector")
+    return direction / np.linalg.norm(direction)
+
+
+def bond_vectors(x, box_l=None):
+    """ Bond vectors of polymers.
+
+    Calculates the vectors between consecutive beads of polymers
+    with coordinates x. Leading dimensions of x (e.g. frames or
+    chains) are evaluated at once.
+
+    Parameters
+    ----------
+    x : array_like
+        Array of shape [..., number of beads of polymer, 3].
+    box_l : Optional[float or array_like]
+        Box length(s) or the edge vectors of a triclinic box as rows of
+        a [3, 3] matrix (see `minimum_image_vectors`). If given, the
+        minimum image convention is applied to the bonds of folded
+        coordinates.
+
+    Returns
+    -------
+    array_like
+        Array of shape [..., number of beads - 1, 3].
+
+    """
+    x = np.asarray(x, dtype=float)
+    bonds = x[..., 1:, :] - x[..., :-1, :]
+    if box_l is not None:
+        bonds = _minimum_image(bonds, box_l, out=bonds)
+    return bonds
+
+
+def nematic_order(vectors, axis=-2):
+    """ Nematic order parameter and director.
+
+    Calculates the order tensor Q = <3/2 u u - 1/2 I> of the unit
+    vectors u of `vectors` (e.g. from `bond_vectors`) and its
+    eigen-decomposition. The average runs over the vectors along
+    `axis`, the other leading dimensions (e.g. frames) are evaluated
+    separately.
+
+    Parameters
+    ----------
+    vectors : array_like
+        Array of shape [..., number of vectors, 3].
+    axis : None or int or tuple of ints
+        Axes of `vectors` averaged over, e.g. (1, 2) for bonds of shape
+        [frames, chains, bonds, 3] to get the order of the whole system
+        in every frame. None averages over all vectors. Defaults to the
+        second to last axis.
+
+    Returns
+    -------
+    float or array_like, array_like, array_like
+        The order parameter S (largest eigenvalue of Q, the mean P2
+        along the director), the director (corresponding eigenvector)
+        and Q.
+
+    """
+    vectors = np.asarray(vectors, dtype=float)
+    axes = _vector_axes(vectors, axis)
+    n_kept = vectors.ndim - 1 - len(axes)
+    vectors = np.moveaxis(vectors, axes, range(n_kept, vectors.ndim - 1))
+    vectors = vectors.reshape(vectors.shape[:n_kept] + (-1, 3))
+    units = vectors / np.linalg.norm(vectors, axis=-1)[..., np.newaxis]
+    Q = 1.5 * np.einsum('...ni,...nj->...ij', units, units) / \
+        units.shape[-2] - 0.5 * np.eye(3)
+    eigenvalues, eigenvectors = np.linalg.eigh(Q)
+    return eigenvalues[..., -1], eigenvectors[..., :, -1], Q
 
 
 def rg2(x):
     """ Square radius of gyration.
 
     Calculates the squared radius of gyration for coordinates x of a polymer.
+    Leading dimensions of x (e.g. frames or chains) are evaluated at once.
 
     Parameters
     ----------
     x : array_like
-        Array of length number of beads of the polymer.
+        Array of shape [..., number of beads of the polymer, 3].
 
     Returns
     -------
-    float
+    float or array_like
+        Array of shape x.shape[:-2] for batched input.
 
     """
-    rg2 = 0.0
+    x = np.asarray(x)
     r_mean = center_of_mass(x)
-    for i in range(len(x)):
-        rg2 += np.dot((x[i,:] - r_mean), (x[i,:] - r_mean))
-    rg2 /= len(x)
-    return rg2
+    return np.mean(np.square(x - r_mean[..., np.newaxis, :]).sum(axis=-1),
+                   axis=-1)
 
 
 def rg2_compwise(x):
     """ Square radius of gyration component-wise.
 
     Calculates the componentwise squared radius of gyration
-    for coordinates x of a polymer.
+    for coordinates x of a polymer. Leading dimensions of x
+    (e.g. frames or chains) are evaluated at once.
 
     Parameters
     ----------
     x: array_like
-       Array of length number of beads of polymer.
+       Array of shape [..., number of beads of polymer, 3].
 
     Returns
     -------
     float, float, float
+        Arrays of shape x.shape[:-2] for batched input.
     """
-    rg2 = np.zeros(3)
+    x = np.asarray(x)
     r_mean = center_of_mass(x)
-    for i in range(len(x)):
-        rg2 += (x[i]-r_mean)**2
-    rg2 /= len(x)
-    return rg2[0], rg2[1], rg2[2]
+    rg2 = np.mean(np.square(x - r_mean[..., np.newaxis, :]), axis=-2)
+    return rg2[..., 0], rg2[..., 1], rg2[..., 2]
 
 
 def end_to_end_distance(x):
     """ End to end distance of polymer.
 
     Calculates the absolute value of the end to end vector
-    for coordinates x of a polymer.
+    for coordinates x of a polymer. Leading dimensions of x
+    (e.g. frames or chains) are evaluated at once.
 
     Parameters
     ----------
     x: array_like
-        Array of length number of beads of polymer.
+        Array of shape [..., number of beads of polymer, 3].
 
     Returns
     -------
-    float
+    float or array_like
+        Array of shape x.shape[:-2] for batched input.
     """
-    return np.linalg.norm(x[-1]-x[0])
+    x = np.asarray(x)
+    return np.linalg.norm(x[..., -1, :] - x[..., 0, :], axis=-1)
 
 
 def center_of_mass(x, mass=None):
@@ -129,25 +275,27 @@ def center_of_mass(x, mass=None):
 
     Calculates the center of mass of a polymer with
     given coordinates x of the monomers and optional
-    array of mass values mass.
+    array of mass values mass. Leading dimensions of x
+    (e.g. frames or chains) are evaluated at once.
 
     Parameters
     ----------
     x: array_like
-        Array of length number of beads of polymer.
+        Array of shape [..., number of beads of polymer, 3].
     mass: Optional[array_like]
         Array of length number of beads of polymer.
 
     Returns
     -------
     array_like
+        Array of shape x.shape[:-2] + (3,).
     """
     if (mass is not None):
-        com = np.average(x, axis=0, weights=mass)
+        com = np.average(x, axis=-2, weights=mass)
     else:
-        com = np.average(x, axis=0)
+        com = np.average(x, axis=-2)
     return com
-	    
+
 
 def radial_distribution(h5md_pos, h5md_species, SPECIES_1, SPECIES_2, TIMESTEP_MIN, TIMESTEP_MAX, BOX_L, N_BINS, R_MIN, R_MAX=None):
     """ Radial distribution function.
@@ -155,8 +303,12 @@ def radial_distribution(h5md_pos, h5md_species, SPECIES_1, SPECIES_2, TIMESTEP_M
     Calculates the radial distribution function
     (RDF) for a trajectory array h5md_pos with the 
     content [timesteps, particles, xyz] in the 
-    h5md format (see http://nongnu.org/h5md/ 
-    for details). 
+    h5md format (see http://nongnu.org/h5md/
+    for details). Only pairs of a SPECIES_1 and
+    a SPECIES_2 particle whose distance lies
+    strictly between R_MIN and R_MAX are counted
+    (see `neighbor_pairs`) and frames with NaN
+    positions are skipped.
 
     Parameters
     ----------
@@ -192,54 +344,515 @@ def radial_distribution(h5md_pos, h5md_species, SPECIES_1, SPECIES_2, TIMESTEP_M
     """
     if R_MAX is None:
         R_MAX = 0.5 * BOX_L # due to minimum image convention
-    VOLUME = BOX_L*BOX_L*BOX_L
-    step = (R_MAX-R_MIN)/float(N_BINS)
     bin_edges = np.linspace(R_MIN, R_MAX, num=N_BINS+1, endpoint=True)
-    N_SPECIES_1 = np.sum(h5md_species[:]==SPECIES_1)
-    N_SPECIES_2 = np.sum(h5md_species[:]==SPECIES_2)
-    hist_master = np.zeros(N_BINS)
+    mask_1 = np.asarray(h5md_species[:]) == SPECIES_1
+    mask_2 = np.asarray(h5md_species[:]) == SPECIES_2
+    hist = np.zeros(N_BINS, dtype=np.int64)
     for i in range(TIMESTEP_MIN, TIMESTEP_MAX):
-        bin_mids = (bin_edges + 0.5*step)[:-1]
-        hist = np.zeros(N_BINS)
-        count = 0 
-        SPECIES_1_pos = h5md_pos[i,h5md_species[:]==SPECIES_1,:]
-        SPECIES_2_pos = h5md_pos[i,h5md_species[:]==SPECIES_2,:]
-        nans1 = np.count_nonzero(np.isnan(SPECIES_1_pos))
-        nans2 = np.count_nonzero(np.isnan(SPECIES_2_pos))
-        if (nans1 > 0 or nans2 > 0):
-            print("DEBUG\tnumber of nan values: ", nans1, nans2)
-            break
-        for j in range(N_SPECIES_1):
-            for k in range(N_SPECIES_2):
-                diff_vector = SPECIES_1_pos[j,:] - SPECIES_2_pos[k,:]
-                diff_vector_minimum_image = diff_vector - BOX_L * np.rint(diff_vector/BOX_L)
-                norm_diff_vector_minimum_image = np.linalg.norm(diff_vector_minimum_image)
-                if (norm_diff_vector_minimum_image > R_MIN and norm_diff_vector_minimum_image < R_MAX):
-                    hist_bin = np.digitize(np.array([norm_diff_vector_minimum_image,]), bin_edges)[0]-1
-                    hist[hist_bin] += 1
-                    count += 1
-                elif (count==0 and math.isnan(norm_diff_vector_minimum_image)):
-                    print("DEBUG\tdiff_vector: ", diff_vector)
-                    print("DEBUG\tSPECIES_1_pos: ", SPECIES_1_pos[j,:])
-                    print("DEBUG\tSPECIES_2_pos: ", SPECIES_2_pos[k,:], "\n")
-    
-        for i in range(0,len(bin_edges)-1):
-            r_in = bin_edges[i]
-            r_out = r_in + step
-            bin_volume = 4.0/3.0 * np.pi*((r_out*r_out*r_out) - (r_in*r_in*r_in))
-            hist[i] *= VOLUME/ ( bin_volume*float(count) )
-        hist_master += hist
-    hist_master /= float(TIMESTEP_MAX-TIMESTEP_MIN)
-    return hist_master, bin_mids
+        frame = np.asarray(h5md_pos[i])
+        SPECIES_1_pos = frame[mask_1]
+        SPECIES_2_pos = frame[mask_2]
+        if np.isnan(SPECIES_1_pos).any() or np.isnan(SPECIES_2_pos).any():
+            continue
+        # only the cross pairs are searched, not those within a species
+        for _, _, dist in neighbor_pairs(SPECIES_1_pos, SPECIES_2_pos, BOX_L,
+                                         R_MAX):
+            hist += np.histogram(dist[dist > R_MIN], bins=bin_edges)[0]
+    # normalised by the number of pairs within range, summed over all frames
+    shell_volumes = 4. / 3. * np.pi * (bin_edges[1:]**3 - bin_edges[:-1]**3)
+    hist_master = _box_volume(BOX_L) * hist / (shell_volumes * hist.sum())
+    return hist_master, 0.5 * (bin_edges[1:] + bin_edges[:-1])
+
+
+def radial_distribution_partials(h5md_pos, h5md_species, box, n_bins,
+                                 r_min=0., r_max=None, species=None,
+                                 timesteps=None, nan_policy='raise'):
+    """ Partial radial distribution functions of several species.
+
+    Calculates the RDFs of all pairs of the given species, the total RDF
+    and the coordination numbers in a single pass over the frames of
+    `h5md_pos`. The pairs of every frame are found in one neighbor search
+    (see `neighbor_pairs`) over all particles of the selected species.
+
+    Parameters
+    ----------
+    h5md_pos: array_like
+        Three dimensional array [timesteps, particles, xyz] of the
+        particle trajectory, e.g. the result of `kaipy.util.h5md_pos`.
+    h5md_species: array_like
+        One dimensional array of the species of every particle.
+    box: float or array_like
+        Box as in `minimum_image_vectors`.
+    n_bins: int
+        Number of bins of the RDFs.
+    r_min: float
+        Minimum radial distance. Distances in [r_min, r_max) are
+        counted, pairs of a particle with itself never.
+    r_max: float
+        Maximum radial distance. Defaults to half the smallest width of
+        the box.
+    species: array_like
+        Species to include. Defaults to all species in `h5md_species`.
+    timesteps: iterable of int
+        Frames to average over. Defaults to all frames.
+    nan_policy: str
+        Treatment of frames with NaN positions, see
+        `RadialDistributionAccumulator`.
+
+    Returns
+    -------
+    RDFResult
+        Pair counts and the RDFs derived from them.
+    """
+    accumulator = RadialDistributionAccumulator(
+        h5md_species, box, n_bins, r_min, r_max, species=species,
+        nan_policy=nan_policy)
+    if timesteps is None:
+        timesteps = range(len(h5md_pos))
+    for t in timesteps:
+        accumulator.update(h5md_pos[t])
+    return accumulator.result()
+
+
+class RadialDistributionAccumulator(Accumulator):
+    """ Streaming partial radial distribution functions.
+
+    Accumulates the ordered pair counts of all pairs of species frame by
+    frame. The counts are normalised only once in `result`, so that the
+    accumulator can reduce the frames of a `kaipy.parallel` trajectory
+    (with an observable returning the positions) and partial results of
+    several workers can be merged.
+
+    Parameters
+    ----------
+    h5md_species: array_like
+        One dimensional array of the species of every particle.
+    box: float or array_like
+        Box as in `minimum_image_vectors`.
+    n_bins: int
+        Number of bins of the RDFs.
+    r_min: float
+        Minimum radial distance. Distances in [r_min, r_max) are
+        counted, pairs of a particle with itself never.
+    r_max: float
+        Maximum radial distance. Defaults to half the smallest width of
+        the box.
+    species: array_like
+        Species to include. Defaults to all species in `h5md_species`.
+    nan_policy: str
+        'raise' raises a ValueError for frames with NaN positions,
+        'skip' leaves them out and counts them in `n_skipped`.
+    """
+
+    def __init__(self, h5md_species, box, n_bins, r_min=0., r_max=None,
+                 species=None, nan_policy='raise'):
+        if nan_policy not in ('raise', 'skip'):
+            raise ValueError("Unknown nan_policy '{}'.".format(nan_policy))
+        self.nan_policy = nan_policy
+        self.box = np.asarray(box, dtype=float)
+        if r_max is None:
+            r_max = 0.5 * _box_min_width(self.box)
+        self.bin_edges = np.linspace(r_min, r_max, num=n_bins+1,
+                                     endpoint=True)
+        h5md_species = np.asarray(h5md_species[:])
+        if species is None:
+            species = np.unique(h5md_species)
+        self.species = list(species)
+        codes = np.full(len(h5md_species), -1, dtype=np.intp)
+        for k, label in enumerate(self.species):
+            codes[h5md_species == label] = k
+        self.selected = codes >= 0
+        self.codes = codes[self.selected]
+        self.n_particles = np.bincount(self.codes,
+                                       minlength=len(self.species))
+        self.counts = np.zeros((len(self.species), len(self.species),
+                                n_bins), dtype=np.int64)
+        self.n_frames = 0
+        self.n_skipped = 0
+
+    def update(self, value):
+        """
+        Add the pair counts of one frame of positions [particles, xyz].
+        """
+        frame = np.asarray(value)[self.selected]
+        if np.isnan(frame).any():
+            if self.nan_policy == 'raise':
+                raise ValueError("Frame contains NaN positions.")
+            self.n_skipped += 1
+            return
+        _pair_counts(frame, self.codes, self.box, self.bin_edges,
+                     out=self.counts)
+        self.n_frames += 1
+
+    def merge(self, other):
+        self.counts += other.counts
+        self.n_frames += other.n_frames
+        self.n_skipped += other.n_skipped
+
+    def allreduce(self, comm):
+        total = np.zeros_like(self.counts)
+        comm.Allreduce(self.counts, total)
+        self.counts = total
+        self.n_frames = comm.allreduce(self.n_frames)
+        self.n_skipped = comm.allreduce(self.n_skipped)
+
+    def result(self):
+        return RDFResult(self.bin_edges, self.species, self.n_particles,
+                         self.counts, self.n_frames, _box_volume(self.box))
+
+
+class RDFResult(object):
+    """ Partial radial distribution functions from pair counts.
+
+    Attributes
+    ----------
+    bin_edges: array_like
+        Edges of the radial bins.
+    bin_mids: array_like
+        Midpoints of the radial bins.
+    species: list
+        Species labels, in the order of the first two axes of `counts`
+        and `rdf`.
+    n_particles: array_like
+        Number of particles of every species.
+    counts: array_like
+        Ordered pair counts of shape [species, species, bins] summed over
+        all frames.
+    n_frames: int
+        Number of frames the counts were summed over.
+    volume: float
+        Volume of the simulation box.
+    shell_volumes: array_like
+        Volumes of the spherical shells of the bins.
+    rdf: array_like
+        Partial RDFs g_ab(r) of shape [species, species, bins].
+    total: array_like
+        RDF of all particles irrespective of their species.
+    coordination: array_like
+        Mean number of particles of species b within the upper bin edge
+        (and beyond `bin_edges[0]`) of a particle of species a, of shape
+        [species, species, bins].
+    """
+
+    def __init__(self, bin_edges, species, n_particles, counts, n_frames,
+                 volume):
+        self.bin_edges = np.asarray(bin_edges, dtype=float)
+        self.bin_mids = 0.5 * (self.bin_edges[1:] + self.bin_edges[:-1])
+        self.species = list(species)
+        self.n_particles = np.asarray(n_particles)
+        self.counts = counts
+        self.n_frames = n_frames
+        self.volume = volume
+        self.shell_volumes = 4.0/3.0 * np.pi * np.diff(self.bin_edges**3)
+        shell = self.shell_volumes
+        # number of ordered pairs of distinct particles
+        n = self.n_particles.astype(float)
+        n_pairs = np.outer(n, n) - np.diag(n)
+        ideal = n_frames * n_pairs[:, :, np.newaxis] * shell / volume
+        self.rdf = np.divide(counts, ideal, out=np.zeros(counts.shape),
+                             where=ideal > 0)
+        n_total = n.sum()
+        ideal_total = n_frames * n_total * (n_total - 1) * shell / volume
+        self.total = np.divide(counts.sum(axis=(0, 1)), ideal_total,
+                               out=np.zeros(len(shell)),
+                               where=ideal_total > 0)
+        norm = (n_frames * n)[:, np.newaxis, np.newaxis]
+        self.coordination = np.divide(
+            np.cumsum(counts, axis=-1), norm,
+            out=np.zeros(counts.shape), where=norm > 0)
+
+    def _index(self, species):
+        return self.species.index(species)
+
+    def partial(self, species_1, species_2):
+        """ RDF of particles of `species_2` around `species_1`. """
+        return self.rdf[self._index(species_1), self._index(species_2)]
+
+    def coordination_number(self, species_1, species_2):
+        """ Coordination number of `species_2` around `species_1`. """
+        return self.coordination[self._index(species_1),
+                                 self._index(species_2)]
+
+
+def _pair_counts(pos, codes, box, bin_edges, out):
+    """ Add the histograms of the ordered pair distances of all species.
+
+    `codes` are the species indices of the particles into the first two
+    axes of `out`, which has shape [species, species, bins].
+    """
+    n_species, n_bins = out.shape[1:]
+    width = (bin_edges[-1] - bin_edges[0]) / n_bins
+    for i, j, dist in neighbor_pairs(pos, pos, box, bin_edges[-1]):
+        bins = np.floor((dist - bin_edges[0]) / width).astype(np.intp)
+        keep = (i != j) & (bins >= 0) & (bins < n_bins)
+        index = (codes[i[keep]] * n_species + codes[j[keep]]) * n_bins \
+            + bins[keep]
+        out += np.bincount(index, minlength=out.size).reshape(out.shape)
+    return out
+
+
+def _box_volume(box):
+    """ Volume of a cubic, orthorhombic or triclinic box. """
+    box = np.asarray(box, dtype=float)
+    if box.ndim == 2:
+        return abs(np.linalg.det(box))
+    return np.prod(np.broadcast_to(box, (3,)))
+
+
+def _box_min_width(box):
+    """ Smallest distance between opposite faces of the box. """
+    box = np.asarray(box, dtype=float)
+    if box.ndim == 2:
+        faces = np.cross(box[[1, 2, 0]], box[[2, 0, 1]])
+        return _box_volume(box) / np.linalg.norm(faces, axis=-1).max()
+    return np.min(box)
+
+
+def neighbor_pairs(pos1, pos2, box_l, r_max, block_size=2**18):
+    """ Pairs of particles within a cutoff.
+
+    Finds all pairs of positions `pos1[i]`, `pos2[j]` whose minimum
+    image distance in a periodic box is smaller than `r_max`. A
+    periodic cell list is used if at least three cells of edge length
+    `r_max` fit into the box in every direction, otherwise all pairs
+    are checked. The pairs are generated in blocks to bound the memory
+    consumption.
+
+    Parameters
+    ----------
+    pos1: array_like
+        Array of shape [n_particles_1, 3] of finite positions.
+    pos2: array_like
+        Array of shape [n_particles_2, 3] of finite positions.
+    box_l: float or array_like
+        Length(s) of the periodic simulation box or the edge vectors of
+        a triclinic box as rows of a matrix, which are always searched
+        without cell list.
+    r_max: float
+        Cutoff distance.
+    block_size: int
+        Approximate number of candidate pairs checked at once, which
+        bounds the size of the temporary arrays. The particles of `pos1`
+        are processed in blocks of about `block_size` divided by the
+        number of candidates per particle (all of `pos2`, or those in
+        the 27 neighboring cells on average).
+
+    Yields
+    ------
+    array_like, array_like, array_like
+        Indices into `pos1`, indices into `pos2` and the distances of
+        the pairs found in one block.
+    """
+    pos1 = np.asarray(pos1, dtype=float)
+    pos2 = np.asarray(pos2, dtype=float)
+    box_l = np.asarray(box_l, dtype=float)
+    if box_l.ndim < 2:
+        box_l = np.broadcast_to(box_l, (3,))
+        n_cells = np.floor(box_l / r_max).astype(int)
+    if box_l.ndim == 2 or np.any(n_cells < 3):
+        # every row of pos1 is paired with all of pos2
+        rows = max(1, block_size // max(len(pos2), 1))
+        for start in range(0, len(pos1), rows):
+            diff = minimum_image_vectors(
+                pos1[start:start+rows, np.newaxis, :],
+                pos2[np.newaxis, :, :], box_l)
+            dist = np.sqrt(np.square(diff).sum(axis=-1))
+            i, j = np.nonzero(dist < r_max)
+            yield i + start, j, dist[i, j]
+        return
+    cell_l = box_l / n_cells
+    cells_1 = np.floor(pos1 / cell_l).astype(np.int64) % n_cells
+    cells_2 = np.ravel_multi_index(
+        (np.floor(pos2 / cell_l).astype(np.int64) % n_cells).T, n_cells)
+    # particles of pos2 sorted by cell and the index range of each cell
+    order_2 = np.argsort(cells_2, kind='mergesort')
+    cell_count = np.bincount(cells_2, minlength=np.prod(n_cells))
+    cell_start = np.cumsum(cell_count) - cell_count
+    per_row = 27. * len(pos2) / np.prod(n_cells)
+    rows = max(1, int(block_size // max(per_row, 1.)))
+    for start in range(0, len(pos1), rows):
+        block = cells_1[start:start+rows]
+        for shift in itertools.product((-1, 0, 1), repeat=3):
+            neighbor = np.ravel_multi_index(
+                ((block + shift) % n_cells).T, n_cells)
+            count = cell_count[neighbor]
+            n_candidates = count.sum()
+            if n_candidates == 0:
+                continue
+            i = np.repeat(np.arange(len(block)), count)
+            run_start = np.repeat(np.cumsum(count) - count, count)
+            j = order_2[np.repeat(cell_start[neighbor], count) +
+                        np.arange(n_candidates) - run_start]
+            i += start
+            diff = minimum_image_vectors(pos1[i], pos2[j], box_l)
+            dist = np.sqrt(np.square(diff).sum(axis=-1))
+            within = dist < r_max
+            yield i[within], j[within], dist[within]
 
 
 def minimum_image_distance_vector(pos1, pos2, boxl):
-    return np.array((pos2-pos1)-boxl*np.rint((pos2-pos1)/boxl))
+    return minimum_image_vectors(pos1, pos2, boxl)
 
 
 def minimum_image_distance(pos1, pos2, boxl):
-    return np.linalg.norm((pos2-pos1)-boxl*np.rint((pos2-pos1)/boxl))
-    
+    return minimum_image_distances(pos1, pos2, boxl)
+
+
+def minimum_image_vectors(pos1, pos2, box, out=None):
+    """ Minimum image distance vectors in a periodic box.
+
+    Computes `pos2 - pos1` folded back to the nearest periodic image.
+    The positions broadcast against each other, so that many pairs
+    (both of shape [n, 3]) and one-to-many (shapes [3] and [n, 3]) are
+    handled by the same call.
+
+    Parameters
+    ----------
+    pos1: array_like
+        Positions of shape [..., 3].
+    pos2: array_like
+        Positions of shape [..., 3].
+    box: float or array_like
+        Edge length of a cubic box, per-axis edge lengths of shape [3]
+        of an orthorhombic box or the edge vectors of a triclinic box as
+        rows of a [3, 3] matrix, as stored in H5MD
+        `particles/atoms/box/edges` (see :func:`kaipy.util.h5md_box`).
+    out: array_like, optional
+        Float array of the broadcast shape the result is written into.
+
+    Returns
+    -------
+    array_like
+        Distance vectors of the broadcast shape of `pos1` and `pos2`.
+    """
+    diff = np.subtract(pos2, pos1, out=out, dtype=float)
+    # folded in place unless the positions are scalars
+    return _minimum_image(diff, box, out=diff if isinstance(
+        diff, np.ndarray) else None)
+
+
+def minimum_image_distances(pos1, pos2, box, out=None, buffer=None):
+    """ Minimum image distances in a periodic box.
+
+    The distance vectors are computed as an intermediate of the
+    broadcast shape of `pos1` and `pos2`, which is allocated on every
+    call unless `buffer` is given.
+
+    Parameters
+    ----------
+    pos1: array_like
+        Positions of shape [..., 3].
+    pos2: array_like
+        Positions of shape [..., 3].
+    box: float or array_like
+        Box as in :func:`minimum_image_vectors`.
+    out: array_like, optional
+        Float array of the broadcast shape without the last axis the
+        result is written into.
+    buffer: array_like, optional
+        Float array of the broadcast shape used for the distance
+        vectors, e.g. to reuse it between calls. Triclinic boxes still
+        allocate temporaries of this size.
+
+    Returns
+    -------
+    array_like or float
+        Distances of the broadcast shape of `pos1` and `pos2` without
+        the last axis.
+    """
+    diff = minimum_image_vectors(pos1, pos2, box, out=buffer)
+    np.square(diff, out=diff)
+    out = np.sum(diff, axis=-1, out=out)
+    return np.sqrt(out, out=out) if isinstance(out, np.ndarray) \
+        else np.sqrt(out)
+
+
+def minimum_image_pdist(pos, box, out=None, block_size=4096):
+    """ Condensed minimum image distances of all pairs.
+
+    Parameters
+    ----------
+    pos: array_like
+        Positions of shape [n_particles, 3].
+    box: float or array_like
+        Box as in :func:`minimum_image_vectors`.
+    out: array_like, optional
+        Float array of shape [n_particles * (n_particles - 1) / 2] the
+        result is written into.
+    block_size: int
+        Approximate number of pairs computed at once, which bounds the
+        size of the temporary distance vectors.
+
+    Returns
+    -------
+    array_like
+        Distances of the pairs (0, 1), (0, 2), ..., (1, 2), ... in the
+        order of :func:`numpy.triu_indices` with `k=1`.
+    """
+    pos = np.asarray(pos, dtype=float)
+    n = len(pos)
+    if out is None:
+        out = np.empty(n * (n - 1) // 2)
+    elif out.shape != (n * (n - 1) // 2,):
+        raise ValueError("out has shape {}, expected {}".format(
+            out.shape, (n * (n - 1) // 2,)))
+    buffer = np.empty((max(block_size, n), 3))
+    start = 0
+    i = 0
+    while i < n - 1:
+        # rows i..j-1 of the upper triangle fit into one buffer
+        j = i + 1
+        n_pairs = n - j
+        while j < n - 1 and n_pairs + n - j - 1 <= len(buffer):
+            j += 1
+            n_pairs += n - j
+        counts = np.arange(n - i - 1, n - j - 1, -1)
+        rows = np.repeat(np.arange(i, j), counts)
+        cols = np.arange(n_pairs) - np.repeat(np.cumsum(counts) - counts,
+                                              counts) + rows + 1
+        diff = minimum_image_vectors(pos[rows], pos[cols], box,
+                                     out=buffer[:n_pairs])
+        np.square(diff, out=diff)
+        block = out[start:start+n_pairs]
+        np.sum(diff, axis=-1, out=block)
+        np.sqrt(block, out=block)
+        start += n_pairs
+        i = j
+    return out
+
+
+def _minimum_image(diff, box, out=None):
+    """ Distance vectors `diff` folded to the nearest image.
+
+    The result is written into `out` if given, which may be `diff`.
+    """
+    diff = np.asarray(diff, dtype=float)
+    box = np.asarray(box, dtype=float)
+    if box.ndim == 2:
+        # fractional coordinates with the edge vectors as rows of box
+        frac = np.dot(diff, np.linalg.inv(box))
+        frac -= np.rint(frac)
+        result = np.dot(frac, box)
+        # rounding alone misses the nearest image in skewed boxes, so the
+        # neighboring images are checked as well
+        base = result.copy()
+        best = np.square(base).sum(axis=-1)
+        for shift in itertools.product((-1, 0, 1), repeat=3):
+            if not any(shift):
+                continue
+            candidate = base + np.dot(shift, box)
+            dist = np.square(candidate).sum(axis=-1)
+            closer = dist < best
+            result = np.where(closer[..., np.newaxis], candidate, result)
+            best = np.minimum(dist, best)
+        if out is None:
+            return result
+        out[...] = result
+        return out
+    shift = np.rint(diff / box)
+    shift *= box
+    return np.subtract(diff, shift, out=out)
+
 
 def msd_fft(x):
     """ Mean square displacement.
@@ -255,47 +868,229 @@ def msd_fft(x):
     Parameters
     ----------
     x: array_like
-        Array of length number of beads of polymer.
+        Array of shape [frames, dimensions] of the
+        unfolded trajectory of one particle.
 
     Returns
     -------
     array_like
     """
-    def autocorr(x):
-        N=len(x)
-        F = np.fft.fft(x, n=2*N)  #2*N because of zero-padding
-        PSD = F * F.conjugate()
-        res = np.fft.ifft(PSD)
-        res= (res[:N]).real   #now we have the autocorrelation in convention B
-        n=N*np.ones(N)-np.arange(0,N) #divide res(m) by (N-m)
-        return res/n #this is the autocorrelation in convention A
-    N = x.shape[0]
-    D = np.square(x).sum(axis=1)
-    D = np.append(D,0)
-    S2 = sum([autocorr(x[:,i]) for i in range(x.shape[1])])
-    Q = 2*D.sum()
-    S1 = np.zeros(N)
-    for m in range(N):
-        Q = Q-D[m-1]-D[N-m]
-        S1[m]=Q/(N-m)
-    return S1-2*S2
+    x = np.asarray(x, dtype=float)
+    return _msd_average(x[:, np.newaxis, :])
+
+
+def msd_ensemble(x, species=None, chain_length=None, block_size=1024):
+    """ Ensemble averaged mean square displacement.
+
+    Calculates the mean square displacement averaged over
+    all particles of the unfolded trajectory x (see `msd_fft`).
+    The FFTs of all particles are done along the time axis
+    in blocks of `block_size` particles and summed in
+    frequency space, so that only one inverse transform is
+    needed per average.
+
+    Parameters
+    ----------
+    x: array_like
+        Array of shape [frames, particles, 3].
+    species: Optional[array_like]
+        Array of length number of particles (or number of
+        chains if `chain_length` is given). If given, the
+        average is done separately for each species.
+    chain_length: Optional[int]
+        If given, consecutive particles form chains of this
+        length and the MSD of the chain centers of mass is
+        calculated.
+    block_size: int
+        Number of particles transformed at once.
+
+    Returns
+    -------
+    array_like or dict
+        Array of length number of frames or, if `species` is
+        given, a dict mapping each species to such an array.
+    """
+    x = np.asarray(x, dtype=float)
+    if chain_length is not None:
+        x = center_of_mass(x.reshape(
+            (x.shape[0], -1, chain_length, x.shape[-1])))
+    if species is None:
+        return _msd_average(x, block_size)
+    species = np.asarray(species)
+    return dict((s, _msd_average(x[:, species == s, :], block_size))
+                for s in np.unique(species))
+
+
+def h5md_msd(h5_dh, ts=None, species=None, block_size=1024, chunk_size=None):
+    """ Ensemble averaged mean square displacement from H5MD file.
+
+    Out-of-core version of `msd_ensemble`. The unfolded trajectories
+    (see `kaipy.util.h5md_pos`) are read in blocks of `block_size`
+    particles, transformed and accumulated, so that the memory
+    consumption is bounded by the block size and not by the number
+    of particles.
+
+    Parameters
+    ----------
+    h5_dh: h5py file handle
+    ts: Optional[array_like]
+        Increasing, equally spaced timesteps. Defaults to all timesteps.
+    species: Optional[array_like]
+        Array of length number of particles in id order. If given, the
+        average is done separately for each species.
+    block_size: int
+        Number of particles read and transformed at once.
+    chunk_size: Optional[int]
+        Maximum number of timesteps per read.
+
+    Returns
+    -------
+    array_like or dict
+        Array of length number of timesteps or, if `species` is
+        given, a dict mapping each species to such an array.
+    """
+    if ts is None:
+        ts = np.arange(h5_dh["particles/atoms/position/value"].shape[0])
+    ts = np.asarray(ts, dtype=int).ravel()
+    if len(ts) > 1 and (ts[1] <= ts[0] or
+                        np.any(np.diff(ts) != ts[1] - ts[0])):
+        raise ValueError("the timesteps have to be increasing and equally "
+                         "spaced")
+    n_ts = len(ts)
+    n_fft = next_fast_len(2 * n_ts)  # zero-padding
+    labels = [None] if species is None else np.unique(species)
+    sums = dict((s, [np.zeros(n_fft // 2 + 1), np.zeros(n_ts), 0])
+                for s in labels)
+    for particles, x in h5md_pos_particle_blocks(h5_dh, ts, folded=False,
+                                                 block_size=block_size,
+                                                 chunk_size=chunk_size):
+        for s in labels:
+            if s is None:
+                x_s = x
+            else:
+                x_s = x[:, np.asarray(species)[particles] == s, :]
+            _msd_sums(x_s, n_fft, sums[s][0], sums[s][1])
+            sums[s][2] += x_s.shape[1]
+    result = dict((s, _msd_from_sums(power, D, n_fft) / count)
+                  for s, (power, D, count) in sums.items())
+    if species is None:
+        return result[None]
+    return result
+
+
+def _msd_average(x, block_size=1024):
+    """ MSD averaged over the particles of x [frames, particles, dims].
+
+    The S1 term only depends on the sum of the squared positions and the
+    S2 term only on the summed power spectra of all particles and
+    dimensions, so both are accumulated before the final transform.
+    """
+    n_fft = next_fast_len(2 * x.shape[0])  # zero-padding
+    power = np.zeros(n_fft // 2 + 1)
+    D = np.zeros(x.shape[0])
+    for start in range(0, x.shape[1], block_size):
+        _msd_sums(x[:, start:start+block_size, :], n_fft, power, D)
+    return _msd_from_sums(power, D, n_fft) / x.shape[1]
+
+
+def _msd_sums(x, n_fft, power, D):
+    """ Add the power spectra and squared positions of x to power and D. """
+    F = np.fft.rfft(x, n=n_fft, axis=0)
+    power += (np.square(F.real) + np.square(F.imag)).sum(axis=(1, 2))
+    D += np.square(x).sum(axis=(1, 2))
+
+
+def _msd_from_sums(power, D, n_fft):
+    """ MSD from the summed power spectrum and squared positions. """
+    N = len(D)
+    n = N - np.arange(N)  # divide res(m) by (N-m)
+    S2 = np.fft.irfft(power, n=n_fft)[:N] / n
+    cs = np.concatenate(([0.], np.cumsum(D)))
+    S1 = (cs[-1] - cs[:N] + cs[N:0:-1]) / n
+    return S1 - 2 * S2
 
 
 def rouse_mode(x, p):
     """ Rouse mode `p`.
 
     Calculate the Rouse mode `p` for a polymer with coordinates
-    `x`.
+    `x`. Leading dimensions of x (e.g. frames or chains) are
+    evaluated at once.
 
     Parameters
     ----------
     x: array_like
-       Array of length number of beads of polymer.
+       Array of shape [..., number of beads of polymer, 3].
     p: int
        Number indicating the Rouse mode.
+
+    Returns
+    -------
+    array_like
+        Array of shape x.shape[:-2] + (3,).
+    """
+    x = np.asarray(x)
+    N = x.shape[-2]  # Number of monomers
+    weights = np.cos((np.arange(N) + 0.5) * np.pi * float(p) / N)
+    return np.sqrt(2.0/float(N)) * np.einsum('i,...ij->...j', weights, x)
+
+
+def rouse_modes(x, p=None):
+    """ Rouse modes of a polymer.
+
+    Calculate all Rouse modes (or the modes `p`) for a polymer with
+    coordinates `x` at once. The modes are a type-II discrete cosine
+    transform along the polymer, which is evaluated with a real FFT of
+    the mirrored polymer. Leading dimensions of x (e.g. frames or
+    chains) are evaluated at once.
+
+    Parameters
+    ----------
+    x: array_like
+       Array of shape [..., number of beads of polymer, 3].
+    p: Optional[array_like]
+       Numbers of the Rouse modes in [0, number of beads). Defaults to
+       all modes.
+
+    Returns
+    -------
+    array_like
+        Array of shape x.shape[:-2] + (number of modes, 3), where
+        element [..., i, :] equals `rouse_mode(x, p[i])`.
+    """
+    x = np.asarray(x, dtype=float)
+    N = x.shape[-2]  # Number of monomers
+    mirrored = np.concatenate((x, x[..., ::-1, :]), axis=-2)
+    transform = np.fft.rfft(mirrored, axis=-2)[..., :N, :]
+    phase = np.exp(-0.5j * np.pi * np.arange(N) / N)[:, np.newaxis]
+    modes = np.sqrt(0.5/float(N)) * (phase * transform).real
+    if p is not None:
+        modes = modes[..., np.asarray(p), :]
+    return modes
+
+
+def rouse_mode_autocorrelation(modes, normalized=True):
+    """ Time autocorrelation of Rouse modes.
+
+    Calculates <X_p(t) X_p(0)> for Rouse modes `modes` of consecutive
+    frames (see `rouse_modes`), averaged over all time origins and all
+    dimensions between the time and the mode axis (e.g. chains).
+
+    Parameters
+    ----------
+    modes: array_like
+        Array of shape [frames, ..., number of modes, 3].
+    normalized: bool
+        If True, the autocorrelation is divided by its value at t=0.
+
+    Returns
+    -------
+    array_like
+        Array of shape [frames, number of modes].
     """
-    N = x.shape[0]  # Number of monomers
-    res = np.zeros(x.shape[1])
-    for i in range(0,N):
-        res += x[i,:] * np.cos((float(i+0.5)*np.pi*float(p)/N))
-    return np.sqrt(2.0/float(N))*res
+    modes = np.asarray(modes, dtype=float)
+    acf = correlation(modes).sum(axis=-1)
+    acf = acf.reshape((acf.shape[0], -1, acf.shape[-1])).mean(axis=1)
+    if normalized:
+        acf /= acf[0]
+    return acf
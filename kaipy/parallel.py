@@ -2,17 +2,37 @@
 # -*- coding: utf-8 -*-
 
 """
-Module for MPI parallel calculations.
+Module for MPI parallel calculations and their single node counterparts
+based on process and thread pools.
 """
 
 
 from __future__ import print_function
 import abc
+import concurrent.futures
+import copy
 import logging
+import os
+import time
+import h5py
 import numpy as np
+from kaipy.statistic import Accumulator, SumAccumulator, MeanAccumulator,\
+    VarianceAccumulator, BlockingAccumulator
+from kaipy.profiling import Profiler
+from kaipy.util import h5md_pos_iter, h5md_read_count
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
 
 LOGGER = logging.getLogger(__name__)
 
+REDUCERS = {'sum': SumAccumulator,
+            'mean': MeanAccumulator,
+            'variance': VarianceAccumulator,
+            'blocking': BlockingAccumulator}
+
 
 class ParallelTrajectory(object):
     """
@@ -26,7 +46,8 @@ class ParallelTrajectory(object):
         Parameters:
         -----------
         comm : mpi4py.MPI.Intracomm
-               MPI communicator.
+               MPI communicator. If None, the calculation is done by a
+               single rank (see `H5mdPoolTrajectory`).
         obs : function
               Function to be used for the calculation.
         res_shape : tuple
@@ -42,19 +63,51 @@ class ParallelTrajectory(object):
         """
         self.total_result = None
         self.comm = kwargs['comm']
-        self.mpi_rank = self.comm.Get_rank()
-        self.mpi_size = self.comm.Get_size()
+        if self.comm is None:
+            self.mpi_rank = 0
+            self.mpi_size = 1
+        else:
+            self.mpi_rank = self.comm.Get_rank()
+            self.mpi_size = self.comm.Get_size()
+
+    def calc_global_range(self, n_ts, stride, offset=0):
+        """
+        Calculate the timesteps of all ranks.
+
+        Parameters:
+        -----------
+        n_ts : int
+               Number of total timesteps.
+        stride : int
+                 Timestep stride.
+        offset : int
+                 Timestep offset.
+
+        Returns:
+        --------
+        array_like
+            Indices of all timesteps to calculate.
+
+        """
+        return np.arange(offset, offset + n_ts, stride)
 
     def calc_range(self, rank, n_ts, stride, offset=0):
         """
         Calculate the timestep range for the current rank.
 
+        The global strided timesteps (see `calc_global_range`) are split
+        into contiguous parts whose lengths differ by at most one.
+
         Parameters:
         -----------
+        rank : int
+               MPI rank.
         n_ts : int
                Number of total timesteps.
         stride : int
                  Timestep stride.
+        offset : int
+                 Timestep offset.
 
         Returns:
         --------
@@ -62,27 +115,33 @@ class ParallelTrajectory(object):
             Indices of the timesteps to calculate.
 
         """
-        start = rank * (n_ts - offset) / self.mpi_size
-        stop = (rank + 1) * (n_ts - offset) / self.mpi_size
-        if rank == 0:
-            return np.arange(0, stop, stride) + offset
-        elif rank == self.mpi_size - 1:
-            res = np.arange(start, n_ts, stride)
-            i = 1
-            while (res[0] % stride) != 0:
-                res = np.arange(start + i, n_ts, stride)
-                i += 1
-            res += offset
-            while res[-1] > (n_ts-1):
-                res = np.arange(res[0], res[-1], stride)
-            return res
-        else:
-            res = np.arange(start, stop, stride)
-            i = 1
-            while res[0] % stride != 0:
-                res = np.arange(start + i, stop, stride)
-                i += 1
-            return res + offset
+        counts = self.calc_counts(n_ts, stride, offset)
+        start = offset + counts[:rank].sum() * stride
+        return np.arange(start, start + counts[rank] * stride, stride)
+
+    def calc_counts(self, n_ts, stride, offset=0):
+        """
+        Calculate the number of timesteps of every rank (see
+        `calc_range`) without building the global timesteps.
+
+        Parameters:
+        -----------
+        n_ts : int
+               Number of total timesteps.
+        stride : int
+                 Timestep stride.
+        offset : int
+                 Timestep offset.
+
+        Returns:
+        --------
+        array_like
+            Number of timesteps of every rank.
+
+        """
+        n_total = len(range(offset, offset + n_ts, stride))
+        ranks = np.arange(self.mpi_size)
+        return n_total // self.mpi_size + (ranks < n_total % self.mpi_size)
 
     @abc.abstractmethod
     def run(self):
@@ -114,6 +173,63 @@ class H5mdParallelTrajectory(ParallelTrajectory):
 
         h5md_file : h5py._hl.files.File
                     Instance of a H5MD file object.
+        chunk_size : int, optional
+                     Number of timesteps read at once (see
+                     :func:`kaipy.util.h5md_pos_iter`). Defaults to the chunk
+                     layout of the position dataset.
+        sort_ids : bool, optional
+                   Sort the positions by particle id. Defaults to False.
+        folded : bool, optional
+                 If False, the positions are unfolded. Defaults to True.
+        collective : bool, optional
+                     Read the frames with collective MPI-IO. Requires h5py
+                     with MPI support and h5md_file opened with
+                     `driver='mpio'` on comm. Defaults to False.
+        prefetch : int, optional
+                   Number of chunk buffers read ahead on a background
+                   thread while obs is evaluated (see
+                   :func:`kaipy.util.h5md_pos_iter`). Defaults to 0, i.e.
+                   no prefetching. Together with collective, MPI has to
+                   be initialised with `MPI_THREAD_MULTIPLE`.
+        reducer : str or kaipy.statistic.Accumulator, optional
+                  If given, the results of obs are accumulated instead of
+                  stored per timestep. Either an accumulator instance, of
+                  which every run uses an empty copy, or one of 'sum',
+                  'mean', 'variance' and 'blocking' for an accumulator of
+                  shape res_shape.
+        schedule : str, optional
+                   'static' (default) splits the timesteps into one
+                   contiguous block per rank, 'dynamic' hands out tasks of
+                   task_size timesteps on demand through a counter in an MPI
+                   window on rank 0. Dynamic scheduling balances observables
+                   whose cost varies between frames, but the frames reach
+                   reducers out of order, so it suits only order independent
+                   accumulators (e.g. not 'blocking').
+        task_size : int, optional
+                    Number of timesteps per task of the dynamic schedule.
+                    Defaults to chunk_size or the chunk layout of the
+                    position dataset.
+        profile : bool or str, optional
+                  If True, time the reads ('io', or 'io/wait' for the
+                  wait on prefetched chunks), count the bytes read, time
+                  every observable ('compute/<name>'), the communication
+                  ('comm') and the wait for the slowest rank before it
+                  ('comm/wait'), which separates I/O bound runs from load
+                  imbalance. 'trace' additionally records every interval
+                  for :meth:`kaipy.profiling.ProfileSummary.to_chrome_trace`,
+                  timed from a barrier at the start of the run. See
+                  `profile_summary`. Defaults to False.
+        transform : function, optional
+                    Function applied once to every frame before the
+                    observables are evaluated on its result, e.g. to
+                    share intermediates such as
+                    :class:`kaipy.topology.ChainObservables` between them.
+
+        Several observables are evaluated in a single pass over the
+        trajectory if obs is a dict of named functions. res_shape and
+        reducer are then dicts with the same names (observables missing
+        in reducer are stored per timestep) and `total_result` is a dict
+        of the results.
 
         """
         # pylint: disable=too-many-instance-attributes
@@ -133,42 +249,716 @@ class H5mdParallelTrajectory(ParallelTrajectory):
             raise ValueError(
                 "H5MD file does not contain valid position dataset.")
         self.obs = kwargs['obs']
+        self.transform = kwargs.get('transform')
         self.stride = kwargs['stride']
         self.offset = kwargs['offset']
         self.res_shape = kwargs['res_shape']
+        self.chunk_size = kwargs.get('chunk_size')
+        self.sort_ids = kwargs.get('sort_ids', False)
+        self.folded = kwargs.get('folded', True)
+        self.prefetch = kwargs.get('prefetch', 0)
+        self.collective = kwargs.get('collective', False)
+        if self.collective:
+            if not h5py.get_config().mpi:
+                raise ValueError(
+                    "Collective reads require h5py built with MPI support.")
+            if self.h5md['file'].driver != 'mpio':
+                raise ValueError(
+                    "Collective reads require a file opened with the "
+                    "'mpio' driver.")
+            from mpi4py import MPI
+            if self.prefetch and \
+                    MPI.Query_thread() != MPI.THREAD_MULTIPLE:
+                # the prefetch thread would issue the collective calls
+                raise ValueError(
+                    "Collective reads with prefetching require MPI "
+                    "initialised with MPI_THREAD_MULTIPLE.")
         if kwargs['n_ts'] == 0:
             self.n_ts = self.h5md['pos'].shape[0] - self.offset
         else:
-            self.n_ts = kwargs['n_ts']
-        self.timestep_range = self.calc_range(self.mpi_rank, self.n_ts,
-                                              self.stride, self.offset)
-        self.mpi_buffer = np.zeros(
-            ((self.timestep_range.shape[0],) + kwargs['res_shape']))
+            self.n_ts = min(kwargs['n_ts'],
+                            self.h5md['pos'].shape[0] - self.offset)
+        self.schedule = kwargs.get('schedule', 'static')
+        if self.schedule not in ('static', 'dynamic'):
+            raise ValueError("Unknown schedule '{}'.".format(self.schedule))
+        if self.schedule == 'dynamic' and self.collective:
+            raise ValueError(
+                "Collective reads require the static schedule.")
+        self.task_size = kwargs.get('task_size') or self.chunk_size or \
+            (self.h5md['pos'].chunks or (16,))[0]
+        if self.schedule == 'dynamic' and self.comm is not None:
+            # the timesteps of every rank are only known after run
+            self.timestep_range = np.array([], dtype=int)
+        else:
+            self.timestep_range = self.calc_range(self.mpi_rank, self.n_ts,
+                                                  self.stride, self.offset)
+        self.local_indices = None
+        self.profile = kwargs.get('profile', False)
+        self.profiler = None
+        self.load = {'frames': 0, 'tasks': 0, 'busy': 0., 'task_times': []}
+        if isinstance(self.obs, dict):
+            # sorted, so that all ranks communicate in the same order
+            self.names = sorted(self.obs)
+            self.observables = self.obs
+            res_shapes = self.res_shape
+            reducers = kwargs.get('reducer') or {}
+        else:
+            self.names = [None]
+            self.observables = {None: self.obs}
+            res_shapes = {None: self.res_shape}
+            reducers = {None: kwargs.get('reducer')}
+        self.res_shapes = {name: tuple(res_shapes[name])
+                           for name in self.names}
+        self.reducer_specs = {name: reducers.get(name) for name in self.names}
+        self.reducers = self.make_reducers()
+        self.mpi_buffers = {
+            name: self.allocate_buffer(
+                (self.timestep_range.shape[0],) + self.res_shapes[name], name)
+            for name in self.names if self.reducers[name] is None}
+
+    @property
+    def reducer(self):
+        """
+        Accumulator of a single observable.
+
+        """
+        return self.reducers.get(None)
+
+    @property
+    def mpi_buffer(self):
+        """
+        Results of all local timesteps of a single observable.
+
+        """
+        return self.mpi_buffers.get(None)
+
+    def allocate_buffer(self, shape, name=None):
+        """
+        Allocate the buffer for the results of all local timesteps of the
+        observable name.
+
+        """
+        return np.zeros(shape)
+
+    @staticmethod
+    def make_reducer(reducer, res_shape):
+        """
+        Create the accumulator for a reducer given by name.
+
+        Parameters:
+        -----------
+        reducer : str, kaipy.statistic.Accumulator or None
+                  Accumulator or one of 'sum', 'mean', 'variance' and
+                  'blocking'.
+        res_shape : tuple
+                    Shape of data returned by obs.
+
+        Returns:
+        --------
+        kaipy.statistic.Accumulator or None
+
+        """
+        if reducer is None:
+            return None
+        if isinstance(reducer, Accumulator):
+            return copy.deepcopy(reducer)
+        try:
+            return REDUCERS[reducer](res_shape)
+        except KeyError:
+            raise ValueError("Unknown reducer '{}'.".format(reducer))
+
+    def make_reducers(self):
+        """
+        Create empty accumulators of all observables with a reducer, so
+        that every run starts from scratch.
+
+        """
+        return {name: self.make_reducer(self.reducer_specs[name],
+                                        self.res_shapes[name])
+                for name in self.names}
+
+    def new_profiler(self):
+        """
+        Profiler for a run, or None if profiling is disabled.
+
+        """
+        if not self.profile:
+            return None
+        return Profiler(trace=self.profile == 'trace')
+
+    def start_profiler(self):
+        """
+        Set up the profiler of a run. With tracing, the ranks synchronize
+        the origin of their event times. Collective for MPI.
+
+        """
+        self.profiler = self.new_profiler()
+        if self.profiler is not None and self.profiler.trace:
+            self.profiler.synchronize(self.comm)
+
+    def profile_summary(self):
+        """
+        Timers and counters of the last run and communication of all
+        ranks. Collective for MPI.
+
+        Returns:
+        --------
+        kaipy.profiling.ProfileSummary
+
+        """
+        if self.profiler is None:
+            raise ValueError("Profiling is disabled, see 'profile'.")
+        return self.profiler.summary(self.comm)
 
     def run(self, *args):
-        logging.debug("Rank: {}, Start: {}, Stop: {}".format(self.mpi_rank,
-                                                             self.timestep_range[
-                                                                 0],
-                                                             self.timestep_range[-1]))
-        logging.debug("Rank: {}, mpi_buffer shape: {}".format(self.mpi_rank,
-                                                              self.timestep_range.shape))
-        for j, i in enumerate(self.timestep_range):
-            self.mpi_buffer[j] = self.obs(self.h5md['pos'][i, :, :], *args)
+        self.load = {'frames': 0, 'tasks': 0, 'busy': 0., 'task_times': []}
+        self.start_profiler()
+        self.reducers = self.make_reducers()
+        if self.schedule == 'dynamic' and self.comm is not None:
+            self._run_dynamic(args)
+            return
+        if len(self.timestep_range):
+            LOGGER.debug("Rank: {}, Start: {}, Stop: {}".format(
+                self.mpi_rank, self.timestep_range[0],
+                self.timestep_range[-1]))
+        for name, buffer in self.mpi_buffers.items():
+            LOGGER.debug("Rank: {}, mpi_buffer {} shape: {}".format(
+                self.mpi_rank, name, buffer.shape))
+        n_reads = None
+        if self.collective:
+            from mpi4py import MPI
+            # every rank takes part in the largest number of reads
+            n_reads = self.comm.allreduce(
+                h5md_read_count(self.h5md['file'], self.timestep_range,
+                                self.chunk_size), op=MPI.MAX)
+        self._run_frames(self.timestep_range, args, self.mpi_buffers,
+                         n_reads)
 
-    def communicate(self):
+    def _run_frames(self, timesteps, args, buffers, n_reads=None):
+        """
+        Evaluate the observables on timesteps and record the load.
+
+        """
+        start = time.perf_counter()
+        chunks = h5md_pos_iter(self.h5md['file'], timesteps,
+                               folded=self.folded, chunk_size=self.chunk_size,
+                               sort_ids=self.sort_ids,
+                               collective=self.collective, n_reads=n_reads,
+                               prefetch=self.prefetch)
+        if self.profiler is not None:
+            chunks = _profiled_reads(
+                chunks, self.profiler, 'io/wait' if self.prefetch else 'io',
+                _frame_bytes(self.h5md['file'], self.sort_ids, self.folded))
+        j = 0
+        for _, frames in chunks:
+            for frame in frames:
+                _evaluate(frame, j, self.observables, self.transform, args,
+                          buffers, self.reducers, self.profiler)
+                j += 1
+        elapsed = time.perf_counter() - start
+        self.load['frames'] += j
+        self.load['tasks'] += 1
+        self.load['busy'] += elapsed
+        return elapsed
+
+    def _run_dynamic(self, args):
+        """
+        Evaluate tasks of task_size timesteps handed out on demand.
+
+        """
+        global_range = self.calc_global_range(self.n_ts, self.stride,
+                                              self.offset)
+        n_tasks = -(-len(global_range) // self.task_size)
+        counter = _TaskCounter(self.comm)
+        indices = []
+        buffers = {name: [] for name in self.mpi_buffers}
+        try:
+            while True:
+                if self.profiler is None:
+                    task = counter.next()
+                else:
+                    task = self.profiler.timed('comm', counter.next)
+                if task >= n_tasks:
+                    break
+                task_indices = np.arange(
+                    task * self.task_size,
+                    min((task + 1) * self.task_size, len(global_range)))
+                task_buffers = {
+                    name: np.zeros((len(task_indices),) +
+                                   self.res_shapes[name])
+                    for name in buffers}
+                elapsed = self._run_frames(global_range[task_indices], args,
+                                           task_buffers)
+                self.load['task_times'].append((task, elapsed))
+                indices.append(task_indices)
+                for name, buffer in task_buffers.items():
+                    buffers[name].append(buffer)
+        finally:
+            counter.free()
+        self.local_indices = np.concatenate(
+            indices + [np.array([], dtype=int)]).astype(np.int64)
+        self.timestep_range = global_range[self.local_indices]
+        self.mpi_buffers = {
+            name: np.concatenate(
+                parts + [np.zeros((0,) + self.res_shapes[name])])
+            for name, parts in buffers.items()}
+        LOGGER.debug("Rank: {}, tasks: {}, frames: {}".format(
+            self.mpi_rank, self.load['tasks'], self.load['frames']))
+
+    def load_report(self):
+        """
+        Load of all ranks in the last run. Collective for MPI.
+
+        Returns:
+        --------
+        dict
+            'frames', 'tasks' and 'busy' (seconds spent reading and
+            evaluating) per rank, the 'imbalance' max(busy) / mean(busy)
+            and, for the dynamic schedule, 'static_imbalance', the
+            imbalance the static schedule would have had for the measured
+            cost of the tasks.
+
+        """
+        load = dict(self.load)
+        task_times = load.pop('task_times')
+        if self.comm is None:
+            loads, all_task_times = [load], [task_times]
+        else:
+            loads = self.comm.allgather(load)
+            all_task_times = self.comm.allgather(task_times)
+        report = {key: [rank_load[key] for rank_load in loads]
+                  for key in ('frames', 'tasks', 'busy')}
+        report['imbalance'] = _imbalance(report['busy'])
+        if self.schedule == 'dynamic' and self.comm is not None:
+            n_frames = sum(report['frames'])
+            frame_cost = np.zeros(n_frames)
+            for task, elapsed in sum(all_task_times, []):
+                frames = slice(task * self.task_size,
+                               min((task + 1) * self.task_size, n_frames))
+                frame_cost[frames] = elapsed / (frames.stop - frames.start)
+            report['static_imbalance'] = _imbalance(
+                [part.sum() for part in
+                 np.array_split(frame_cost, self.mpi_size)])
+        return report
+
+    def communicate(self, mode=None):
+        """
+        Communicate the results of all ranks.
+
+        Parameters:
+        -----------
+        mode : str
+               'gather' collects the results of all timesteps in
+               `total_result` on rank 0 with a single `Gatherv`, 'allreduce'
+               sums the results over all timesteps into `total_result` on
+               every rank (for reducible observables) and 'reduce' combines
+               the accumulators of all ranks and stores their result in
+               `total_result` on every rank. Observables with a reducer are
+               always reduced, the others default to 'gather'.
+
+        Without comm, the local results are the total results.
+
+        """
+        results = {}
+        if self.profiler is not None and self.comm is not None:
+            # separates waiting for the slowest rank from the communication
+            self.profiler.timed('comm/wait', self.comm.Barrier)
+        for name in self.names:
+            if self.profiler is None:
+                results[name] = self._communicate(name, mode)
+            else:
+                results[name] = self.profiler.timed(
+                    'comm', self._communicate, name, mode)
+        self.total_result = results if isinstance(self.obs, dict) \
+            else results[None]
+
+    def _communicate(self, name, mode):
+        """
+        Communicate the results of the observable name.
+
+        """
+        if self.reducers[name] is not None:
+            # the local accumulator is kept for further communication
+            reducer = copy.deepcopy(self.reducers[name])
+            if self.comm is not None:
+                reducer.allreduce(self.comm)
+            return reducer.result()
+        if mode is None:
+            mode = 'gather'
+        res_shape = self.res_shapes[name]
+        mpi_buffer = self.mpi_buffers[name]
+        if self.comm is None and mode in ('gather', 'allreduce'):
+            return mpi_buffer.copy() if mode == 'gather' \
+                else mpi_buffer.sum(axis=0)
+        if mode == 'allreduce':
+            local_result = mpi_buffer.sum(axis=0)
+            total_result = np.zeros_like(local_result)
+            self.comm.Allreduce(local_result, total_result)
+            return total_result
+        if mode == 'gather' and self.local_indices is not None:
+            return self._gather_indexed(mpi_buffer, res_shape)
+        if mode == 'gather':
+            n_values = int(np.prod(res_shape))
+            n_frames = self.calc_counts(self.n_ts, self.stride, self.offset)
+            counts = n_frames * n_values
+            displacements = np.cumsum(counts) - counts
+            total_result = None
+            recv_buffer = None
+            if self.mpi_rank == 0:
+                total_result = np.zeros((n_frames.sum(),) + res_shape)
+                LOGGER.debug(
+                    "Shape of recv_buffer: {}.".format(total_result.shape))
+                recv_buffer = [total_result, (counts, displacements)]
+            LOGGER.debug("Shape of send buffer: {}.".format(mpi_buffer.shape))
+            self.comm.Gatherv(mpi_buffer, recv_buffer, root=0)
+            return total_result
+        if mode == 'reduce':
+            raise ValueError("Observable '{}' has no reducer.".format(name))
+        raise ValueError("Unknown communication mode '{}'.".format(mode))
+
+    def _gather_indexed(self, mpi_buffer, res_shape):
+        """
+        Gather the results of the dynamic schedule on rank 0 and put them
+        into the slots of their global timestep indices.
+
+        """
+        counts = np.array(self.comm.allgather(len(self.local_indices)))
+        displacements = np.cumsum(counts) - counts
+        n_values = int(np.prod(res_shape))
+        indices = values = None
+        index_buffer = value_buffer = None
         if self.mpi_rank == 0:
-            self.total_result = self.mpi_buffer
-            for j in range(1, self.mpi_size):
-                node_range = self.calc_range(
-                    j, self.n_ts, self.stride, self.offset)
-                recv_buffer = np.zeros(
-                    ((node_range.shape[0],) + self.res_shape))
-                logging.debug(
-                    "Shape of recv_buffer: {}.".format(recv_buffer.shape))
-                self.comm.Recv(recv_buffer, source=j, tag=int(j))
-                self.total_result = np.concatenate(
-                    (self.total_result, recv_buffer), axis=0)
+            indices = np.zeros(counts.sum(), dtype=np.int64)
+            values = np.zeros((counts.sum(),) + res_shape)
+            index_buffer = [indices, (counts, displacements)]
+            value_buffer = [values, (counts * n_values,
+                                     displacements * n_values)]
+        self.comm.Gatherv(self.local_indices, index_buffer, root=0)
+        self.comm.Gatherv(mpi_buffer, value_buffer, root=0)
+        if self.mpi_rank != 0:
+            return None
+        total_result = np.zeros_like(values)
+        total_result[indices] = values
+        return total_result
+
+
+class _TaskCounter(object):
+    """
+    Counter of handed out tasks in an MPI window on rank 0, incremented
+    with one-sided atomic operations so that no rank has to serve it.
+
+    """
+
+    def __init__(self, comm):
+        from mpi4py import MPI
+        self.mpi = MPI
+        itemsize = MPI.INT64_T.Get_size()
+        size = itemsize if comm.Get_rank() == 0 else 0
+        self.win = MPI.Win.Allocate(size, itemsize, comm=comm)
+        if comm.Get_rank() == 0:
+            self.win.Lock(0)
+            self.win.Put(np.zeros(1, dtype=np.int64), 0)
+            self.win.Unlock(0)
+        comm.Barrier()
+        self.one = np.ones(1, dtype=np.int64)
+        self.value = np.zeros(1, dtype=np.int64)
+
+    def next(self):
+        """
+        Fetch the next task index.
+
+        """
+        self.win.Lock(0, self.mpi.LOCK_SHARED)
+        self.win.Fetch_and_op(self.one, self.value, 0, 0, self.mpi.SUM)
+        self.win.Unlock(0)
+        return int(self.value[0])
+
+    def free(self):
+        """
+        Free the window. Collective.
+
+        """
+        self.win.Free()
+
+
+def _imbalance(busy):
+    """
+    Ratio of the maximum to the mean of the busy times of all ranks.
+
+    """
+    busy = np.asarray(busy, dtype=float)
+    if busy.mean() == 0:
+        return 1.
+    return busy.max() / busy.mean()
+
+
+class H5mdPoolTrajectory(H5mdParallelTrajectory):
+    """
+    Parallel evaluation for H5MD files on a single node with a pool of
+    processes or threads instead of MPI.
+
+    The timesteps are split evenly between the workers. Every worker opens
+    the H5MD file read-only itself and writes its results directly into a
+    shared memory buffer, so no arrays are pickled.
+
+    """
+
+    def __init__(self, **kwargs):
+        """
+        Parameters:
+        -----------
+
+        h5md_file : h5py._hl.files.File or str
+                    H5MD file object or file name.
+        n_workers : int, optional
+                    Number of workers. Defaults to the number of CPUs.
+        executor : str, optional
+                   'process' (default) or 'thread'. Threads only give a
+                   speedup for observables that release the GIL, e.g.
+                   NumPy operations on large arrays. The process pool
+                   requires obs and the accumulator to be picklable.
+
+        The remaining parameters are those of `H5mdParallelTrajectory`
+        except comm.
+
+        """
+        self.shared_memory = None
+        self.executor = kwargs.get('executor', 'process')
+        if self.executor not in ('process', 'thread'):
+            raise ValueError(
+                "Unknown executor '{}'.".format(self.executor))
+        if self.executor == 'process' and shared_memory is None:
+            raise ImportError(
+                "The process executor requires multiprocessing.shared_memory"
+                " (Python >= 3.8).")
+        self.n_workers = kwargs.get('n_workers') or os.cpu_count()
+        h5md_file = kwargs['h5md_file']
+        opened = not isinstance(h5md_file, h5py.File)
+        if opened:
+            h5md_file = h5py.File(h5md_file, 'r')
+        self.filename = h5md_file.filename
+        kwargs = dict(kwargs, comm=None, h5md_file=h5md_file)
+        try:
+            super(H5mdPoolTrajectory, self).__init__(**kwargs)
+        finally:
+            # the workers open the file themselves, only its name is kept
+            if opened:
+                h5md_file.close()
+
+    def allocate_buffer(self, shape, name=None):
+        if self.executor == 'thread':
+            return np.zeros(shape)
+        if self.shared_memory is None:
+            self.shared_memory = {}
+        self.shared_memory[name] = shared_memory.SharedMemory(
+            create=True, size=max(int(np.prod(shape)) * 8, 1))
+        buffer = np.ndarray(shape, dtype=np.float64,
+                            buffer=self.shared_memory[name].buf)
+        buffer[...] = 0.
+        return buffer
+
+    def release_buffer(self):
+        """
+        Copy the results out of the shared memory buffers and release them.
+
+        """
+        if self.shared_memory is None:
+            return
+        for name, shm in self.shared_memory.items():
+            self.mpi_buffers[name] = np.array(self.mpi_buffers[name])
+            shm.close()
+            shm.unlink()
+        self.shared_memory = None
+
+    def run(self, *args):
+        if self.schedule == 'dynamic':
+            # idle workers pick up the next task from the executor queue
+            parts = np.array_split(
+                np.arange(len(self.timestep_range)),
+                np.arange(self.task_size, len(self.timestep_range),
+                          self.task_size))
         else:
-            logging.debug("Shape of send buffer: {}.".format(
-                self.mpi_buffer.shape))
-            self.comm.Send(self.mpi_buffer, dest=0, tag=int(self.mpi_rank))
+            parts = np.array_split(np.arange(len(self.timestep_range)),
+                                   self.n_workers)
+        parts = [part for part in parts if len(part)]
+        if self.executor == 'process' and self.shared_memory is None:
+            # communicate released the shared buffers of the last run
+            self.mpi_buffers = {
+                name: self.allocate_buffer(buffer.shape, name)
+                for name, buffer in self.mpi_buffers.items()}
+        if self.executor == 'process':
+            pool = concurrent.futures.ProcessPoolExecutor
+        else:
+            pool = concurrent.futures.ThreadPoolExecutor
+        if self.shared_memory is not None:
+            targets = {name: (self.shared_memory[name].name, buffer.shape)
+                       for name, buffer in self.mpi_buffers.items()}
+        else:
+            targets = self.mpi_buffers
+        read_options = {'folded': self.folded, 'chunk_size': self.chunk_size,
+                        'sort_ids': self.sort_ids, 'prefetch': self.prefetch}
+        self.load = {'frames': len(self.timestep_range), 'tasks': len(parts),
+                     'busy': 0., 'task_times': []}
+        self.start_profiler()
+        self.reducers = self.make_reducers()
+        start = time.perf_counter()
+        with pool(max_workers=self.n_workers) as executor:
+            futures = [executor.submit(_pool_worker, self.filename,
+                                       self.timestep_range[part], part[0],
+                                       targets, self.observables,
+                                       self.transform, args, read_options,
+                                       copy.deepcopy(self.reducers),
+                                       self.new_profiler())
+                       for part in parts]
+            for i, future in enumerate(futures):
+                reducers, profiler = future.result()
+                for name, reducer in reducers.items():
+                    if reducer is not None:
+                        self.reducers[name].merge(reducer)
+                if profiler is not None:
+                    self.profiler.merge(profiler, thread=i)
+        self.load['busy'] = time.perf_counter() - start
+
+    def communicate(self, mode=None):
+        """
+        Collect the results of all workers in `total_result`.
+
+        Parameters:
+        -----------
+        mode : str
+               'gather' (per timestep results) or 'allreduce' (sum over all
+               timesteps) for observables without reducer, which default to
+               'gather'. Observables with a reducer always return the
+               result of the accumulator.
+
+        """
+        start = time.perf_counter()
+        self.release_buffer()
+        results = {}
+        for name in self.names:
+            if self.reducers[name] is not None:
+                results[name] = self.reducers[name].result()
+            elif mode in (None, 'gather'):
+                results[name] = self.mpi_buffers[name]
+            elif mode == 'allreduce':
+                results[name] = self.mpi_buffers[name].sum(axis=0)
+            elif mode == 'reduce':
+                raise ValueError(
+                    "Observable '{}' has no reducer.".format(name))
+            else:
+                raise ValueError(
+                    "Unknown communication mode '{}'.".format(mode))
+        if self.profiler is not None:
+            self.profiler.add_time('comm', time.perf_counter() - start, start)
+        self.total_result = results if isinstance(self.obs, dict) \
+            else results[None]
+
+    def __del__(self):
+        self.release_buffer()
+
+
+def _evaluate(frame, index, observables, transform, args, buffers, reducers,
+              profiler=None):
+    """
+    Evaluate all observables on one frame and store their results at index
+    in buffers or accumulate them in reducers. If profiler is given, the
+    observables and the transform are timed.
+
+    """
+    if profiler is None:
+        if transform is not None:
+            frame = transform(frame)
+        for name, obs in observables.items():
+            if reducers[name] is None:
+                buffers[name][index] = obs(frame, *args)
+            else:
+                reducers[name].update(obs(frame, *args))
+        return
+    if transform is not None:
+        frame = profiler.timed('compute/transform', transform, frame)
+    for name, obs in observables.items():
+        value = profiler.timed(
+            'compute/{}'.format('obs' if name is None else name), obs, frame,
+            *args)
+        if reducers[name] is None:
+            buffers[name][index] = value
+        else:
+            reducers[name].update(value)
+
+
+def _profiled_reads(chunks, profiler, key, frame_bytes):
+    """
+    Pass on the chunks of `kaipy.util.h5md_pos_iter`, timing the reads
+    with the timer key and counting the bytes read.
+
+    """
+    chunks = iter(chunks)
+    while True:
+        start = time.perf_counter()
+        try:
+            ts_chunk, frames = next(chunks)
+        except StopIteration:
+            return
+        profiler.add_time(key, time.perf_counter() - start, start)
+        profiler.add_count('bytes_read', len(ts_chunk) * frame_bytes)
+        profiler.add_count('frames', len(ts_chunk))
+        yield ts_chunk, frames
+
+
+def _frame_bytes(h5md_file, sort_ids, folded):
+    """
+    Number of bytes read from h5md_file per frame.
+
+    """
+    names = ['position']
+    if sort_ids:
+        names.append('id')
+    if not folded:
+        names.append('image')
+    datasets = [h5md_file['particles/atoms/{}/value'.format(name)]
+                for name in names]
+    return sum(dataset.dtype.itemsize * int(np.prod(dataset.shape[1:]))
+               for dataset in datasets)
+
+
+def _pool_worker(filename, timesteps, start, targets, observables, transform,
+                 args, read_options, reducers, profiler=None):
+    """
+    Evaluate the observables on timesteps of an H5MD file in a pool worker.
+
+    The results of observables without reducer are written to targets (a
+    dict of arrays or of the names and shapes of shared memory buffers)
+    from index start on, the others are accumulated in reducers, which are
+    returned together with the profiler.
+
+    """
+    shms = []
+    buffers = {}
+    for name, target in targets.items():
+        if not isinstance(target, np.ndarray):
+            shms.append(shared_memory.SharedMemory(name=target[0]))
+            target = np.ndarray(target[1], dtype=np.float64,
+                                buffer=shms[-1].buf)
+        buffers[name] = target
+    try:
+        with h5py.File(filename, 'r') as h5_fh:
+            chunks = h5md_pos_iter(h5_fh, timesteps, **read_options)
+            if profiler is not None:
+                chunks = _profiled_reads(
+                    chunks, profiler,
+                    'io/wait' if read_options.get('prefetch') else 'io',
+                    _frame_bytes(h5_fh, read_options['sort_ids'],
+                                 read_options['folded']))
+            j = start
+            for _, frames in chunks:
+                for frame in frames:
+                    _evaluate(frame, j, observables, transform, args,
+                              buffers, reducers, profiler)
+                    j += 1
+    finally:
+        # drop all views of the shared memory before closing it
+        buffers.clear()
+        target = None
+        for shm in shms:
+            shm.close()
+    return reducers, profiler
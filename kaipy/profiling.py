@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Module for lightweight timing and counting of parallel trajectory
+evaluations and the summary of the results of all MPI ranks.
+"""
+
+import json
+import time
+import numpy as np
+
+
+class Profiler(object):
+    """
+    Accumulated timers and counters of one rank or worker.
+
+    Times are summed per key, e.g. 'io', 'io/wait', 'comm', 'comm/wait' or
+    'compute/<observable>'. If trace is True, every timed interval is
+    also kept as an event for the Chrome trace format.
+
+    """
+
+    def __init__(self, trace=False):
+        self.trace = trace
+        self.origin = time.perf_counter()
+        self.times = {}
+        self.counts = {}
+        self.events = []
+
+    def synchronize(self, comm=None):
+        """
+        Restart the origin of the event times at the end of a barrier of
+        comm, so that the traces of all ranks share a time axis.
+        Collective for MPI.
+
+        """
+        if comm is not None:
+            comm.Barrier()
+        self.origin = time.perf_counter()
+
+    def add_time(self, key, seconds, start=None, thread=0):
+        """
+        Add seconds to the timer key. start is the perf_counter value at
+        the beginning of the interval, required for trace events.
+
+        """
+        self.times[key] = self.times.get(key, 0.) + seconds
+        if self.trace and start is not None:
+            self.events.append((key, start - self.origin, seconds, thread))
+
+    def add_count(self, key, value):
+        """
+        Add value to the counter key.
+
+        """
+        self.counts[key] = self.counts.get(key, 0) + value
+
+    def timed(self, key, func, *args):
+        """
+        Call func(*args) and add its run time to the timer key.
+
+        """
+        start = time.perf_counter()
+        result = func(*args)
+        self.add_time(key, time.perf_counter() - start, start)
+        return result
+
+    def merge(self, other, thread=0):
+        """
+        Add the timers, counters and events of other, e.g. of a pool
+        worker whose events are assigned to thread.
+
+        """
+        for key, seconds in other.times.items():
+            self.times[key] = self.times.get(key, 0.) + seconds
+        for key, value in other.counts.items():
+            self.add_count(key, value)
+        offset = other.origin - self.origin
+        self.events.extend((key, start + offset, seconds, thread)
+                           for key, start, seconds, _ in other.events)
+
+    def summary(self, comm=None):
+        """
+        Summary of the profilers of all ranks of comm. Collective.
+
+        """
+        totals = dict(('time/' + key, float(seconds))
+                      for key, seconds in self.times.items())
+        totals.update(('count/' + key, int(value))
+                      for key, value in self.counts.items())
+        events = [(key, float(start), float(seconds), int(thread))
+                  for key, start, seconds, thread in self.events]
+        if comm is None:
+            return ProfileSummary([totals], [events])
+        return ProfileSummary(comm.allgather(totals), comm.allgather(events))
+
+
+class ProfileSummary(object):
+    """
+    Timers and counters of all ranks with their statistics over ranks.
+
+    Attributes:
+    -----------
+    ranks : list of dict
+            Totals of every rank, keyed by 'time/<timer>' (seconds) and
+            'count/<counter>'.
+    stats : dict
+            'min', 'mean', 'max' and 'imbalance' (max / mean) over all
+            ranks of every key. Keys missing on a rank count as zero.
+    events : list of list
+             Trace events (key, start, duration, thread) of every rank if
+             tracing was enabled.
+
+    """
+
+    def __init__(self, ranks, events=None):
+        self.ranks = ranks
+        self.events = events or [[] for _ in ranks]
+        self.stats = {}
+        for key in sorted(set().union(*ranks)):
+            values = np.array([rank.get(key, 0) for rank in ranks],
+                              dtype=float)
+            mean = values.mean()
+            self.stats[key] = {
+                'min': float(values.min()), 'mean': float(mean),
+                'max': float(values.max()),
+                'imbalance': float(values.max() / mean) if mean > 0 else 1.}
+
+    def to_dict(self):
+        """
+        Per-rank totals and statistics as a dict.
+
+        """
+        return {'ranks': self.ranks, 'stats': self.stats}
+
+    def to_json(self, filename=None):
+        """
+        JSON representation of `to_dict`, written to filename if given.
+
+        """
+        text = json.dumps(self.to_dict(), indent=2, sort_keys=True)
+        if filename is not None:
+            with open(filename, 'w') as json_file:
+                json_file.write(text)
+        return text
+
+    def to_chrome_trace(self, filename=None):
+        """
+        Trace events of all ranks in the Chrome trace format (viewable in
+        chrome://tracing or Perfetto), with one process per rank and one
+        thread per pool worker. Written to filename if given.
+
+        """
+        trace = {'displayTimeUnit': 'ms', 'traceEvents': [
+            {'name': key, 'cat': key.split('/')[0], 'ph': 'X',
+             'ts': start * 1e6, 'dur': seconds * 1e6, 'pid': rank,
+             'tid': thread}
+            for rank, events in enumerate(self.events)
+            for key, start, seconds, thread in events]}
+        if filename is not None:
+            with open(filename, 'w') as trace_file:
+                json.dump(trace, trace_file)
+        return trace
+
+    def __str__(self):
+        lines = ['{:<32} {:>12} {:>12} {:>12} {:>10}'.format(
+            'key', 'min', 'mean', 'max', 'imbalance')]
+        row = '{:<32} {:>12.6g} {:>12.6g} {:>12.6g} {:>10.3f}'
+        for key, stat in sorted(self.stats.items()):
+            lines.append(row.format(key, stat['min'], stat['mean'],
+                                    stat['max'], stat['imbalance']))
+        return '\n'.join(lines)
@@ -15,27 +15,105 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import abc
+import copy
 import numpy as np
 import math
 
 
+def next_fast_len(n):
+    """
+    Smallest integer of the form 2**a * 3**b * 5**c that is not smaller
+    than n, i.e. a length for which FFTs are fast.
+    """
+    best = 1 << max(int(n) - 1, 0).bit_length()
+    p5 = 1
+    while p5 < best:
+        p35 = p5
+        while p35 < best:
+            quotient = -(-int(n) // p35)
+            best = min(best, p35 << max(quotient - 1, 0).bit_length())
+            p35 *= 3
+        p5 *= 5
+    return best
+
+
 def autocorrelation(data, normalized=True):
     """
     Compute autocorrelation using FFT
+
+    data can be a single series or an array of shape
+    [n_samples, n_observables], whose columns are transformed at once.
     """
+    data = np.asarray(data, dtype=float)
     nobs = len(data)
-    corr_data = data - data.mean()
+    corr_data = data - data.mean(axis=0)
     n = 2**int(math.log(nobs, 2))
     corr_data = corr_data[:n]
-    Frf = np.fft.fft(corr_data)
-    acf = np.fft.ifft(Frf * np.conjugate(Frf))/corr_data.shape[0]
+    Frf = np.fft.rfft(corr_data, axis=0)
+    acf = np.fft.irfft(Frf * np.conjugate(Frf), n=n, axis=0)/n
     if normalized:
         acf /= acf[0]
-    acf = np.real(acf)
     # only return half of the ACF 
     # (see 4.3.1 "Kreuzkorrelationsfunktion" 
     # of https://github.com/arnolda/padc)
-    return acf[:int(corr_data.shape[0]/2)]
+    return acf[:int(n/2)]
+
+
+def correlation(data, other=None, centered=False, normalized=False,
+                dtype=np.float64):
+    """
+    Time correlation function <data(t0 + t) other(t0)> averaged over all
+    time origins t0.
+
+    The correlation is computed with real FFTs that are zero-padded to a
+    fast length of at least 2N-1, so that all N samples are used, nothing
+    wraps around, and every lag t is divided by its number of time
+    origins N-t (unbiased estimate).
+
+    Parameters
+    ----------
+    data : array_like
+        Series of length N or array of shape [N, ...] whose columns are
+        correlated at once.
+    other : array_like, optional
+        Series of the same shape for the cross-correlation. Defaults to
+        data (autocorrelation).
+    centered : bool
+        If True, the mean of every column is subtracted first.
+    normalized : bool
+        If True, the correlation is divided by its value at t = 0.
+    dtype : numpy.dtype
+        Floating point type of the calculation, e.g. numpy.float32 to
+        halve the memory of the transforms. The saving needs numpy>=2;
+        older versions of numpy.fft compute in double precision whatever
+        the input type.
+
+    Returns
+    -------
+    array_like
+        Correlation of the same shape as data.
+    """
+    def prepare(series):
+        series = np.asarray(series, dtype=dtype)
+        if centered:
+            series = series - series.mean(axis=0)
+        return series
+    data = prepare(data)
+    N = len(data)
+    n_fft = next_fast_len(2 * N - 1)
+    F = np.fft.rfft(data, n=n_fft, axis=0)
+    if other is None:
+        spectrum = np.square(F.real) + np.square(F.imag)
+    else:
+        spectrum = F * np.conjugate(np.fft.rfft(prepare(other), n=n_fft,
+                                                axis=0))
+    corr = np.fft.irfft(spectrum, n=n_fft, axis=0)[:N]
+    corr /= (N - np.arange(N, dtype=dtype)).reshape(
+        (N,) + (1,) * (data.ndim - 1))
+    if normalized:
+        corr /= corr[0]
+    return corr
 
 
 def calc_error(data):
@@ -44,24 +122,486 @@ def calc_error(data):
     account that these series are correlated (which
     enhances the estimated statistical error).
     """
+    data_mean, stat_err = calc_error_batch(np.reshape(data, (-1, 1)))
+    return data_mean[0], stat_err[0]
+
+
+def calc_error_batch(data):
+    """
+    Error estimation (see `calc_error`) for all columns of data of shape
+    [n_samples, n_observables] at once.
+
+    Returns
+    -------
+    array_like, array_like
+        Mean values and statistical errors of all observables.
+    """
+    data = np.asarray(data, dtype=float)
     # calculate the normalized autocorrelation function of data
-    acf = autocorrelation(data)
+    # with all samples (only the first half is statistically meaningful)
+    acf = correlation(data, centered=True, normalized=True)[:len(data)//2]
     # calculate the integrated correlation time tau_int
     # (Janke, Wolfhard. "Statistical analysis of simulations: Data correlations
     # and error estimation." Quantum Simulations of Complex Many-Body Systems:
     # From Theory to Algorithms 10 (2002): 423-445.)
-    tau_int = 0.5
-    for i in range(len(acf)):
-        tau_int += acf[i]
-        if i >= 6 * tau_int:
-            break
+    # with the self-consistent window i >= 6 * tau_int for all columns
+    tau_int = 0.5 + np.cumsum(acf, axis=0)
+    window = np.arange(len(acf))[:, np.newaxis] >= 6 * tau_int
+    cutoff = np.where(window.any(axis=0), np.argmax(window, axis=0),
+                      len(acf) - 1)
+    tau_int = tau_int[cutoff, np.arange(data.shape[1])]
     # mean value of the time series
-    data_mean = np.mean(data)
+    data_mean = np.mean(data, axis=0)
     # calculate the so called effective length of the time series N_eff
-    if tau_int > 0.5:
-        N_eff = len(data) / (2.0 * tau_int)
-        # finally the error is sqrt(var(data)/N_eff)
-        stat_err = np.sqrt(np.var(data) / N_eff)
-    else:
-        stat_err = np.sqrt(np.var(data) / len(data))
+    # and finally the error sqrt(var(data)/N_eff)
+    N_eff = np.where(tau_int > 0.5, len(data) / (2.0 * tau_int), len(data))
+    stat_err = np.sqrt(np.var(data, axis=0) / N_eff)
     return data_mean, stat_err
+
+
+class Accumulator(object):
+    """
+    Base class for accumulators that reduce a stream of values (e.g. the
+    results of an observable for every timestep) without storing them.
+    Accumulators of several workers can be combined with `merge` or,
+    across MPI ranks, with `allreduce`.
+    """
+    __metaclass__ = abc.ABCMeta
+
+    @abc.abstractmethod
+    def update(self, value):
+        """
+        Add a value to the accumulator.
+        """
+        pass
+
+    @abc.abstractmethod
+    def merge(self, other):
+        """
+        Add the values accumulated by another accumulator of the same type.
+        """
+        pass
+
+    @abc.abstractmethod
+    def result(self):
+        """
+        Return the accumulated result.
+        """
+        pass
+
+    def allreduce(self, comm):
+        """
+        Merge the accumulators of all ranks of the MPI communicator comm,
+        so that every rank holds the total. Subclasses with array state
+        override this with buffer based collectives.
+        """
+        rank = comm.Get_rank()
+        for i, other in enumerate(comm.allgather(self)):
+            if i != rank:
+                self.merge(other)
+
+
+class SumAccumulator(Accumulator):
+    """
+    Sum of values of a given shape.
+    """
+
+    def __init__(self, shape=()):
+        self.sum = np.zeros(shape)
+        self.count = 0
+
+    def update(self, value):
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other):
+        self.sum += other.sum
+        self.count += other.count
+
+    def allreduce(self, comm):
+        total = np.zeros_like(self.sum)
+        comm.Allreduce(self.sum, total)
+        self.sum = total
+        self.count = comm.allreduce(self.count)
+
+    def result(self):
+        return self.sum
+
+
+class MeanAccumulator(SumAccumulator):
+    """
+    Mean of values of a given shape.
+    """
+
+    def result(self):
+        return self.sum / self.count
+
+
+class VarianceAccumulator(Accumulator):
+    """
+    Mean and variance of values of a given shape with Welford's online
+    algorithm. Partial results are combined with the pairwise update of
+    Chan et al.
+    """
+
+    def __init__(self, shape=(), ddof=0):
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+        self.count = 0
+        self.ddof = ddof
+
+    def update(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def merge(self, other):
+        count = self.count + other.count
+        if count == 0:
+            return
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta**2 * self.count * other.count / count
+        self.count = count
+
+    def allreduce(self, comm):
+        count = comm.allreduce(self.count)
+        if count == 0:
+            return
+        weighted_mean = self.mean * self.count
+        mean = np.zeros_like(weighted_mean)
+        comm.Allreduce(weighted_mean, mean)
+        mean /= count
+        local_m2 = self.m2 + self.count * (self.mean - mean)**2
+        self.m2 = np.zeros_like(local_m2)
+        comm.Allreduce(local_m2, self.m2)
+        self.mean = mean
+        self.count = count
+
+    def result(self):
+        """
+        Returns
+        -------
+        array_like, array_like
+            Mean and variance.
+        """
+        return self.mean, self.m2 / (self.count - self.ddof)
+
+
+class HistogramAccumulator(SumAccumulator):
+    """
+    Histogram of all values with the bins `bins` and `range` (see
+    `np.histogram`).
+    """
+
+    def __init__(self, bins, range=None):
+        # pylint: disable=redefined-builtin
+        _, self.bin_edges = np.histogram([], bins=bins, range=range)
+        super(HistogramAccumulator, self).__init__(len(self.bin_edges) - 1)
+
+    def update(self, value):
+        self.sum += np.histogram(value, bins=self.bin_edges)[0]
+        self.count += 1
+
+
+class BlockingAccumulator(Accumulator):
+    """
+    Blocking (binning) error analysis of a correlated time series after
+    Flyvbjerg and Petersen (J. Chem. Phys. 91, 461 (1989)).
+
+    The values are fed one by one with `update` or in chunks with
+    `extend`. Every level of the blocking transformation keeps the
+    running mean and variance of its blocks and at most one unpaired
+    block, so the memory is O(log N) for N values. The standard error estimate of a level increases with
+    the block size until the blocks are uncorrelated and then stays on
+    a plateau.
+    """
+
+    def __init__(self, shape=(), min_blocks=16):
+        """
+        Parameters
+        ----------
+        shape : tuple
+            Shape of the values.
+        min_blocks : int
+            Minimal number of blocks of a level used for the error.
+        """
+        self.shape = shape
+        self.min_blocks = min_blocks
+        self.count = []
+        self.mean = []
+        self.m2 = []
+        self.pending = []
+
+    def _add(self, level, value):
+        while True:
+            if level == len(self.count):
+                self._new_level()
+            self.count[level] += 1
+            delta = value - self.mean[level]
+            self.mean[level] += delta / self.count[level]
+            self.m2[level] += delta * (value - self.mean[level])
+            if self.pending[level] is None:
+                self.pending[level] = value
+                return
+            value = 0.5 * (self.pending[level] + value)
+            self.pending[level] = None
+            level += 1
+
+    def _new_level(self):
+        self.count.append(0)
+        self.mean.append(np.zeros(self.shape))
+        self.m2.append(np.zeros(self.shape))
+        self.pending.append(None)
+
+    def update(self, value):
+        self._add(0, np.array(value, dtype=float))
+
+    def extend(self, values):
+        """
+        Add consecutive values of shape [n_values] + shape at once.
+        """
+        values = np.asarray(values, dtype=float)
+        level = 0
+        while len(values):
+            if level == len(self.count):
+                self._new_level()
+            count = self.count[level] + len(values)
+            delta = values.mean(axis=0) - self.mean[level]
+            self.m2[level] = self.m2[level] + \
+                np.square(values - values.mean(axis=0)).sum(axis=0) + \
+                delta**2 * self.count[level] * len(values) / count
+            self.mean[level] = self.mean[level] + delta * len(values) / count
+            self.count[level] = count
+            if self.pending[level] is not None:
+                values = np.concatenate((self.pending[level][np.newaxis],
+                                         values))
+            n_pairs = len(values) // 2
+            self.pending[level] = values[-1].copy() if len(values) % 2 \
+                else None
+            values = 0.5 * (values[0:2*n_pairs:2] + values[1:2*n_pairs:2])
+            level += 1
+
+    def merge(self, other):
+        """
+        Add the values of another accumulator. Unpaired blocks of the same
+        level of both accumulators are paired with each other.
+        """
+        for level in range(len(other.count)):
+            if level == len(self.count):
+                self._new_level()
+            count = self.count[level] + other.count[level]
+            if other.count[level] == 0:
+                continue
+            delta = other.mean[level] - self.mean[level]
+            self.mean[level] = self.mean[level] + \
+                delta * other.count[level] / count
+            self.m2[level] = self.m2[level] + other.m2[level] + \
+                delta**2 * self.count[level] * other.count[level] / count
+            self.count[level] = count
+        for level in range(len(other.count)):
+            if other.pending[level] is None:
+                continue
+            if self.pending[level] is None:
+                self.pending[level] = other.pending[level].copy()
+            else:
+                value = 0.5 * (self.pending[level] + other.pending[level])
+                self.pending[level] = None
+                self._add(level + 1, value)
+
+    def allreduce(self, comm):
+        """
+        Merge the accumulators of all ranks in rank order, so that the
+        unpaired blocks are paired alike and every rank holds the same
+        total.
+        """
+        accumulators = comm.allgather(self)
+        total = copy.deepcopy(accumulators[0])
+        for other in accumulators[1:]:
+            total.merge(other)
+        self.__dict__.update(total.__dict__)
+
+    def levels(self):
+        """
+        Standard error estimates of all levels with at least two blocks.
+
+        Returns
+        -------
+        array_like, array_like, array_like
+            Number of blocks, standard error and error of the standard
+            error of every level.
+        """
+        n_blocks = np.array([n for n in self.count if n > 1])
+        n = n_blocks.reshape((-1,) + (1,) * len(self.shape)).astype(float)
+        variance = np.array(self.m2[:len(n_blocks)]) / n
+        stat_err = np.sqrt(variance / (n - 1))
+        return n_blocks, stat_err, stat_err / np.sqrt(2 * (n - 1))
+
+    def result(self):
+        """
+        Returns
+        -------
+        array_like, array_like
+            Mean and standard error at the first level whose successor
+            agrees with it within its error bar (the plateau). Without
+            a plateau the last usable level is taken, the error is NaN
+            if no level has two blocks.
+        """
+        n_blocks, stat_err, err_err = self.levels()
+        if len(n_blocks) == 0:
+            mean = self.mean[0] if self.count and self.count[0] \
+                else np.full(self.shape, np.nan)
+            return mean, np.full(self.shape, np.nan)
+        usable = max(np.count_nonzero(n_blocks >= self.min_blocks), 1)
+        if usable == 1:
+            return self.mean[0], stat_err[0]
+        stat_err = stat_err[:usable]
+        err_err = err_err[:usable]
+        plateau = stat_err[1:] <= stat_err[:-1] + err_err[:-1]
+        level = np.where(plateau.any(axis=0), np.argmax(plateau, axis=0),
+                         usable - 1)
+        return self.mean[0], np.take_along_axis(
+            stat_err, np.expand_dims(level, 0), axis=0)[0]
+
+
+class MultipleTauCorrelator(Accumulator):
+    """
+    Multiple-tau correlator for time correlation functions on the fly
+    (Ramirez et al., J. Chem. Phys. 133, 154103 (2010)).
+
+    Values are pushed one time step at a time. Level 0 keeps the last
+    `n_points` values and correlates every new value with all of them.
+    Every `averaging` values of a level are averaged and pushed to the
+    next level, which only correlates the lags not covered by the level
+    below. The lags are thus spaced logarithmically and the memory does
+    not depend on the length of the time series.
+    """
+
+    def __init__(self, shape=(), mode='product', cross=False, n_points=16,
+                 averaging=2, n_levels=24, axes=None):
+        """
+        Parameters
+        ----------
+        shape : tuple
+            Shape of the values.
+        mode : str
+            'product' for <a(t0 + t) b(t0)> (auto- and cross-correlation,
+            e.g. of Rouse modes) or 'msd' for <(a(t0 + t) - b(t0))**2>
+            (mean square displacement of unfolded positions).
+        cross : bool
+            If True, two values a and b are pushed at every time step.
+            Otherwise b is a.
+        n_points : int
+            Number of lags per level. Must be a multiple of averaging.
+        averaging : int
+            Number of values that are averaged for the next level.
+        n_levels : int
+            Number of levels. The largest lag is
+            (n_points - 1) * averaging**(n_levels - 1).
+        axes : tuple, optional
+            Axes of the values over which the correlation is averaged on
+            the fly, e.g. the particle axis.
+        """
+        if mode not in ('product', 'msd'):
+            raise ValueError("Unknown correlation mode '{}'.".format(mode))
+        if n_points % averaging:
+            raise ValueError("n_points must be a multiple of averaging.")
+        self.shape = tuple(shape)
+        self.mode = mode
+        self.n_points = n_points
+        self.averaging = averaging
+        self.n_levels = n_levels
+        self.axes = tuple(axis + 1 for axis in axes) if axes else None
+        corr_shape = tuple(n for i, n in enumerate(self.shape)
+                           if not axes or i not in axes)
+        self.buffer = [np.zeros((n_levels, n_points) + self.shape)]
+        self.block_sum = [np.zeros((n_levels,) + self.shape)]
+        if cross:
+            self.buffer.append(np.zeros((n_levels, n_points) + self.shape))
+            self.block_sum.append(np.zeros((n_levels,) + self.shape))
+        self.n_values = np.zeros(n_levels, dtype=int)
+        self.corr = np.zeros((n_levels, n_points) + corr_shape)
+        self.count = np.zeros((n_levels, n_points), dtype=int)
+
+    def push(self, a, b=None):
+        """
+        Add the value(s) of the next time step.
+        """
+        values = [a] if b is None else [a, b]
+        self._add(0, [np.asarray(value, dtype=float) for value in values])
+
+    def update(self, value):
+        if len(self.buffer) == 2:
+            self.push(*value)
+        else:
+            self.push(value)
+
+    def _add(self, level, values):
+        head = self.n_values[level] % self.n_points
+        for buffer, value in zip(self.buffer, values):
+            buffer[level, head] = value
+        self.n_values[level] += 1
+        start = 0 if level == 0 else self.n_points // self.averaging
+        stop = min(self.n_values[level], self.n_points)
+        if stop > start:
+            older = self.buffer[-1][level,
+                                    (head - np.arange(start, stop)) %
+                                    self.n_points]
+            if self.mode == 'product':
+                corr = values[0] * older
+            else:
+                corr = np.square(values[0] - older)
+            if self.axes:
+                corr = corr.mean(axis=self.axes)
+            self.corr[level, start:stop] += corr
+            self.count[level, start:stop] += 1
+        if level + 1 == self.n_levels:
+            return
+        for block_sum, value in zip(self.block_sum, values):
+            block_sum[level] += value
+        if self.n_values[level] % self.averaging == 0:
+            averages = [block_sum[level] / self.averaging
+                        for block_sum in self.block_sum]
+            for block_sum in self.block_sum:
+                block_sum[level] = 0.
+            self._add(level + 1, averages)
+
+    def merge(self, other):
+        """
+        Add the correlations of another correlator with the same parameters
+        (e.g. of another part of the trajectory or other particles).
+        """
+        self.corr += other.corr
+        self.count += other.count
+
+    def allreduce(self, comm):
+        corr = np.zeros_like(self.corr)
+        comm.Allreduce(self.corr, corr)
+        count = np.zeros_like(self.count)
+        comm.Allreduce(self.count, count)
+        self.corr = corr
+        self.count = count
+
+    def result(self):
+        """
+        Returns
+        -------
+        array_like, array_like
+            Lags in units of time steps and the correlation function.
+        """
+        lags = np.concatenate(
+            [np.arange(0 if level == 0 else self.n_points // self.averaging,
+                       self.n_points) * self.averaging**level
+             for level in range(self.n_levels)])
+        corr = np.concatenate(
+            [self.corr[level, 0 if level == 0 else
+                       self.n_points // self.averaging:]
+             for level in range(self.n_levels)])
+        count = np.concatenate(
+            [self.count[level, 0 if level == 0 else
+                        self.n_points // self.averaging:]
+             for level in range(self.n_levels)])
+        valid = count > 0
+        count = count.reshape(count.shape + (1,) * (corr.ndim - 1))
+        return lags[valid], (corr / np.maximum(count, 1))[valid]
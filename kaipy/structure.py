@@ -0,0 +1,234 @@
+# This file is part of kaipy.
+# Copyright (C) 2017  Kai Szuttor
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from kaipy.statistic import next_fast_len
+
+
+def structure_factor(h5md_pos, box, q_max, dq=None, h5md_species=None,
+                     species_1=None, species_2=None, method='direct',
+                     mesh=None, block_size=1024):
+    """ Static structure factor.
+
+    Calculates the static structure factor
+
+        S_ab(q) = < Re(rho_a(q) rho_b(q)*) > / sqrt(N_a N_b),
+        rho_a(q) = sum_j exp(-i q r_j),
+
+    for all wave vectors q compatible with the periodic box, i.e.
+    q = 2 pi n H^-T for integer vectors n and the box matrix H, and
+    averages it over spherical shells of width `dq`. Only one of each
+    pair q, -q is evaluated since S(q) = S(-q).
+
+    Parameters
+    ----------
+    h5md_pos: array_like
+        Positions [timesteps, particles, xyz] (e.g. from
+        `kaipy.util.h5md_pos`) or of a single frame [particles, xyz].
+    box: float or array_like
+        Edge length of a cubic box, per-axis edge lengths of an
+        orthorhombic box or the edge vectors of a triclinic box as rows
+        of a [3, 3] matrix (see `kaipy.util.h5md_box`).
+    q_max: float
+        Largest wave vector magnitude.
+    dq: float
+        Width of the shells. Defaults to the smallest wave vector
+        magnitude along the box vectors.
+    h5md_species: array_like
+        Species of every particle. Required if `species_1` is given.
+    species_1: int
+        Species a of the partial structure factor. Defaults to all
+        particles.
+    species_2: int
+        Species b of the partial structure factor. Defaults to
+        `species_1`.
+    method: str
+        'direct' sums the complex exponentials of all particles exactly,
+        'fft' assigns the particles to a mesh (cloud in cell) and uses
+        a fast Fourier transform, which is much faster for many
+        particles and wave vectors but approximate close to the
+        Nyquist wave vector of the mesh.
+    mesh: int or array_like
+        Mesh points per box vector for method 'fft'. Defaults to four
+        times the largest index of a wave vector along each box vector.
+    block_size: int
+        Number of particles treated at once by method 'direct'.
+
+    Returns
+    -------
+    array_like, array_like
+        Mean wave vector magnitude and structure factor of all non-empty
+        shells.
+    """
+    box = _box_matrix(box)
+    inv_box = np.linalg.inv(box)
+    # |n_k| = |q a_k| / (2 pi) is bounded by q_max |a_k| / (2 pi)
+    n_max = np.floor(q_max * np.linalg.norm(box, axis=1)
+                     / (2. * np.pi)).astype(int)
+    n = [np.arange(-n_max[0], n_max[0] + 1),
+         np.arange(-n_max[1], n_max[1] + 1),
+         np.arange(0, n_max[2] + 1)]
+    grid = np.stack(np.meshgrid(*n, indexing='ij'), axis=-1)
+    q_norm = np.linalg.norm(2. * np.pi * np.dot(grid, inv_box.T), axis=-1)
+    # half space: drop n = 0 and the vectors -n of the plane n_z = 0
+    half = (grid[..., 2] > 0) | (grid[..., 1] > 0) | \
+        ((grid[..., 1] == 0) & (grid[..., 0] > 0))
+    selected = half & (q_norm <= q_max)
+    if dq is None:
+        dq = np.min(2. * np.pi * np.linalg.norm(inv_box, axis=0))
+    shells = np.floor(q_norm[selected] / dq).astype(np.intp)
+
+    if h5md_species is None or species_1 is None:
+        masks = [None, None]
+        same_species = True
+    else:
+        h5md_species = np.asarray(h5md_species[:])
+        if species_2 is None:
+            species_2 = species_1
+        masks = [h5md_species == species_1, h5md_species == species_2]
+        same_species = species_1 == species_2
+    if np.ndim(h5md_pos) == 2:
+        h5md_pos = [h5md_pos]
+    if method == 'fft':
+        if mesh is None:
+            mesh = [next_fast_len(4 * m + 2) for m in n_max]
+        mesh = np.broadcast_to(np.asarray(mesh, dtype=int), (3,))
+        if np.any(2 * n_max >= mesh):
+            raise ValueError("mesh is too coarse for q_max")
+        # Fourier transform of the cloud in cell assignment
+        window = np.ones(grid.shape[:-1])
+        for k in range(3):
+            shape = [1, 1, 1]
+            shape[k] = -1
+            window = window * np.reshape(np.sinc(n[k] / float(mesh[k]))**2,
+                                         shape)
+        window = window[selected]
+    elif method != 'direct':
+        raise ValueError("Unknown method '{}'.".format(method))
+
+    s_sum = np.zeros(np.count_nonzero(selected))
+    n_frames = 0
+    for frame in h5md_pos:
+        frame = np.asarray(frame, dtype=float)
+        rho = []
+        n_particles = []
+        for k, mask in enumerate(masks):
+            if k == 1 and same_species:
+                rho.append(rho[0])
+                n_particles.append(n_particles[0])
+                break
+            pos = frame if mask is None else frame[mask]
+            frac = np.dot(pos, inv_box)
+            if method == 'direct':
+                rho.append(_density_modes(frac, n, block_size)[selected])
+            else:
+                rho.append(_mesh_modes(frac, n, mesh)[selected] / window)
+            n_particles.append(len(pos))
+        s_sum += np.real(rho[0] * np.conj(rho[1])) / np.sqrt(
+            n_particles[0] * n_particles[1])
+        n_frames += 1
+    counts = np.bincount(shells)
+    nonempty = counts > 0
+    q_mean = np.bincount(shells, weights=q_norm[selected])[nonempty] \
+        / counts[nonempty]
+    s_q = np.bincount(shells, weights=s_sum)[nonempty] \
+        / (counts[nonempty] * n_frames)
+    return q_mean, s_q
+
+
+def form_factor(x, q, block_size=4096):
+    """ Single chain form factor.
+
+    Calculates the isotropically averaged form factor of a polymer with
+    the Debye formula
+
+        P(q) = 1/N^2 sum_ij sin(q r_ij) / (q r_ij).
+
+    Leading dimensions of x (e.g. frames or chains) are averaged over.
+
+    Parameters
+    ----------
+    x : array_like
+        Unfolded coordinates of shape [..., number of beads, 3].
+    q : array_like
+        Wave vector magnitudes.
+    block_size: int
+        Number of bead pairs treated at once.
+
+    Returns
+    -------
+    array_like
+        Form factor for every q.
+    """
+    x = np.asarray(x, dtype=float)
+    q = np.asarray(q, dtype=float)
+    n_beads = x.shape[-2]
+    x = np.reshape(x, (-1, n_beads, 3))
+    i, j = np.triu_indices(n_beads, k=1)
+    result = np.zeros(q.shape)
+    for start in range(0, len(i), block_size):
+        dist = np.linalg.norm(x[:, j[start:start+block_size]] -
+                              x[:, i[start:start+block_size]], axis=-1)
+        # np.sinc(x) = sin(pi x) / (pi x)
+        result += np.sinc(np.multiply.outer(dist, q) / np.pi).sum(
+            axis=(0, 1))
+    return (n_beads + 2. * result / len(x)) / n_beads**2
+
+
+def _box_matrix(box):
+    """ Box vectors as rows of a [3, 3] matrix. """
+    box = np.asarray(box, dtype=float)
+    if box.ndim == 2:
+        return box
+    return np.diag(np.broadcast_to(box, (3,)))
+
+
+def _density_modes(frac, n, block_size):
+    """ Fourier modes of the density on the wave vector grid n.
+
+    The exponentials are factorised along the box vectors, so that only
+    the phases exp(-2 pi i n_k s_k) of the fractional coordinates s are
+    evaluated and combined for all wave vectors of a block of particles.
+    """
+    rho = np.zeros((len(n[0]) * len(n[1]), len(n[2])), dtype=complex)
+    for start in range(0, len(frac), block_size):
+        block = frac[start:start+block_size]
+        phase_x, phase_y, phase_z = [
+            np.exp(-2j * np.pi * np.multiply.outer(block[:, k], n[k]))
+            for k in range(3)]
+        phase_xy = (phase_x[:, :, np.newaxis] * phase_y[:, np.newaxis, :])
+        # the sum over particles is a matrix product
+        rho += np.dot(phase_xy.reshape(len(block), -1).T, phase_z)
+    return rho.reshape(tuple(len(n_k) for n_k in n))
+
+
+def _mesh_modes(frac, n, mesh):
+    """ Fourier modes of the density assigned to a mesh.
+
+    The particles are assigned with the cloud in cell scheme and the
+    modes of the wave vector grid n are taken from the FFT of the mesh.
+    """
+    scaled = frac * mesh
+    lower = np.floor(scaled).astype(np.intp)
+    weight = scaled - lower
+    density = np.zeros(np.prod(mesh))
+    for corner in np.ndindex(2, 2, 2):
+        corner = np.array(corner)
+        w = np.prod(np.where(corner, weight, 1. - weight), axis=-1)
+        index = np.ravel_multi_index(((lower + corner) % mesh).T, mesh)
+        density += np.bincount(index, weights=w, minlength=len(density))
+    modes = np.fft.fftn(density.reshape(mesh))
+    return modes[np.ix_(n[0] % mesh[0], n[1] % mesh[1], n[2] % mesh[2])]
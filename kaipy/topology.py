@@ -0,0 +1,232 @@
+# This file is part of kaipy.
+# Copyright (C) 2017  Kai Szuttor
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+
+
+class ChainTopology(object):
+    """
+    Layout of linear chains of consecutive particles, e.g. the polymers
+    of a melt. Per-chain observables of all chains are evaluated at once
+    with segment reductions (see `ChainObservables`).
+
+    Parameters
+    ----------
+    lengths : array_like
+        Number of particles of every chain. The chains occupy consecutive
+        ranges of particles in order.
+    mass : array_like, optional
+        Mass of every particle. Center of mass and gyration tensor are
+        mass weighted if given.
+
+    """
+
+    def __init__(self, lengths, mass=None):
+        self.lengths = np.asarray(lengths, dtype=np.intp)
+        if self.lengths.ndim != 1 or np.any(self.lengths < 1):
+            raise ValueError("Chain lengths have to be positive integers.")
+        self.offsets = np.cumsum(self.lengths) - self.lengths
+        self.n_chains = len(self.lengths)
+        self.n_particles = int(self.lengths.sum())
+        self.mass = None
+        if mass is not None:
+            self.mass = np.asarray(mass, dtype=float)
+            if self.mass.shape != (self.n_particles,):
+                raise ValueError("Expected {} masses, got shape {}.".format(
+                    self.n_particles, self.mass.shape))
+            self.chain_mass = np.add.reduceat(self.mass, self.offsets)
+
+    @classmethod
+    def regular(cls, n_chains, chain_length, mass=None):
+        """
+        Topology of n_chains chains of equal length.
+
+        """
+        return cls(np.full(n_chains, chain_length, dtype=np.intp), mass)
+
+    @classmethod
+    def from_h5md(cls, h5_dh, group='atoms', mass=None):
+        """
+        Topology from the bonds in H5MD `connectivity/<group>`.
+
+        The bonds are pairs of particle ids, which are mapped to the
+        positions sorted by id (see `kaipy.util.h5md_pos`). Particles
+        without bonds form chains of length one.
+
+        Parameters
+        ----------
+        h5_dh : h5py file handle
+        group : str
+                Name of the particle group.
+        mass : array_like, optional
+               Mass of every particle.
+
+        """
+        ids = np.unique(h5_dh["particles/{}/id/value".format(group)][0])
+        bonds = np.asarray(h5_dh["connectivity/{}".format(group)][:])
+        return cls.from_bonds(np.searchsorted(ids, bonds), len(ids), mass)
+
+    @classmethod
+    def from_bonds(cls, bonds, n_particles, mass=None):
+        """
+        Topology from bonds between particle indices.
+
+        Parameters
+        ----------
+        bonds : array_like
+                Array of shape [n_bonds, 2] of bonded particle indices.
+                Only bonds between consecutive particles are allowed.
+        n_particles : int
+                      Total number of particles.
+        mass : array_like, optional
+               Mass of every particle.
+
+        """
+        bonds = np.reshape(np.asarray(bonds, dtype=np.intp), (-1, 2))
+        if np.any(np.abs(bonds[:, 0] - bonds[:, 1]) != 1):
+            raise ValueError(
+                "Only linear chains of consecutive particles are supported.")
+        # particle i continues the chain of particle i - 1
+        bonded = np.zeros(n_particles, dtype=bool)
+        bonded[bonds.max(axis=1)] = True
+        starts = np.flatnonzero(~bonded)
+        return cls(np.diff(np.append(starts, n_particles)), mass)
+
+    def chain_index(self):
+        """
+        Index of the chain of every particle.
+
+        """
+        return np.repeat(np.arange(self.n_chains), self.lengths)
+
+    def reduce(self, values):
+        """
+        Sum of values over the particles of every chain.
+
+        Parameters
+        ----------
+        values : array_like
+                 Array of shape [..., n_particles, k].
+
+        Returns
+        -------
+        array_like
+            Array of shape [..., n_chains, k].
+
+        """
+        return np.add.reduceat(values, self.offsets, axis=-2)
+
+    def observables(self, x):
+        """
+        Per-chain observables of positions x, see `ChainObservables`.
+
+        """
+        return ChainObservables(self, x)
+
+
+class ChainObservables(object):
+    """
+    Per-chain observables of all chains of one or several frames.
+
+    Intermediate results (center of mass and positions relative to it)
+    are computed once and shared by all observables.
+
+    Parameters
+    ----------
+    topology : ChainTopology
+    x : array_like
+        Unfolded positions of shape [..., n_particles, 3], where leading
+        dimensions (e.g. frames) are evaluated at once.
+
+    """
+
+    def __init__(self, topology, x):
+        self.topology = topology
+        self.x = np.asarray(x, dtype=float)
+        if self.x.shape[-2] != topology.n_particles:
+            raise ValueError("Expected {} particles, got {}.".format(
+                topology.n_particles, self.x.shape[-2]))
+        self._com = None
+        self._relative = None
+
+    def _weighted_mean(self, values):
+        """ Mean of per-particle values over every chain. """
+        topology = self.topology
+        if topology.mass is None:
+            return topology.reduce(values) / topology.lengths[:, np.newaxis]
+        return topology.reduce(values * topology.mass[:, np.newaxis]) \
+            / topology.chain_mass[:, np.newaxis]
+
+    def center_of_mass(self):
+        """
+        Centers of mass of shape [..., n_chains, 3].
+
+        """
+        if self._com is None:
+            self._com = self._weighted_mean(self.x)
+        return self._com
+
+    def relative_positions(self):
+        """
+        Positions relative to the center of mass of their chain.
+
+        """
+        if self._relative is None:
+            self._relative = self.x - np.repeat(
+                self.center_of_mass(), self.topology.lengths, axis=-2)
+        return self._relative
+
+    def rg2_compwise(self):
+        """
+        Componentwise squared radii of gyration of shape [..., n_chains, 3].
+
+        """
+        return self._weighted_mean(np.square(self.relative_positions()))
+
+    def rg2(self):
+        """
+        Squared radii of gyration of shape [..., n_chains].
+
+        """
+        return self.rg2_compwise().sum(axis=-1)
+
+    def gyration_tensor(self):
+        """
+        Gyration tensors of shape [..., n_chains, 3, 3].
+
+        """
+        relative = self.relative_positions()
+        products = relative[..., :, np.newaxis] * \
+            relative[..., np.newaxis, :]
+        shape = products.shape[:-2] + (9,)
+        tensor = self._weighted_mean(products.reshape(shape))
+        return tensor.reshape(tensor.shape[:-1] + (3, 3))
+
+    def end_to_end_vector(self):
+        """
+        End to end vectors of shape [..., n_chains, 3].
+
+        """
+        first = self.topology.offsets
+        last = first + self.topology.lengths - 1
+        return self.x[..., last, :] - self.x[..., first, :]
+
+    def end_to_end_distance(self):
+        """
+        End to end distances of shape [..., n_chains].
+
+        """
+        return np.linalg.norm(self.end_to_end_vector(), axis=-1)
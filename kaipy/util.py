@@ -1,5 +1,11 @@
+import queue
+import threading
+import h5py
 import numpy as np
 
+# read size for datasets without chunk layout
+CONTIGUOUS_READ_BYTES = 2**24
+
 
 def h5md_pos(h5_dh, ts=None, folded=True):
     """ Sorted position from H5MD file.
@@ -14,33 +20,512 @@ def h5md_pos(h5_dh, ts=None, folded=True):
         Timestep (range) for which the coordinates should be returned.
     """
     if isinstance(ts, np.ndarray) or isinstance(ts, list) or ts is None:
+        pos_ds = h5_dh["particles/atoms/position/value"]
         if ts is None:
-            h5_pos = h5_dh["particles/atoms/position/value"][:, :, :]
-            h5_id = h5_dh["particles/atoms/id/value"][:, :, :]
-            h5_image = h5_dh["particles/atoms/image/value"][:, :, :]
+            ts = np.arange(pos_ds.shape[0])
         else:
-            h5_pos = h5_dh["particles/atoms/position/value"][np.min(ts):np.max(ts)+1, :, :]
-            h5_id = h5_dh["particles/atoms/id/value"][np.min(ts):np.max(ts)+1, :, :]
-            h5_image = h5_dh["particles/atoms/image/value"][np.min(ts):np.max(ts)+1, :, :]
-        # number of timesteps: n_ts
-        n_ts = h5_pos.shape[0]
-        result = np.zeros(h5_pos.shape)
-        for i in range(n_ts):
-            sorted_pos = h5_pos[i, np.argsort(h5_id[i,:,:].flatten()), :]
-            if not folded:
-                h5_box = h5_dh["particles/atoms/box/edges"]
-                sorted_image = h5_image[i, np.argsort(h5_id[i,:,:].flatten()), :]
-                sorted_pos += sorted_image * h5_box[:]
-            result[i, :, :] = sorted_pos
+            ts = np.arange(np.min(ts), np.max(ts)+1)
+        # fill the result chunk by chunk instead of loading whole datasets
+        result = np.zeros((len(ts),) + pos_ds.shape[1:])
+        for ts_chunk, sorted_pos in h5md_pos_iter(h5_dh, ts, folded=folded):
+            result[ts_chunk - ts[0]] = sorted_pos
         return result
     else:
-        h5_pos = h5_dh["particles/atoms/position/value"][ts, :, :]
-        h5_id = h5_dh["particles/atoms/id/value"][ts, :, :]
-        h5_image = h5_dh["particles/atoms/image/value"][ts, :, :]
-        id_flat = h5_id.ravel()
-        sorted_pos = h5_pos[np.argsort(id_flat), :]
-        if not folded:
-            h5_box = h5_dh["particles/atoms/box/edges"]
-            sorted_image = h5_image[np.argsort(id_flat)]
-            sorted_pos += sorted_image * h5_box[:]
-        return sorted_pos
+        n_frames = h5_dh["particles/atoms/position/value"].shape[0]
+        if not -n_frames <= ts < n_frames:
+            raise IndexError("timestep {} is out of range for {} "
+                             "frames".format(ts, n_frames))
+        # negative timesteps count from the end as for a plain index
+        ts = int(ts) % n_frames
+        sel = slice(ts, ts + 1)
+        h5_pos = h5_dh["particles/atoms/position/value"][sel]
+        h5_id = h5_dh["particles/atoms/id/value"][sel]
+        h5_image = h5_dh["particles/atoms/image/value"][sel] \
+            if not folded else None
+        box = h5md_box(h5_dh, ts) if not folded else None
+        return _sort_frames(h5_pos, h5_id, h5_image, box)[0]
+
+
+def h5md_box(h5_dh, ts=None):
+    """ Simulation box edges from H5MD file.
+
+    Reads `particles/atoms/box/edges`, which is either a dataset for a
+    fixed box or a time-dependent group with a `value` dataset.
+
+    Parameters
+    ----------
+    h5_dh: h5py file handle
+    ts: int or array like
+        Timestep(s) for which the edges of a time-dependent box should
+        be returned. Ignored for a fixed box.
+
+    Returns
+    -------
+    array_like
+        Edge lengths of shape [3] for an orthorhombic box or the edge
+        vectors as rows of a [3, 3] matrix for a triclinic box, with a
+        leading timestep dimension if `ts` is an array for a
+        time-dependent box.
+    """
+    edges = h5_dh["particles/atoms/box/edges"]
+    # a fixed box is a plain dataset, a time-dependent one a group
+    if not hasattr(edges, "keys"):
+        return np.asarray(edges[()], dtype=float)
+    if ts is None:
+        raise ValueError(
+            "the box is time-dependent, a timestep has to be given")
+    if np.ndim(ts) == 0:
+        return np.asarray(edges["value"][int(ts)], dtype=float)
+    return np.asarray(edges["value"][
+        _frame_selection(np.asarray(ts, dtype=int).ravel())], dtype=float)
+
+
+def h5md_pos_iter(h5_dh, ts=None, folded=True, chunk_size=None,
+                  sort_ids=True, collective=False, n_reads=None, prefetch=0):
+    """ Sorted positions from H5MD file in chunks of timesteps.
+
+    Generator version of `h5md_pos`. The timesteps `ts` are read in
+    chunks of at most `chunk_size` timesteps that are aligned with the
+    chunk layout of the position dataset, so that the memory consumption
+    is bounded by the chunk size and not by the length of the trajectory.
+    Strided timesteps are read as strided hyperslabs.
+
+    Parameters
+    ----------
+    h5_dh: h5py file handle
+    ts: array like
+        Increasing timesteps for which the coordinates should be returned.
+        Defaults to all timesteps.
+    folded: bool
+        If False, the positions are unfolded with the image dataset.
+    chunk_size: int
+        Maximum number of timesteps per chunk. Rounded up to a multiple
+        of the chunk shape of the position dataset. Defaults to the
+        chunk shape of the dataset.
+    sort_ids: bool
+        If False, the positions are returned in the order of the file and
+        the id dataset is not read.
+    collective: bool
+        Read collectively, which requires a file opened with the `mpio`
+        driver. All ranks of the communicator of the file have to iterate
+        over all chunks.
+    n_reads: int
+        Number of collective reads of the rank with the most reads (see
+        `h5md_read_count`). Ranks with fewer reads issue empty reads after
+        their last chunk, so that the collective calls of all ranks match.
+    prefetch: int
+        Number of preallocated chunk buffers that are read ahead on a
+        background thread, so that reading overlaps with the processing
+        of the previous chunk (at least 2 for double buffering). The
+        yielded positions may share memory with a buffer and are only
+        valid until the next iteration. 0 reads in the calling thread.
+        Collective reads from the background thread require MPI
+        initialised with `MPI_THREAD_MULTIPLE`.
+
+    Yields
+    ------
+    array_like, array_like
+        Timesteps of the chunk and the positions of shape
+        [timesteps, particles, xyz].
+    """
+    if collective and prefetch:
+        from mpi4py import MPI
+        if MPI.Query_thread() != MPI.THREAD_MULTIPLE:
+            raise ValueError("Collective reads with prefetching require MPI "
+                             "initialised with MPI_THREAD_MULTIPLE.")
+    pos_ds = h5_dh["particles/atoms/position/value"]
+    if ts is None:
+        ts = np.arange(pos_ds.shape[0])
+    ts = np.asarray(ts, dtype=int).ravel()
+    chunk_size = _chunk_frames(pos_ds, chunk_size)
+    datasets = [pos_ds]
+    if sort_ids:
+        datasets.append(h5_dh["particles/atoms/id/value"])
+    if not folded:
+        datasets.append(h5_dh["particles/atoms/image/value"])
+    box = _box_edges(h5_dh) if not folded else None
+    read_args = (datasets, ts, chunk_size, box, sort_ids, collective, n_reads)
+    if prefetch:
+        return _prefetch_frames(read_args, prefetch)
+    return ((ts_chunk, frames) for ts_chunk, frames, _ in
+            _read_frames(*read_args))
+
+
+def _read_frames(datasets, ts, chunk_size, box, sort_ids, collective=False,
+                 n_reads=None, buffers=None):
+    """ Read, sort and unfold the frames of `h5md_pos_iter`.
+
+    `box` is a fixed box or the edges dataset of a time-dependent box
+    (see `_box_edges`), of which the frames of every chunk are read.
+
+    If `buffers` is given, every chunk is read into a set of preallocated
+    arrays taken from it with `buffers.get()`. The set is yielded along
+    with the frames and has to be returned by the caller once the frames
+    are no longer used. A None taken from `buffers` stops the reads.
+    """
+    reads = _split_frames(ts, chunk_size)
+    for ts_chunk in reads:
+        sel = _frame_selection(ts_chunk)
+        buffer = None
+        if buffers is None:
+            data = [_read(dataset, sel, collective) for dataset in datasets]
+        else:
+            buffer = buffers.get()
+            if buffer is None:
+                return
+            data = [_read(dataset, sel, collective, out=out[:len(ts_chunk)])
+                    for dataset, out in zip(datasets, buffer)]
+        h5_id = data[1] if sort_ids else None
+        h5_image = data[-1] if box is not None else None
+        chunk_box = _frames_box(box, sel, collective) \
+            if isinstance(box, h5py.Dataset) else box
+        yield (ts_chunk, _sort_frames(data[0], h5_id, h5_image, chunk_box),
+               buffer)
+    # match the collective reads of ranks with more reads
+    if collective and n_reads is not None:
+        if isinstance(box, h5py.Dataset):
+            datasets = datasets + [box]
+        for _ in range(n_reads - len(reads)):
+            for dataset in datasets:
+                _empty_read(dataset)
+
+
+def _prefetch_frames(read_args, depth):
+    """ Generator of `_read_frames` reading ahead on a background thread.
+
+    `depth` sets of arrays for one chunk of every dataset are allocated
+    once and cycled between the reading thread and the caller, so that
+    with two or more sets the next chunk is read while the caller works
+    on the current one.
+    """
+    datasets, chunk_size = read_args[0], read_args[2]
+    free = queue.Queue()
+    for _ in range(depth):
+        free.put([np.empty((chunk_size,) + dataset.shape[1:],
+                           dtype=float if i == 0 else dataset.dtype)
+                  for i, dataset in enumerate(datasets)])
+    filled = queue.Queue()
+
+    def produce():
+        try:
+            for item in _read_frames(*read_args, buffers=free):
+                filled.put(item)
+            filled.put(None)
+        except Exception as error:  # pylint: disable=broad-except
+            filled.put(error)
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    in_use = None
+    try:
+        while True:
+            # the frames of the previous chunk are no longer used
+            if in_use is not None:
+                free.put(in_use)
+                in_use = None
+            item = filled.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            ts_chunk, frames, in_use = item
+            yield ts_chunk, frames
+    finally:
+        # wakes up the reading thread if the caller stops early
+        free.put(None)
+        thread.join()
+
+
+def h5md_read_count(h5_dh, ts=None, chunk_size=None):
+    """ Number of reads of `h5md_pos_iter` for timesteps `ts`.
+
+    Parameters
+    ----------
+    h5_dh: h5py file handle
+    ts: array like
+        Increasing timesteps. Defaults to all timesteps.
+    chunk_size: int
+        Maximum number of timesteps per chunk (see `h5md_pos_iter`).
+
+    Returns
+    -------
+    int
+    """
+    pos_ds = h5_dh["particles/atoms/position/value"]
+    if ts is None:
+        ts = np.arange(pos_ds.shape[0])
+    ts = np.asarray(ts, dtype=int).ravel()
+    return len(_split_frames(ts, _chunk_frames(pos_ds, chunk_size)))
+
+
+def h5md_pos_particle_blocks(h5_dh, ts=None, folded=True, block_size=1024,
+                             chunk_size=None):
+    """ Sorted positions from H5MD file in blocks of particles.
+
+    Yields the trajectory of consecutive blocks of (id-sorted) particles
+    for all timesteps `ts`, so that the memory consumption is bounded by
+    the block size and not by the number of particles. If the order of
+    the ids does not change during the trajectory, only the columns of
+    the particles of a block are read. Otherwise every block requires
+    a pass over the whole trajectory (see `h5md_pos_iter`), i.e. all
+    positions are read once per block.
+
+    Parameters
+    ----------
+    h5_dh: h5py file handle
+    ts: array like
+        Increasing timesteps for which the coordinates should be returned.
+        Defaults to all timesteps.
+    folded: bool
+        If False, the positions are unfolded with the image dataset.
+    block_size: int
+        Number of particles per block. Rounded up to a multiple of the
+        particle extent of the chunks of the position dataset.
+    chunk_size: int
+        Maximum number of timesteps per read (see `h5md_pos_iter`).
+
+    Yields
+    ------
+    array_like, array_like
+        Indices of the particles in id order and their positions of shape
+        [timesteps, particles, xyz].
+    """
+    pos_ds = h5_dh["particles/atoms/position/value"]
+    if ts is None:
+        ts = np.arange(pos_ds.shape[0])
+    ts = np.asarray(ts, dtype=int).ravel()
+    n_particles = pos_ds.shape[1]
+    if pos_ds.chunks is not None:
+        chunk = pos_ds.chunks[1]
+        block_size = int(np.ceil(max(block_size, 1) / float(chunk))) * chunk
+    order = _static_id_order(h5_dh, ts, chunk_size)
+    box = _box_edges(h5_dh) if not folded else None
+    for start in range(0, n_particles, block_size):
+        particles = np.arange(start, min(start + block_size, n_particles))
+        result = np.zeros((len(ts), len(particles), pos_ds.shape[2]))
+        if order is None:
+            for ts_chunk, pos in h5md_pos_iter(h5_dh, ts, folded=folded,
+                                               chunk_size=chunk_size):
+                result[np.searchsorted(ts, ts_chunk)] = pos[:, particles]
+            yield particles, result
+            continue
+        # the columns are read in increasing order and put back in id order
+        columns = order[particles]
+        col_order = np.argsort(columns)
+        columns = columns[col_order]
+        i = 0
+        for ts_chunk in _split_frames(ts, _chunk_frames(pos_ds, chunk_size)):
+            frames = _frame_selection(ts_chunk)
+            pos = _read_columns(pos_ds, frames, columns)
+            if box is not None:
+                pos = _unfold(pos, _read_columns(
+                    h5_dh["particles/atoms/image/value"], frames, columns),
+                    _frames_box(box, frames)
+                    if isinstance(box, h5py.Dataset) else box)
+            result[i:i+len(ts_chunk), col_order] = pos
+            i += len(ts_chunk)
+        yield particles, result
+
+
+def _read_columns(dataset, frames, columns):
+    """ Read increasing particle `columns` of a frame selection.
+
+    Contiguous columns are read as one hyperslab, others as a point
+    selection or, if the frames are a list of indices (only one axis
+    can be indexed with a list), as contiguous runs.
+    """
+    if columns[-1] - columns[0] + 1 == len(columns):
+        return dataset[frames, columns[0]:columns[-1] + 1]
+    if isinstance(frames, slice):
+        return dataset[frames, list(columns)]
+    runs = np.split(columns, np.flatnonzero(np.diff(columns) > 1) + 1)
+    return np.concatenate([dataset[frames, run[0]:run[-1] + 1]
+                           for run in runs], axis=1)
+
+
+def _static_id_order(h5_dh, ts, chunk_size=None):
+    """ Column order of the particle ids if it is the same for all `ts`.
+
+    Returns
+    -------
+    array_like or None
+        Column of the i-th particle in id order, or None if the order of
+        the ids changes between timesteps.
+    """
+    id_ds = h5_dh["particles/atoms/id/value"]
+    ids = id_ds[ts[0]].ravel()
+    for ts_chunk in _split_frames(ts, _chunk_frames(id_ds, chunk_size)):
+        chunk_ids = id_ds[_frame_selection(ts_chunk)]
+        if not np.all(chunk_ids.reshape(chunk_ids.shape[:2]) == ids):
+            return None
+    return np.argsort(ids)
+
+
+def _split_frames(ts, chunk_size):
+    """ Split increasing timesteps `ts` into reads of whole chunks.
+
+    The timesteps are split at the boundaries of aligned chunks of
+    `chunk_size` frames. Consecutive parts are combined as long as they
+    hold at most `chunk_size` timesteps, so that strided timesteps spread
+    over many chunks are read with few large hyperslab selections.
+    """
+    splits = np.flatnonzero(np.diff(ts // chunk_size)) + 1
+    reads = []
+    for ts_chunk in np.split(ts, splits):
+        if reads and len(reads[-1]) + len(ts_chunk) <= chunk_size:
+            reads[-1] = np.concatenate((reads[-1], ts_chunk))
+        elif len(ts_chunk):
+            reads.append(ts_chunk)
+    return reads
+
+
+def _read(dataset, selection, collective=False, out=None):
+    """ Read a selection, collectively with the mpio driver if requested.
+
+    If `out` is given, the selection is read directly into it.
+    """
+    if out is None:
+        if not collective:
+            return dataset[selection]
+        with dataset.collective:
+            return dataset[selection]
+    if not collective:
+        dataset.read_direct(out, selection)
+        return out
+    with dataset.collective:
+        dataset.read_direct(out, selection)
+    return out
+
+
+def _empty_read(dataset):
+    """ Take part in a collective read without selecting any data.
+
+    h5py skips the read for empty selections, so the low level interface
+    is used to call into HDF5 anyway.
+    """
+    file_space = dataset.id.get_space()
+    file_space.select_none()
+    memory_space = h5py.h5s.create_simple((1,))
+    memory_space.select_none()
+    buffer = np.zeros(1, dtype=dataset.dtype)
+    dxpl = h5py.h5p.create(h5py.h5p.DATASET_XFER)
+    dxpl.set_dxpl_mpio(h5py.h5fd.MPIO_COLLECTIVE)
+    dataset.id.read(memory_space, file_space, buffer, dxpl=dxpl)
+
+
+def _chunk_frames(dataset, chunk_size=None):
+    """ Number of timesteps per read aligned with the dataset chunks.
+
+    Parameters
+    ----------
+    dataset: h5py dataset
+        Time dependent dataset with the time as first dimension.
+    chunk_size: int
+        Requested number of timesteps, rounded up to a multiple of the
+        time extent of one chunk. If None, the time extent of one chunk
+        is used, or for contiguous datasets as many timesteps as fit into
+        `CONTIGUOUS_READ_BYTES`.
+
+    Returns
+    -------
+    int
+    """
+    if dataset.chunks is None:
+        if chunk_size is not None:
+            return max(int(chunk_size), 1)
+        frame_bytes = dataset.dtype.itemsize * int(np.prod(dataset.shape[1:]))
+        return max(1, CONTIGUOUS_READ_BYTES // max(frame_bytes, 1))
+    chunk = dataset.chunks[0]
+    if chunk_size is None:
+        return chunk
+    return int(np.ceil(max(chunk_size, 1) / float(chunk))) * chunk
+
+
+def _frame_selection(ts):
+    """ HDF5 selection for increasing timesteps `ts`.
+
+    Returns a (strided) slice if the timesteps are equally spaced and
+    a list of indices otherwise.
+    """
+    if len(ts) == 1:
+        return slice(ts[0], ts[0] + 1)
+    step = ts[1] - ts[0]
+    if step > 0 and np.all(np.diff(ts) == step):
+        return slice(ts[0], ts[-1] + 1, step)
+    return list(ts)
+
+
+def _sort_frames(h5_pos, h5_id=None, h5_image=None, box=None):
+    """ Sort and unfold positions of several timesteps.
+
+    Parameters
+    ----------
+    h5_pos: array_like
+        Positions of shape [timesteps, particles, xyz].
+    h5_id: array_like
+        Ids of shape [timesteps, particles, 1]. If None, the positions
+        are not sorted.
+    h5_image: array_like
+        Images of shape [timesteps, particles, xyz].
+    box: array_like
+        Box edge lengths or triclinic edge vectors as rows of a matrix,
+        either fixed or of every timestep (see `_frames_box`). If None,
+        the positions are not unfolded.
+
+    Returns
+    -------
+    array_like
+        Positions of all timesteps sorted by id and unfolded with the
+        images in one vectorized operation.
+    """
+    result = np.asarray(h5_pos, dtype=float)
+    if h5_id is not None:
+        ids = np.reshape(h5_id, h5_id.shape[:2])
+        # ESPResSo usually writes the particles in id order, in which case
+        # a single check replaces the sort
+        if np.any(ids[:, 1:] < ids[:, :-1]):
+            order = np.argsort(ids, axis=1)[:, :, np.newaxis]
+            result = np.take_along_axis(result, order, axis=1)
+            if box is not None:
+                h5_image = np.take_along_axis(h5_image, order, axis=1)
+    if box is not None:
+        result = _unfold(result, h5_image, box)
+    return result
+
+
+def _box_edges(h5_dh):
+    """ Box of the unfolding readers.
+
+    A fixed box is returned as array (see `h5md_box`), a time-dependent
+    one as its edges dataset, of which `_frames_box` reads the frames.
+    """
+    edges = h5_dh["particles/atoms/box/edges"]
+    if hasattr(edges, "keys"):
+        return edges["value"]
+    return h5md_box(h5_dh)
+
+
+def _frames_box(edges, selection, collective=False):
+    """ Box of every frame of a selection of a time-dependent box.
+
+    Edge lengths get a particle axis, so that they broadcast against
+    positions of shape [frames, particles, xyz] in `_unfold`.
+    """
+    box = np.asarray(_read(edges, selection, collective), dtype=float)
+    return box[:, np.newaxis, :] if box.ndim == 2 else box
+
+
+def _unfold(pos, image, box):
+    """ Unfold positions with their periodic images.
+
+    `box` holds either the per-axis edge lengths or, for a triclinic
+    box, the edge vectors as rows of a matrix, for a time-dependent box
+    of every frame (see `_frames_box`).
+    """
+    box = np.asarray(box, dtype=float)
+    if box.ndim == 3 and box.shape[-2] == 3:
+        return pos + np.matmul(image, box)
+    if box.ndim == 2:
+        return pos + np.dot(image, box)
+    return pos + image * box
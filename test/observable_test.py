@@ -1,10 +1,25 @@
 #!/usr/bin/env python
 
 
+import itertools
+import os
+import tracemalloc
 import unittest
 import numpy as np
+import h5py
 from kaipy.observable import second_legendre, rg2, rg2_compwise,\
-                             end_to_end_distance, center_of_mass
+                             end_to_end_distance, center_of_mass,\
+                             neighbor_pairs, radial_distribution,\
+                             rouse_mode, rouse_modes,\
+                             rouse_mode_autocorrelation, msd_fft,\
+                             msd_ensemble, h5md_msd, second_legendre_bonds,\
+                             bond_vectors, nematic_order,\
+                             orientational_order,\
+                             minimum_image_distance,\
+                             minimum_image_vectors, minimum_image_distances,\
+                             minimum_image_pdist,\
+                             radial_distribution_partials,\
+                             RadialDistributionAccumulator
 
 class Test_Second_legendre(unittest.TestCase):
 
@@ -47,6 +62,79 @@ class Test_Second_legendre(unittest.TestCase):
                                                       2)
 
         
+class Test_orientational_order(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(42)
+        self.x = rng.uniform(0., 10., (3, 2, 20, 3))
+
+    def test_second_legendre_bonds(self):
+        bonds = bond_vectors(self.x)
+        p2 = second_legendre_bonds(bonds, 'y')
+        self.assertEqual(p2.shape, (3, 2, 19))
+        for i in range(19):
+            self.assertAlmostEqual(p2[1, 0, i],
+                                   second_legendre(self.x[1, 0, i],
+                                                   self.x[1, 0, i + 1], 'y'))
+        np.testing.assert_array_almost_equal(
+            second_legendre_bonds(bonds, [1., 1., 0.]),
+            second_legendre_bonds(
+                np.stack(((bonds[..., 0] + bonds[..., 1]) / np.sqrt(2.),
+                          (bonds[..., 1] - bonds[..., 0]) / np.sqrt(2.),
+                          bonds[..., 2]), axis=-1), 'x'))
+        self.assertRaises(ValueError, second_legendre_bonds, bonds, [0, 0, 0])
+
+    def test_bond_vectors(self):
+        x = np.array([[9.5, 0., 0.], [0.5, 0., 0.], [0.5, 9., 0.]])
+        np.testing.assert_array_almost_equal(
+            bond_vectors(x, box_l=10.), [[1., 0., 0.], [0., -1., 0.]])
+
+    def test_bond_vectors_triclinic(self):
+        box = np.array([[8., 0., 0.], [2., 9., 0.], [-1., 3., 10.]])
+        rng = np.random.RandomState(42)
+        # four beads, where a [3, 3] box broadcasts against the bonds
+        x = rng.uniform(0., 8., (4, 3))
+        np.testing.assert_array_almost_equal(
+            bond_vectors(x, box_l=box),
+            minimum_image_vectors(x[:-1], x[1:], box))
+
+    def test_nematic_order(self):
+        aligned = np.zeros((10, 3))
+        aligned[:, 2] = np.where(np.arange(10) % 2, 1., -1.)
+        order, director, Q = nematic_order(aligned)
+        self.assertAlmostEqual(order, 1.)
+        self.assertAlmostEqual(abs(director[2]), 1.)
+        np.testing.assert_array_almost_equal(Q, np.diag([-0.5, -0.5, 1.]))
+        rng = np.random.RandomState(42)
+        order, _, _ = nematic_order(rng.normal(size=(4, 10000, 3)))
+        self.assertEqual(order.shape, (4,))
+        self.assertTrue(np.all(order < 0.05))
+
+    def test_nematic_order_axis(self):
+        bonds = bond_vectors(self.x)
+        order, director, Q = nematic_order(bonds, axis=(1, 2))
+        self.assertEqual(order.shape, (3,))
+        for frame in range(3):
+            reference = nematic_order(bonds[frame].reshape(-1, 3))
+            self.assertAlmostEqual(order[frame], reference[0])
+            np.testing.assert_array_almost_equal(Q[frame], reference[2])
+        # the order parameter is the mean P2 along the director
+        np.testing.assert_array_almost_equal(
+            order, [orientational_order(bonds[frame], director[frame])
+                    for frame in range(3)])
+        total = nematic_order(bonds, axis=None)[2]
+        np.testing.assert_array_almost_equal(total, Q.mean(axis=0))
+        self.assertRaises(ValueError, nematic_order, bonds, -1)
+
+    def test_orientational_order(self):
+        bonds = bond_vectors(self.x)
+        p2 = second_legendre_bonds(bonds, 'z')
+        self.assertAlmostEqual(orientational_order(bonds, 'z'), p2.mean())
+        np.testing.assert_array_almost_equal(
+            orientational_order(bonds, 'z', axis=(1, 2)),
+            p2.mean(axis=(1, 2)))
+
+
 class Test_Rg2(unittest.TestCase):
 
     def setUp(self):
@@ -99,11 +187,408 @@ class Test_center_of_mass(unittest.TestCase):
         np.testing.assert_array_almost_equal(center_of_mass(self.coordinates, np.array([1,0,0,2])), np.array([ 0.33333333,0.,0.]))
         
 
+class Test_batched_observables(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(42)
+        self.frames = rng.normal(size=(5, 4, 20, 3))
+
+    def check(self, func, *args):
+        def as_array(result):
+            if isinstance(result, tuple):
+                return np.stack(result, axis=-1)
+            return np.asarray(result)
+        batched = as_array(func(self.frames, *args))
+        for i in range(self.frames.shape[0]):
+            for j in range(self.frames.shape[1]):
+                np.testing.assert_array_almost_equal(
+                    batched[i, j], as_array(func(self.frames[i, j], *args)))
+
+    def test_rg2(self):
+        self.check(rg2)
+
+    def test_rg2_compwise(self):
+        self.check(rg2_compwise)
+
+    def test_end_to_end_distance(self):
+        self.check(end_to_end_distance)
+
+    def test_center_of_mass(self):
+        self.check(center_of_mass)
+
+    def test_rouse_mode(self):
+        self.check(rouse_mode, 3)
+        x = self.frames[0, 0]
+        reference = np.sqrt(2. / 20.) * sum(
+            x[i] * np.cos((i + 0.5) * np.pi * 3. / 20.) for i in range(20))
+        np.testing.assert_array_almost_equal(rouse_mode(x, 3), reference)
+
+
+class Test_rouse_modes(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(42)
+        self.frames = rng.normal(size=(6, 2, 15, 3))
+
+    def test_all_modes(self):
+        modes = rouse_modes(self.frames)
+        for p in range(15):
+            np.testing.assert_array_almost_equal(modes[..., p, :],
+                                                 rouse_mode(self.frames, p))
+
+    def test_selected_modes(self):
+        np.testing.assert_array_almost_equal(
+            rouse_modes(self.frames, [1, 4]),
+            rouse_modes(self.frames)[..., [1, 4], :])
+
+    def test_autocorrelation(self):
+        modes = rouse_modes(self.frames)
+        acf = rouse_mode_autocorrelation(modes, normalized=False)
+        for t in range(6):
+            reference = np.mean(
+                [(modes[t0 + t] * modes[t0]).sum(axis=-1).mean(axis=0)
+                 for t0 in range(6 - t)], axis=0)
+            np.testing.assert_array_almost_equal(acf[t], reference)
+        np.testing.assert_array_almost_equal(
+            rouse_mode_autocorrelation(modes)[0], np.ones(15))
+
+
+class Test_msd(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(42)
+        self.x = np.cumsum(rng.normal(size=(50, 12, 3)), axis=0)
+
+    def reference(self, x):
+        return np.array([np.mean(np.square(x[m:] - x[:len(x)-m]).sum(axis=-1))
+                         for m in range(len(x))])
+
+    def test_msd_fft(self):
+        np.testing.assert_array_almost_equal(msd_fft(self.x[:, 0]),
+                                             self.reference(self.x[:, 0]))
+
+    def test_ensemble(self):
+        reference = np.mean([self.reference(self.x[:, i]) for i in range(12)],
+                            axis=0)
+        np.testing.assert_array_almost_equal(
+            msd_ensemble(self.x, block_size=5), reference)
+
+    def test_species(self):
+        species = np.arange(12) % 2
+        result = msd_ensemble(self.x, species=species)
+        for s in (0, 1):
+            reference = np.mean([self.reference(self.x[:, i])
+                                 for i in range(12) if species[i] == s],
+                                axis=0)
+            np.testing.assert_array_almost_equal(result[s], reference)
+
+    def test_chains(self):
+        com = self.x.reshape((50, 3, 4, 3)).mean(axis=2)
+        reference = np.mean([self.reference(com[:, i]) for i in range(3)],
+                            axis=0)
+        np.testing.assert_array_almost_equal(
+            msd_ensemble(self.x, chain_length=4), reference)
+
+
+class Test_h5md_msd(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        rng = np.random.RandomState(42)
+        cls.box = np.array([5., 6., 7.])
+        cls.unfolded = np.cumsum(rng.normal(size=(40, 10, 3)), axis=0)
+        image = np.floor(cls.unfolded / cls.box)
+        order = rng.permutation(10)
+        with h5py.File('msd_test.h5', 'w') as h5_fh:
+            h5_fh.create_dataset('particles/atoms/position/value',
+                                 data=(cls.unfolded - image * cls.box)[:, order],
+                                 chunks=(8, 4, 3))
+            h5_fh.create_dataset('particles/atoms/image/value',
+                                 data=image[:, order], chunks=(8, 4, 3))
+            h5_fh.create_dataset('particles/atoms/id/value',
+                                 data=np.tile(order, (40, 1))[:, :, np.newaxis])
+            h5_fh.create_dataset('particles/atoms/box/edges', data=cls.box)
+        cls.h5_fh = h5py.File('msd_test.h5', 'r')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.h5_fh.close()
+        os.remove('msd_test.h5')
+
+    def test_function(self):
+        np.testing.assert_array_almost_equal(
+            h5md_msd(self.h5_fh, block_size=3), msd_ensemble(self.unfolded))
+
+    def test_species(self):
+        species = np.arange(10) % 3
+        ts = np.arange(1, 40, 2)
+        result = h5md_msd(self.h5_fh, ts=ts, species=species, chunk_size=5)
+        reference = msd_ensemble(self.unfolded[ts], species=species)
+        for s in range(3):
+            np.testing.assert_array_almost_equal(result[s], reference[s])
+
+    def test_irregular_timesteps(self):
+        with self.assertRaises(ValueError):
+            h5md_msd(self.h5_fh, ts=[0, 1, 3])
+        with self.assertRaises(ValueError):
+            h5md_msd(self.h5_fh, ts=[3, 2, 1])
+
+
+class Test_neighbor_pairs(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(42)
+        self.box_l = 10.
+        self.pos1 = rng.uniform(-5., 15., (200, 3))
+        self.pos2 = rng.uniform(0., 10., (150, 3))
+
+    def reference(self, r_max):
+        diff = self.pos2[np.newaxis, :, :] - self.pos1[:, np.newaxis, :]
+        diff -= self.box_l * np.rint(diff / self.box_l)
+        dist = np.linalg.norm(diff, axis=-1)
+        i, j = np.nonzero(dist < r_max)
+        return set(zip(i, j)), np.sort(dist[i, j])
+
+    def check(self, r_max, block_size):
+        pairs = set()
+        dists = []
+        for i, j, dist in neighbor_pairs(self.pos1, self.pos2, self.box_l,
+                                         r_max, block_size=block_size):
+            pairs.update(zip(i, j))
+            dists.append(dist)
+        ref_pairs, ref_dists = self.reference(r_max)
+        self.assertEqual(pairs, ref_pairs)
+        np.testing.assert_array_almost_equal(np.sort(np.concatenate(dists)),
+                                             ref_dists)
+
+    def test_cell_list(self):
+        self.check(2.5, 64)
+
+    def test_all_pairs(self):
+        self.check(4.5, 64)
+
+    def test_all_pairs_memory(self):
+        # the blocks are bounded by pairs, not by particles of pos1
+        rng = np.random.RandomState(42)
+        pos1 = rng.uniform(0., 10., (200, 3))
+        pos2 = rng.uniform(0., 10., (20000, 3))
+        tracemalloc.start()
+        n_pairs = sum(len(i) for i, _, _ in neighbor_pairs(
+            pos1, pos2, self.box_l, 4.5, block_size=1000))
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self.assertGreater(n_pairs, 0)
+        # a single row of 20000 distance vectors takes 480 kB
+        self.assertLess(peak, 8 * 10**6)
+
+    def test_cell_list_memory(self):
+        # block_size counts candidate pairs with cell list as well
+        rng = np.random.RandomState(42)
+        pos1 = rng.uniform(0., 10., (2000, 3))
+        pos2 = rng.uniform(0., 10., (20000, 3))
+        tracemalloc.start()
+        n_pairs = sum(len(i) for i, _, _ in neighbor_pairs(
+            pos1, pos2, self.box_l, 1., block_size=20000))
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self.assertGreater(n_pairs, 0)
+        self.assertLess(peak, 8 * 10**6)
+
+    def test_triclinic(self):
+        box = np.array([[10., 0., 0.], [3., 10., 0.], [0., -2., 10.]])
+        pairs = set()
+        for i, j, dist in neighbor_pairs(self.pos1, self.pos2, box, 2.5,
+                                         block_size=64):
+            pairs.update(zip(i, j))
+        dist = minimum_image_distances(self.pos1[:, np.newaxis, :],
+                                       self.pos2[np.newaxis, :, :], box)
+        self.assertEqual(pairs, set(zip(*np.nonzero(dist < 2.5))))
+
+
+class Test_minimum_image(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(42)
+        self.pos = rng.uniform(0., 8., (40, 3))
+        self.boxes = [8., np.array([8., 9., 10.]),
+                      np.array([[8., 0., 0.], [2., 9., 0.], [-1., 3., 10.]])]
+
+    def reference(self, pos1, pos2, box):
+        """ Nearest image by search over all images up to two boxes away. """
+        edges = np.diag(np.broadcast_to(box, (3,))) if np.ndim(box) < 2 \
+            else box
+        shifts = np.array(list(itertools.product(range(-2, 3), repeat=3)))
+        diff = pos2 - pos1 + np.dot(shifts, edges)[:, np.newaxis, :]
+        dist = np.linalg.norm(diff, axis=-1)
+        return diff[np.argmin(dist, axis=0), np.arange(diff.shape[1])]
+
+    def test_pairs(self):
+        for box in self.boxes:
+            out = np.empty((39, 3))
+            result = minimum_image_vectors(self.pos[:-1], self.pos[1:], box,
+                                           out=out)
+            self.assertIs(result, out)
+            np.testing.assert_array_almost_equal(
+                out, self.reference(self.pos[:-1], self.pos[1:], box))
+
+    def test_one_to_many(self):
+        for box in self.boxes:
+            out = np.empty(39)
+            minimum_image_distances(self.pos[0], self.pos[1:], box, out=out)
+            np.testing.assert_array_almost_equal(out, np.linalg.norm(
+                self.reference(self.pos[0], self.pos[1:], box), axis=-1))
+
+    def test_distances_buffer(self):
+        for box in self.boxes:
+            buffer = np.empty((39, 3))
+            out = np.empty(39)
+            result = minimum_image_distances(self.pos[:-1], self.pos[1:],
+                                             box, out=out, buffer=buffer)
+            self.assertIs(result, out)
+            np.testing.assert_array_almost_equal(out, np.linalg.norm(
+                self.reference(self.pos[:-1], self.pos[1:], box), axis=-1))
+
+    def test_pdist(self):
+        i, j = np.triu_indices(len(self.pos), k=1)
+        for box in self.boxes:
+            out = np.empty(len(i))
+            minimum_image_pdist(self.pos, box, out=out, block_size=50)
+            np.testing.assert_array_almost_equal(out, np.linalg.norm(
+                self.reference(self.pos[i], self.pos[j], box), axis=-1))
+
+    def test_single_pair(self):
+        self.assertAlmostEqual(
+            minimum_image_distance(np.zeros(3), np.array([7., 1., 0.]), 8.),
+            np.sqrt(2.))
+        # scalar coordinates and a single vector in a triclinic box
+        self.assertAlmostEqual(minimum_image_vectors(1., 7.5, 8.), -1.5)
+        pos1 = np.zeros(3)
+        for pos2 in self.pos[:5]:
+            np.testing.assert_array_almost_equal(
+                minimum_image_vectors(pos1, pos2, self.boxes[2]),
+                self.reference(pos1, pos2[np.newaxis], self.boxes[2])[0])
+
+
+class Test_radial_distribution(unittest.TestCase):
+
+    def test_ideal_gas(self):
+        rng = np.random.RandomState(42)
+        box_l = 12.
+        pos = rng.uniform(0., box_l, (2, 2000, 3))
+        species = np.zeros(2000)
+        rdf, bin_mids = radial_distribution(pos, species, 0, 0, 0, 2, box_l,
+                                            10, 1.0, 3.0)
+        np.testing.assert_array_almost_equal(bin_mids, np.arange(1.1, 3., 0.2))
+        shell = 4. / 3. * np.pi * (3.**3 - 1.**3)
+        np.testing.assert_allclose(rdf, box_l**3 / shell, rtol=0.05)
+
+    def test_nan_frame(self):
+        rng = np.random.RandomState(42)
+        pos = rng.uniform(0., 10., (3, 200, 3))
+        species = rng.randint(0, 2, 200)
+        reference = radial_distribution(pos[[0, 2]], species, 0, 1, 0, 2,
+                                        10., 5, 0.5)
+        pos[1, 7] = np.nan
+        result = radial_distribution(pos, species, 0, 1, 0, 3, 10., 5, 0.5)
+        np.testing.assert_array_almost_equal(result[0], reference[0])
+
+
+    def test_cross_pairs(self):
+        # only pairs of SPECIES_1 and SPECIES_2 strictly beyond R_MIN count
+        pos = np.array([[[1., 1., 1.], [2., 1., 1.], [1., 2.5, 1.],
+                         [1.2, 1., 1.]]])
+        species = np.array([0, 1, 1, 0])
+        rdf, _ = radial_distribution(pos, species, 0, 1, 0, 1, 10., 2, 1.0,
+                                     2.0)
+        shells = 4. / 3. * np.pi * np.array([1.5**3 - 1., 2.**3 - 1.5**3])
+        # the cross pairs at 1.0 (on R_MIN) and 0.8 are left out, as are
+        # the pair of species 1 at 1.8
+        counts = np.histogram([1.5, np.hypot(0.2, 1.5)], bins=[1., 1.5, 2.])[0]
+        np.testing.assert_array_almost_equal(
+            rdf, 1000. * counts / (shells * counts.sum()))
+
+
+class Test_radial_distribution_partials(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(42)
+        self.box_l = np.array([10., 11., 12.])
+        self.pos = rng.uniform(0., 1., (3, 300, 3)) * self.box_l
+        self.species = rng.randint(0, 3, 300)
+
+    def test_counts(self):
+        result = radial_distribution_partials(self.pos, self.species,
+                                              self.box_l, 8, 0.5, 4.5,
+                                              species=[2, 0])
+        self.assertEqual(result.n_frames, 3)
+        mask = (self.species == 2) | (self.species == 0)
+        codes = np.where(self.species[mask] == 2, 0, 1)
+        reference = np.zeros((2, 2, 8))
+        for frame in self.pos[:, mask]:
+            dist = minimum_image_distances(frame[:, np.newaxis, :],
+                                           frame[np.newaxis, :, :],
+                                           self.box_l)
+            for a in range(2):
+                for b in range(2):
+                    reference[a, b] += np.histogram(
+                        dist[np.ix_(codes == a, codes == b)],
+                        bins=result.bin_edges)[0]
+        np.testing.assert_array_equal(result.counts, reference)
+        np.testing.assert_array_almost_equal(
+            result.coordination_number(2, 0),
+            np.cumsum(reference[0, 1]) / (3 * np.sum(codes == 0)))
+
+    def test_ideal_gas(self):
+        rng = np.random.RandomState(1)
+        box_l = 12.
+        pos = rng.uniform(0., box_l, (2, 2000, 3))
+        species = rng.randint(0, 2, 2000)
+        result = radial_distribution_partials(pos, species, box_l, 5, 1.0)
+        np.testing.assert_array_almost_equal(result.bin_mids,
+                                             np.arange(1.5, 6., 1.))
+        np.testing.assert_allclose(result.rdf, 1., rtol=0.1)
+        np.testing.assert_allclose(result.total, 1., rtol=0.05)
+        np.testing.assert_allclose(result.partial(0, 1), result.partial(1, 0),
+                                   rtol=0.05)
+
+    def test_nan(self):
+        self.pos[1, 3] = np.nan
+        with self.assertRaises(ValueError):
+            radial_distribution_partials(self.pos, self.species, self.box_l, 8)
+        result = radial_distribution_partials(self.pos, self.species,
+                                              self.box_l, 8, nan_policy='skip')
+        self.assertEqual(result.n_frames, 2)
+
+    def test_merge(self):
+        accumulators = [RadialDistributionAccumulator(
+            self.species, self.box_l, 8, nan_policy='skip') for _ in range(2)]
+        self.pos[2, 0] = np.nan
+        for i, frame in enumerate(self.pos):
+            accumulators[i % 2].update(frame)
+        accumulators[0].merge(accumulators[1])
+        self.assertEqual(accumulators[0].n_skipped, 1)
+        reference = radial_distribution_partials(self.pos[:2], self.species,
+                                                 self.box_l, 8)
+        result = accumulators[0].result()
+        self.assertEqual(result.n_frames, 2)
+        np.testing.assert_array_equal(result.counts, reference.counts)
+        np.testing.assert_array_almost_equal(result.rdf, reference.rdf)
+
+
 if __name__ == "__main__": 
     suite1 = unittest.TestLoader().loadTestsFromTestCase(Test_Second_legendre)
     suite2 = unittest.TestLoader().loadTestsFromTestCase(Test_Rg2)
     suite3 = unittest.TestLoader().loadTestsFromTestCase(Test_Rg2_compwise)
     suite4 = unittest.TestLoader().loadTestsFromTestCase(Test_End_to_end_distance)
     suite5 = unittest.TestLoader().loadTestsFromTestCase(Test_center_of_mass)
-    alltests = unittest.TestSuite([suite1,suite2,suite3,suite4,suite5])
+    suite6 = unittest.TestLoader().loadTestsFromTestCase(Test_neighbor_pairs)
+    suite7 = unittest.TestLoader().loadTestsFromTestCase(Test_radial_distribution)
+    suite8 = unittest.TestLoader().loadTestsFromTestCase(Test_batched_observables)
+    suite9 = unittest.TestLoader().loadTestsFromTestCase(Test_rouse_modes)
+    suite10 = unittest.TestLoader().loadTestsFromTestCase(Test_msd)
+    suite11 = unittest.TestLoader().loadTestsFromTestCase(Test_h5md_msd)
+    suite12 = unittest.TestLoader().loadTestsFromTestCase(Test_orientational_order)
+    suite13 = unittest.TestLoader().loadTestsFromTestCase(Test_minimum_image)
+    suite14 = unittest.TestLoader().loadTestsFromTestCase(Test_radial_distribution_partials)
+    alltests = unittest.TestSuite([suite1,suite2,suite3,suite4,suite5,suite6,suite7,suite8,suite9,suite10,suite11,suite12,suite13,suite14])
     unittest.TextTestRunner(verbosity=2).run(alltests)
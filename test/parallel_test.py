@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+
+"""
+Unit-test module for the kaipy.parallel module.
+"""
+
+import itertools
+import os
+import unittest
+import numpy as np
+import h5py
+from kaipy.parallel import H5mdParallelTrajectory, H5mdPoolTrajectory
+
+try:
+    from mpi4py import MPI
+except ImportError:
+    MPI = None
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+# one file per rank if the tests are run with mpirun
+H5_FILE = 'parallel_test_{}.h5'.format(
+    MPI.COMM_WORLD.Get_rank() if MPI is not None else 0)
+
+
+def end_to_end(x, polymer_length):
+    return np.linalg.norm(x[polymer_length - 1] - x[0])
+
+
+def first_bead(x, polymer_length):
+    return x[0]
+
+
+def centered(x):
+    return x - x.mean(axis=0)
+
+
+class StubComm(object):
+    """
+    Communicator of size ranks seen from rank, recording Gatherv calls.
+    """
+
+    def __init__(self, rank, size):
+        self.rank = rank
+        self.size = size
+        self.gathered = []
+
+    def Get_rank(self):
+        return self.rank
+
+    def Get_size(self):
+        return self.size
+
+    def Gatherv(self, send_buffer, recv_buffer, root=0):
+        self.gathered.append((send_buffer, recv_buffer))
+
+
+class ParallelTrajectoryBase(object):
+    """
+    Common tests of the parallel trajectory backends.
+    """
+
+    n_particles = 10
+
+    @classmethod
+    def setUpClass(cls):
+        rng = np.random.RandomState(42)
+        cls.pos = rng.normal(size=(23, cls.n_particles, 3))
+        with h5py.File(H5_FILE, 'w') as h5_fh:
+            h5_fh.create_dataset('particles/atoms/position/value',
+                                 data=cls.pos, chunks=(4, cls.n_particles, 3))
+            h5_fh.create_dataset('particles/atoms/position/time',
+                                 data=np.arange(23.))
+        cls.h5_fh = h5py.File(H5_FILE, 'r')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.h5_fh.close()
+        os.remove(H5_FILE)
+
+    def reference(self, timesteps):
+        return np.array([end_to_end(self.pos[i], self.n_particles)
+                         for i in timesteps])
+
+    def trajectory(self, **kwargs):
+        raise NotImplementedError
+
+    def test_gather(self):
+        trajectory = self.trajectory(res_shape=(1,), n_ts=0, stride=3,
+                                     offset=2)
+        trajectory.run(self.n_particles)
+        trajectory.communicate()
+        if trajectory.mpi_rank == 0:
+            np.testing.assert_array_almost_equal(
+                trajectory.total_result.ravel(),
+                self.reference(range(2, 23, 3)))
+
+    def test_allreduce(self):
+        trajectory = self.trajectory(res_shape=(1,), n_ts=10, stride=1,
+                                     offset=0)
+        trajectory.run(self.n_particles)
+        trajectory.communicate('allreduce')
+        np.testing.assert_array_almost_equal(
+            trajectory.total_result, [self.reference(range(10)).sum()])
+
+    def test_multiple_observables(self):
+        trajectory = self.trajectory(
+            obs={'e2e': end_to_end, 'first': first_bead},
+            res_shape={'e2e': (1,), 'first': (3,)},
+            reducer={'first': 'mean'}, transform=centered,
+            n_ts=0, stride=2, offset=0)
+        trajectory.run(self.n_particles)
+        trajectory.communicate()
+        result = trajectory.total_result
+        self.assertEqual(sorted(result), ['e2e', 'first'])
+        np.testing.assert_array_almost_equal(
+            result['first'],
+            (self.pos[::2, 0] - self.pos[::2].mean(axis=1)).mean(axis=0))
+        if trajectory.mpi_rank == 0:
+            np.testing.assert_array_almost_equal(
+                result['e2e'].ravel(), self.reference(range(0, 23, 2)))
+
+    def test_dynamic(self):
+        trajectory = self.trajectory(
+            obs={'e2e': end_to_end, 'first': first_bead},
+            res_shape={'e2e': (1,), 'first': (3,)},
+            reducer={'first': 'sum'}, n_ts=0, stride=1, offset=1,
+            schedule='dynamic', task_size=2)
+        trajectory.run(self.n_particles)
+        trajectory.communicate()
+        report = trajectory.load_report()
+        self.assertEqual(sum(report['frames']), 22)
+        self.assertGreaterEqual(report['imbalance'], 1.)
+        np.testing.assert_array_almost_equal(
+            trajectory.total_result['first'], self.pos[1:, 0].sum(axis=0))
+        if trajectory.mpi_rank == 0:
+            np.testing.assert_array_almost_equal(
+                trajectory.total_result['e2e'].ravel(),
+                self.reference(range(1, 23)))
+
+    def test_profile(self):
+        trajectory = self.trajectory(
+            obs={'e2e': end_to_end, 'first': first_bead},
+            res_shape={'e2e': (1,), 'first': (3,)}, n_ts=0, stride=1,
+            offset=0, profile='trace')
+        trajectory.run(self.n_particles)
+        trajectory.communicate()
+        summary = trajectory.profile_summary()
+        self.assertEqual(sum(rank['count/frames'] for rank in summary.ranks),
+                         23)
+        self.assertEqual(summary.stats['count/bytes_read']['max'] > 0, True)
+        for key in ('time/io', 'time/compute/e2e', 'time/compute/first',
+                    'time/comm'):
+            self.assertIn(key, summary.stats)
+            self.assertGreaterEqual(summary.stats[key]['imbalance'], 1.)
+        names = set(event['name'] for event in
+                    summary.to_chrome_trace()['traceEvents'])
+        self.assertIn('compute/e2e', names)
+
+    def test_profile_prefetch(self):
+        trajectory = self.trajectory(res_shape=(1,), n_ts=0, stride=1,
+                                     offset=0, prefetch=2, profile=True)
+        trajectory.run(self.n_particles)
+        trajectory.communicate()
+        stats = trajectory.profile_summary().stats
+        self.assertIn('time/io/wait', stats)
+        self.assertNotIn('time/io', stats)
+
+    def test_profile_disabled(self):
+        trajectory = self.trajectory(res_shape=(1,), n_ts=0, stride=1,
+                                     offset=0)
+        trajectory.run(self.n_particles)
+        with self.assertRaises(ValueError):
+            trajectory.profile_summary()
+
+    def test_prefetch(self):
+        trajectory = self.trajectory(res_shape=(1,), n_ts=0, stride=1,
+                                     offset=0, chunk_size=4, prefetch=2)
+        trajectory.run(self.n_particles)
+        trajectory.communicate('allreduce')
+        np.testing.assert_array_almost_equal(
+            trajectory.total_result, [self.reference(range(23)).sum()])
+
+    def test_run_twice(self):
+        trajectory = self.trajectory(res_shape=(1,), n_ts=0, stride=3,
+                                     offset=2)
+        # the second run has to overwrite the results of the first one
+        for length in (self.n_particles, self.n_particles - 1):
+            trajectory.run(length)
+            trajectory.communicate()
+            if trajectory.mpi_rank == 0:
+                np.testing.assert_array_almost_equal(
+                    trajectory.total_result.ravel(),
+                    [end_to_end(self.pos[i], length)
+                     for i in range(2, 23, 3)])
+
+    def test_reducer(self):
+        trajectory = self.trajectory(res_shape=(), n_ts=0, stride=2, offset=1,
+                                     reducer='variance')
+        trajectory.run(self.n_particles)
+        trajectory.communicate()
+        reference = self.reference(range(1, 23, 2))
+        np.testing.assert_array_almost_equal(
+            trajectory.total_result, (reference.mean(), reference.var()))
+
+    def test_reducer_twice(self):
+        trajectory = self.trajectory(res_shape=(), n_ts=0, stride=2, offset=1,
+                                     reducer='variance')
+        reference = self.reference(range(1, 23, 2))
+        for _ in range(2):
+            trajectory.run(self.n_particles)
+            for _ in range(2):
+                trajectory.communicate()
+                np.testing.assert_array_almost_equal(
+                    trajectory.total_result,
+                    (reference.mean(), reference.var()))
+        trajectory = self.trajectory(res_shape=(3,), n_ts=0, stride=1,
+                                     offset=0, obs=first_bead, reducer='sum')
+        for _ in range(2):
+            trajectory.run(self.n_particles)
+            trajectory.communicate()
+            np.testing.assert_array_almost_equal(
+                trajectory.total_result, self.pos[:, 0].sum(axis=0))
+
+    def test_reducer_blocking_short(self):
+        # fewer frames than blocks required for the plateau search
+        trajectory = self.trajectory(res_shape=(), n_ts=0, stride=2, offset=1,
+                                     reducer='blocking')
+        trajectory.run(self.n_particles)
+        trajectory.communicate()
+        reference = self.reference(range(1, 23, 2))
+        self.assertAlmostEqual(trajectory.total_result[0], reference.mean())
+        self.assertTrue(np.isfinite(trajectory.total_result[1]))
+
+
+class Test_calc_range(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        with h5py.File(H5_FILE, 'w') as h5_fh:
+            h5_fh['particles/atoms/position/value'] = np.zeros((23, 2, 3))
+            h5_fh['particles/atoms/position/time'] = np.arange(23.)
+        cls.h5_fh = h5py.File(H5_FILE, 'r')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.h5_fh.close()
+        os.remove(H5_FILE)
+
+    def trajectory(self, rank, size, **kwargs):
+        return H5mdParallelTrajectory(comm=StubComm(rank, size),
+                                      h5md_file=self.h5_fh, obs=end_to_end,
+                                      **kwargs)
+
+    def test_split(self):
+        for size, n_ts, stride, offset in itertools.product(
+                (1, 3, 7, 512), (0, 1, 1000, 1001), (1, 3), (0, 2)):
+            trajectory = self.trajectory(0, size, res_shape=(1,), n_ts=0,
+                                         stride=1, offset=0)
+            parts = [trajectory.calc_range(rank, n_ts, stride, offset)
+                     for rank in range(size)]
+            lengths = [len(part) for part in parts]
+            np.testing.assert_array_equal(
+                np.concatenate(parts),
+                trajectory.calc_global_range(n_ts, stride, offset))
+            self.assertLessEqual(max(lengths) - min(lengths), 1)
+            np.testing.assert_array_equal(
+                trajectory.calc_counts(n_ts, stride, offset), lengths)
+
+    def test_n_ts(self):
+        # n_ts is clipped to the timesteps after offset
+        trajectory = self.trajectory(0, 1, res_shape=(1,), n_ts=100,
+                                     stride=2, offset=5)
+        np.testing.assert_array_equal(trajectory.timestep_range,
+                                      np.arange(5, 23, 2))
+
+    def test_gatherv(self):
+        trajectory = self.trajectory(0, 4, res_shape=(3,), n_ts=0, stride=2,
+                                     offset=1)
+        trajectory.run(2)
+        self.assertEqual(len(trajectory.mpi_buffer), 3)
+        trajectory.communicate()
+        _, (total_result, (counts, displacements)) = \
+            trajectory.comm.gathered[0]
+        np.testing.assert_array_equal(counts, np.array([3, 3, 3, 2]) * 3)
+        np.testing.assert_array_equal(displacements, [0, 9, 18, 27])
+        self.assertEqual(total_result.shape, (11, 3))
+
+
+@unittest.skipIf(MPI is None, "mpi4py is not available")
+class Test_H5mdParallelTrajectory(ParallelTrajectoryBase, unittest.TestCase):
+
+    def trajectory(self, **kwargs):
+        kwargs.setdefault('obs', end_to_end)
+        return H5mdParallelTrajectory(comm=MPI.COMM_WORLD,
+                                      h5md_file=self.h5_fh, **kwargs)
+
+    def test_profile_wait(self):
+        # waiting for chunks and for the slowest rank are told apart
+        trajectory = self.trajectory(res_shape=(1,), n_ts=0, stride=1,
+                                     offset=0, prefetch=2, profile=True)
+        trajectory.run(self.n_particles)
+        trajectory.communicate()
+        stats = trajectory.profile_summary().stats
+        self.assertIn('time/io/wait', stats)
+        self.assertIn('time/comm/wait', stats)
+        self.assertNotIn('time/wait', stats)
+
+    def test_collective_requires_mpio(self):
+        with self.assertRaises(ValueError):
+            self.trajectory(res_shape=(1,), n_ts=0, stride=1, offset=0,
+                            collective=True)
+
+
+class Test_H5mdParallelTrajectory_serial(ParallelTrajectoryBase,
+                                        unittest.TestCase):
+
+    def trajectory(self, **kwargs):
+        kwargs.setdefault('obs', end_to_end)
+        return H5mdParallelTrajectory(comm=None, h5md_file=self.h5_fh,
+                                      **kwargs)
+
+
+class Test_H5mdPoolTrajectory_thread(ParallelTrajectoryBase,
+                                     unittest.TestCase):
+
+    def trajectory(self, **kwargs):
+        kwargs.setdefault('obs', end_to_end)
+        return H5mdPoolTrajectory(h5md_file=self.h5_fh, n_workers=3,
+                                  executor='thread', **kwargs)
+
+
+@unittest.skipIf(shared_memory is None,
+                 "multiprocessing.shared_memory is not available")
+class Test_H5mdPoolTrajectory_process(ParallelTrajectoryBase,
+                                      unittest.TestCase):
+
+    def trajectory(self, **kwargs):
+        kwargs.setdefault('obs', end_to_end)
+        return H5mdPoolTrajectory(h5md_file=H5_FILE, n_workers=3,
+                                  executor='process', **kwargs)
+
+    def test_file_closed(self):
+        # the workers open the file by name
+        trajectory = self.trajectory(res_shape=(1,), n_ts=0, stride=1,
+                                     offset=0)
+        self.assertFalse(trajectory.h5md['file'])
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+"""
+Unit-test module for the kaipy.profiling module.
+"""
+
+import json
+import os
+import unittest
+from kaipy.profiling import Profiler, ProfileSummary
+
+
+class Test_Profiler(unittest.TestCase):
+
+    def test_timers(self):
+        profiler = Profiler(trace=True)
+        self.assertEqual(profiler.timed('compute/obs', sum, [1, 2]), 3)
+        profiler.add_time('io', 2., profiler.origin + 1.)
+        profiler.add_time('io', 1.)
+        profiler.add_count('bytes_read', 10)
+        profiler.add_count('bytes_read', 5)
+        self.assertEqual(profiler.times['io'], 3.)
+        self.assertEqual(profiler.counts['bytes_read'], 15)
+        self.assertEqual(len(profiler.events), 2)
+        self.assertEqual(profiler.events[1], ('io', 1., 2., 0))
+
+    def test_merge(self):
+        profiler = Profiler(trace=True)
+        worker = Profiler(trace=True)
+        worker.add_time('io', 1., worker.origin)
+        worker.add_count('frames', 4)
+        profiler.add_count('frames', 2)
+        profiler.merge(worker, thread=3)
+        self.assertEqual(profiler.times['io'], 1.)
+        self.assertEqual(profiler.counts['frames'], 6)
+        key, start, seconds, thread = profiler.events[0]
+        self.assertAlmostEqual(start, worker.origin - profiler.origin)
+        self.assertEqual((key, seconds, thread), ('io', 1., 3))
+
+    def test_synchronize(self):
+        class StubComm(object):
+            barriers = 0
+
+            def Barrier(self):
+                self.barriers += 1
+
+        comm = StubComm()
+        profiler = Profiler(trace=True)
+        created = profiler.origin
+        profiler.synchronize(comm)
+        self.assertEqual(comm.barriers, 1)
+        self.assertGreaterEqual(profiler.origin, created)
+        profiler.add_time('io', 1., profiler.origin + 0.5)
+        self.assertEqual(profiler.events[0][1], 0.5)
+
+    def test_summary(self):
+        profiler = Profiler()
+        profiler.add_time('io', 1.)
+        profiler.add_count('bytes_read', 8)
+        summary = profiler.summary()
+        self.assertEqual(summary.ranks, [{'time/io': 1., 'count/bytes_read': 8}])
+        self.assertEqual(summary.stats['time/io']['imbalance'], 1.)
+
+
+class Test_ProfileSummary(unittest.TestCase):
+
+    def setUp(self):
+        self.summary = ProfileSummary(
+            [{'time/io': 1., 'count/frames': 4},
+             {'time/io': 3., 'time/comm': 2., 'count/frames': 4}],
+            [[('io', 0., 1., 0)], [('io', 0.5, 3., 1), ('comm', 3.5, 2., 0)]])
+
+    def test_stats(self):
+        stats = self.summary.stats
+        self.assertEqual(stats['time/io'], {'min': 1., 'mean': 2., 'max': 3.,
+                                            'imbalance': 1.5})
+        # missing keys count as zero
+        self.assertEqual(stats['time/comm']['min'], 0.)
+        self.assertEqual(stats['time/comm']['imbalance'], 2.)
+        self.assertEqual(stats['count/frames']['imbalance'], 1.)
+        self.assertIn('time/comm', str(self.summary))
+
+    def test_json(self):
+        self.summary.to_json("profiling_test.json")
+        with open("profiling_test.json") as json_file:
+            data = json.load(json_file)
+        os.remove("profiling_test.json")
+        self.assertEqual(data, json.loads(self.summary.to_json()))
+        self.assertEqual(data['stats']['time/io']['max'], 3.)
+        self.assertEqual(len(data['ranks']), 2)
+
+    def test_chrome_trace(self):
+        events = self.summary.to_chrome_trace()['traceEvents']
+        self.assertEqual(len(events), 3)
+        self.assertEqual(events[1], {'name': 'io', 'cat': 'io', 'ph': 'X',
+                                     'ts': 0.5e6, 'dur': 3e6, 'pid': 1,
+                                     'tid': 1})
+
+
+if __name__ == "__main__":
+    suite1 = unittest.TestLoader().loadTestsFromTestCase(Test_Profiler)
+    suite2 = unittest.TestLoader().loadTestsFromTestCase(Test_ProfileSummary)
+    alltests = unittest.TestSuite([suite1, suite2])
+    unittest.TextTestRunner(verbosity=2).run(alltests)
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+
+"""
+Unit-test module for the kaipy.statistic module.
+"""
+
+import copy
+import unittest
+import numpy as np
+from kaipy.statistic import SumAccumulator, MeanAccumulator,\
+                            VarianceAccumulator, HistogramAccumulator,\
+                            BlockingAccumulator, MultipleTauCorrelator,\
+                            correlation, calc_error, calc_error_batch
+
+
+class Test_correlation(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(42)
+        self.data = rng.normal(size=(100, 3))
+        self.other = rng.normal(size=(100, 3))
+
+    def reference(self, data, other):
+        return np.array([np.mean(data[t:] * other[:len(data) - t], axis=0)
+                         for t in range(len(data))])
+
+    def test_autocorrelation(self):
+        np.testing.assert_array_almost_equal(
+            correlation(self.data), self.reference(self.data, self.data))
+
+    def test_cross_correlation(self):
+        np.testing.assert_array_almost_equal(
+            correlation(self.data[:, 0], self.other[:, 0]),
+            self.reference(self.data[:, 0], self.other[:, 0]))
+
+    def test_centered(self):
+        centered = self.data - self.data.mean(axis=0)
+        reference = self.reference(centered, centered)
+        np.testing.assert_array_almost_equal(
+            correlation(self.data, centered=True, normalized=True),
+            reference / reference[0])
+
+    def test_float32(self):
+        np.testing.assert_allclose(
+            correlation(self.data, dtype=np.float32),
+            self.reference(self.data, self.data), rtol=1e-3, atol=1e-4)
+
+
+class StubComm(object):
+    """
+    Communicator of rank whose allgather returns copies of values.
+    """
+
+    def __init__(self, rank, values):
+        self.rank = rank
+        self.values = values
+
+    def Get_rank(self):
+        return self.rank
+
+    def allgather(self, value):
+        return copy.deepcopy(self.values)
+
+
+class Test_calc_error(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(42)
+        noise = rng.normal(size=(2000, 3))
+        self.data = np.zeros((2000, 3))
+        for i in range(1, 2000):
+            self.data[i] = self.data[i - 1] * np.array([0., 0.5, 0.9]) + \
+                noise[i]
+
+    def test_function(self):
+        acf = correlation(self.data[:, 1], centered=True,
+                          normalized=True)[:1000]
+        tau_int = 0.5
+        for i in range(len(acf)):
+            tau_int += acf[i]
+            if i >= 6 * tau_int:
+                break
+        data_mean, stat_err = calc_error(self.data[:, 1])
+        self.assertAlmostEqual(data_mean, np.mean(self.data[:, 1]))
+        self.assertAlmostEqual(stat_err, np.sqrt(np.var(self.data[:, 1]) *
+                                                 2. * tau_int / 2000))
+
+    def test_correlated(self):
+        # the error of an AR(1) process increases by sqrt((1+a)/(1-a))
+        _, stat_err = calc_error(self.data[:, 2])
+        self.assertGreater(stat_err, 3. * np.std(self.data[:, 2]) /
+                           np.sqrt(2000))
+
+    def test_batch(self):
+        data_mean, stat_err = calc_error_batch(self.data)
+        for i in range(3):
+            reference = calc_error(self.data[:, i])
+            self.assertAlmostEqual(data_mean[i], reference[0])
+            self.assertAlmostEqual(stat_err[i], reference[1])
+
+
+class Test_accumulators(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(42)
+        self.data = rng.normal(size=(100, 4))
+
+    def fill(self, accumulator, data):
+        for value in data:
+            accumulator.update(value)
+        return accumulator
+
+    def test_sum(self):
+        accumulator = self.fill(SumAccumulator((4,)), self.data)
+        np.testing.assert_array_almost_equal(accumulator.result(),
+                                             self.data.sum(axis=0))
+
+    def test_mean(self):
+        accumulator = self.fill(MeanAccumulator((4,)), self.data[:30])
+        accumulator.merge(self.fill(MeanAccumulator((4,)), self.data[30:]))
+        np.testing.assert_array_almost_equal(accumulator.result(),
+                                             self.data.mean(axis=0))
+
+    def test_variance(self):
+        accumulator = self.fill(VarianceAccumulator((4,), ddof=1),
+                                self.data[:70])
+        accumulator.merge(self.fill(VarianceAccumulator((4,)), self.data[70:]))
+        mean, variance = accumulator.result()
+        np.testing.assert_array_almost_equal(mean, self.data.mean(axis=0))
+        np.testing.assert_array_almost_equal(variance,
+                                             self.data.var(axis=0, ddof=1))
+
+    def test_histogram(self):
+        accumulator = self.fill(HistogramAccumulator(10, range=(-3., 3.)),
+                                self.data)
+        reference, bin_edges = np.histogram(self.data, bins=10,
+                                            range=(-3., 3.))
+        np.testing.assert_array_equal(accumulator.result(), reference)
+        np.testing.assert_array_almost_equal(accumulator.bin_edges, bin_edges)
+
+
+class Test_blocking(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(42)
+        noise = rng.normal(size=(2**14, 2))
+        self.data = np.zeros((2**14, 2))
+        for i in range(1, 2**14):
+            self.data[i] = self.data[i - 1] * np.array([0., 0.9]) + noise[i]
+
+    def test_function(self):
+        accumulator = BlockingAccumulator((2,))
+        accumulator.extend(self.data[:1001])
+        for value in self.data[1001:1010]:
+            accumulator.update(value)
+        accumulator.extend(self.data[1010:])
+        data_mean, stat_err = accumulator.result()
+        np.testing.assert_array_almost_equal(data_mean,
+                                             self.data.mean(axis=0))
+        # the error of an AR(1) process increases by sqrt((1+a)/(1-a))
+        reference = np.std(self.data, axis=0) / np.sqrt(2**14) * \
+            np.sqrt([1., 19.])
+        np.testing.assert_allclose(stat_err, reference, rtol=0.2)
+        self.assertLessEqual(len(accumulator.count), 15)
+
+    def test_short(self):
+        for n in (1, 2, 3, 10, 31):
+            accumulator = BlockingAccumulator((2,))
+            accumulator.extend(self.data[:n])
+            data_mean, stat_err = accumulator.result()
+            np.testing.assert_array_almost_equal(data_mean,
+                                                 self.data[:n].mean(axis=0))
+            if n == 1:
+                self.assertTrue(np.all(np.isnan(stat_err)))
+            else:
+                # the error of the unblocked values
+                np.testing.assert_array_almost_equal(
+                    stat_err, np.std(self.data[:n], axis=0, ddof=1)
+                    / np.sqrt(n))
+        data_mean, stat_err = BlockingAccumulator((2,)).result()
+        self.assertTrue(np.all(np.isnan(data_mean)))
+        self.assertTrue(np.all(np.isnan(stat_err)))
+
+    def test_allreduce(self):
+        # odd lengths leave unpaired blocks on several levels
+        accumulators = []
+        for part in np.array_split(self.data[:1000], 3):
+            accumulators.append(BlockingAccumulator((2,)))
+            accumulators[-1].extend(part[:-2])
+        results = []
+        for rank in range(3):
+            accumulator = copy.deepcopy(accumulators[rank])
+            accumulator.allreduce(StubComm(rank, accumulators))
+            results.append(accumulator.result())
+        for data_mean, stat_err in results[1:]:
+            np.testing.assert_array_equal(data_mean, results[0][0])
+            np.testing.assert_array_equal(stat_err, results[0][1])
+
+    def test_merge(self):
+        first = BlockingAccumulator((2,))
+        first.extend(self.data[:5001])
+        second = BlockingAccumulator((2,))
+        second.extend(self.data[5001:])
+        first.merge(second)
+        reference = BlockingAccumulator((2,))
+        reference.extend(self.data)
+        np.testing.assert_array_almost_equal(first.result()[0],
+                                             reference.result()[0])
+        np.testing.assert_allclose(first.result()[1], reference.result()[1],
+                                   rtol=0.1)
+
+
+class Test_multiple_tau(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(42)
+        noise = rng.normal(size=(3000, 2))
+        self.data = np.zeros((3000, 2))
+        for i in range(1, 3000):
+            self.data[i] = 0.95 * self.data[i - 1] + noise[i]
+
+    def test_autocorrelation(self):
+        correlator = MultipleTauCorrelator((2,), n_points=8)
+        for value in self.data:
+            correlator.push(value)
+        lags, corr = correlator.result()
+        reference = correlation(self.data)
+        # the first level is exact
+        np.testing.assert_array_almost_equal(corr[:8], reference[:8])
+        np.testing.assert_array_equal(lags[:12],
+                                      [0, 1, 2, 3, 4, 5, 6, 7, 8, 10, 12, 14])
+        np.testing.assert_allclose(corr[lags < 100], reference[lags[lags < 100]],
+                                   rtol=0.05, atol=0.2)
+
+    def test_cross_correlation(self):
+        correlator = MultipleTauCorrelator(cross=True)
+        for a, b in zip(self.data[:, 0], self.data[:, 1]):
+            correlator.update((a, b))
+        np.testing.assert_array_almost_equal(
+            correlator.result()[1][:16],
+            correlation(self.data[:, 0], self.data[:, 1])[:16])
+
+    def test_msd(self):
+        rng = np.random.RandomState(42)
+        walk = np.cumsum(rng.normal(size=(2000, 20, 3)), axis=0)
+        correlator = MultipleTauCorrelator((20, 3), mode='msd', axes=(0,))
+        for value in walk:
+            correlator.push(value)
+        lags, msd = correlator.result()
+        np.testing.assert_allclose(msd.sum(axis=-1)[1:20] / lags[1:20], 3.,
+                                   rtol=0.1)
+
+    def test_merge(self):
+        first = MultipleTauCorrelator((2,), n_points=8)
+        second = MultipleTauCorrelator((2,), n_points=8)
+        for value in self.data[:1500]:
+            first.push(value)
+        for value in self.data[1500:]:
+            second.push(value)
+        first.merge(second)
+        lags, corr = first.result()
+        np.testing.assert_allclose(corr[:8], correlation(self.data)[:8],
+                                   rtol=0.05)
+
+
+if __name__ == "__main__":
+    suite1 = unittest.TestLoader().loadTestsFromTestCase(Test_correlation)
+    suite2 = unittest.TestLoader().loadTestsFromTestCase(Test_calc_error)
+    suite3 = unittest.TestLoader().loadTestsFromTestCase(Test_accumulators)
+    suite4 = unittest.TestLoader().loadTestsFromTestCase(Test_blocking)
+    suite5 = unittest.TestLoader().loadTestsFromTestCase(Test_multiple_tau)
+    alltests = unittest.TestSuite([suite1, suite2, suite3, suite4, suite5])
+    unittest.TextTestRunner(verbosity=2).run(alltests)
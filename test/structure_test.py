@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+"""
+Unit-test module for the kaipy.structure module.
+"""
+
+import itertools
+import unittest
+import numpy as np
+from kaipy.structure import structure_factor, form_factor
+
+
+class Test_structure_factor(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(42)
+        self.box = np.array([[8., 0., 0.], [1., 9., 0.], [-2., 1., 10.]])
+        self.pos = np.dot(rng.uniform(0., 1., (2, 300, 3)), self.box)
+        self.species = rng.randint(0, 2, 300)
+
+    def reference(self, box, q_max, dq, mask_1=None, mask_2=None):
+        n = np.array(list(itertools.product(range(-8, 9), repeat=3)))
+        q = 2. * np.pi * np.dot(n, np.linalg.inv(box).T)
+        q_norm = np.linalg.norm(q, axis=-1)
+        q, q_norm = q[(q_norm > 0) & (q_norm <= q_max)], \
+            q_norm[(q_norm > 0) & (q_norm <= q_max)]
+        mask_1 = np.ones(300, dtype=bool) if mask_1 is None else mask_1
+        mask_2 = mask_1 if mask_2 is None else mask_2
+        s_q = np.zeros(len(q))
+        for frame in self.pos:
+            rho_1 = np.exp(-1j * np.dot(frame[mask_1], q.T)).sum(axis=0)
+            rho_2 = np.exp(-1j * np.dot(frame[mask_2], q.T)).sum(axis=0)
+            s_q += np.real(rho_1 * np.conj(rho_2)) / np.sqrt(
+                mask_1.sum() * mask_2.sum()) / len(self.pos)
+        shells = np.floor(q_norm / dq).astype(int)
+        counts = np.bincount(shells)
+        return np.bincount(shells, weights=s_q)[counts > 0] \
+            / counts[counts > 0]
+
+    def test_direct(self):
+        q, s_q = structure_factor(self.pos, self.box, 3., dq=0.25,
+                                  block_size=64)
+        self.assertTrue(np.all(np.diff(q) > 0))
+        np.testing.assert_array_almost_equal(
+            s_q, self.reference(self.box, 3., 0.25))
+
+    def test_species(self):
+        q, s_q = structure_factor(self.pos, self.box, 3., dq=0.25,
+                                  h5md_species=self.species, species_1=0,
+                                  species_2=1)
+        np.testing.assert_array_almost_equal(
+            s_q, self.reference(self.box, 3., 0.25, self.species == 0,
+                                self.species == 1))
+
+    def test_fft(self):
+        q, s_q = structure_factor(self.pos, self.box, 3., dq=0.25)
+        q_fft, s_fft = structure_factor(self.pos, self.box, 3., dq=0.25,
+                                        method='fft', mesh=64)
+        np.testing.assert_array_almost_equal(q_fft, q)
+        np.testing.assert_allclose(s_fft, s_q, atol=0.02)
+
+    def test_single_frame(self):
+        q, s_q = structure_factor(self.pos, self.box, 3.)
+        q_0, s_0 = structure_factor(self.pos[0], self.box, 3.)
+        q_1, s_1 = structure_factor(self.pos[1], self.box, 3.)
+        np.testing.assert_array_almost_equal(s_q, 0.5 * (s_0 + s_1))
+
+
+class Test_form_factor(unittest.TestCase):
+
+    def test_function(self):
+        rng = np.random.RandomState(42)
+        x = np.cumsum(rng.normal(size=(3, 40, 3)), axis=1)
+        q = np.array([1e-3, 0.3, 1.])
+        dist = np.linalg.norm(x[:, :, np.newaxis] - x[:, np.newaxis], axis=-1)
+        reference = np.mean([
+            np.sum(np.sinc(np.multiply.outer(d, q) / np.pi), axis=(0, 1))
+            for d in dist], axis=0) / 40**2
+        np.testing.assert_array_almost_equal(
+            form_factor(x, q, block_size=100), reference)
+        self.assertAlmostEqual(form_factor(x[0], q)[0], 1., places=4)
+
+
+if __name__ == "__main__":
+    suite1 = unittest.TestLoader().loadTestsFromTestCase(Test_structure_factor)
+    suite2 = unittest.TestLoader().loadTestsFromTestCase(Test_form_factor)
+    alltests = unittest.TestSuite([suite1, suite2])
+    unittest.TextTestRunner(verbosity=2).run(alltests)
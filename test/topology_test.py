@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+"""
+Unit-test module for the kaipy.topology module.
+"""
+
+import os
+import unittest
+import numpy as np
+import h5py
+from kaipy.observable import rg2, rg2_compwise, end_to_end_distance,\
+                             center_of_mass
+from kaipy.topology import ChainTopology
+
+
+class Test_ChainTopology(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(42)
+        self.lengths = [5, 1, 8, 3]
+        self.x = np.cumsum(rng.normal(size=(2, 17, 3)), axis=1)
+        self.mass = rng.uniform(1., 2., 17)
+
+    def chains(self):
+        bounds = np.cumsum([0] + self.lengths)
+        return [self.x[:, a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+
+    def test_observables(self):
+        obs = ChainTopology(self.lengths).observables(self.x)
+        chains = self.chains()
+        np.testing.assert_array_almost_equal(
+            obs.center_of_mass(),
+            np.stack([center_of_mass(c) for c in chains], axis=1))
+        np.testing.assert_array_almost_equal(
+            obs.rg2(), np.stack([rg2(c) for c in chains], axis=1))
+        np.testing.assert_array_almost_equal(
+            obs.rg2_compwise(),
+            np.stack([np.stack(rg2_compwise(c), axis=-1) for c in chains],
+                     axis=1))
+        np.testing.assert_array_almost_equal(
+            obs.end_to_end_distance(),
+            np.stack([end_to_end_distance(c) for c in chains], axis=1))
+        tensor = obs.gyration_tensor()
+        self.assertEqual(tensor.shape, (2, 4, 3, 3))
+        relative = chains[2][1] - center_of_mass(chains[2][1])
+        np.testing.assert_array_almost_equal(
+            tensor[1, 2], np.dot(relative.T, relative) / 8.)
+        np.testing.assert_array_almost_equal(
+            np.trace(tensor, axis1=-2, axis2=-1), obs.rg2())
+
+    def test_mass(self):
+        obs = ChainTopology(self.lengths, self.mass).observables(self.x)
+        bounds = np.cumsum([0] + self.lengths)
+        np.testing.assert_array_almost_equal(
+            obs.center_of_mass(),
+            np.stack([center_of_mass(c, self.mass[a:b]) for c, a, b in
+                      zip(self.chains(), bounds[:-1], bounds[1:])], axis=1))
+
+    def test_from_bonds(self):
+        bonds = [[1, 0], [2, 1], [4, 3], [6, 5], [7, 6]]
+        topology = ChainTopology.from_bonds(bonds, 9)
+        np.testing.assert_array_equal(topology.lengths, [3, 2, 3, 1])
+        np.testing.assert_array_equal(topology.chain_index(),
+                                      [0, 0, 0, 1, 1, 2, 2, 2, 3])
+        with self.assertRaises(ValueError):
+            ChainTopology.from_bonds([[2, 0]], 3)
+
+    def test_from_h5md(self):
+        with h5py.File("topology_test.h5", "w") as h5_file:
+            h5_file["particles/atoms/id/value"] = \
+                np.tile(np.arange(10, 20), (3, 1))
+            h5_file["connectivity/atoms"] = \
+                [[i, i - 1] for i in range(11, 20) if i != 15]
+            topology = ChainTopology.from_h5md(h5_file)
+        os.remove("topology_test.h5")
+        np.testing.assert_array_equal(topology.lengths, [5, 5])
+
+
+if __name__ == "__main__":
+    suite1 = unittest.TestLoader().loadTestsFromTestCase(Test_ChainTopology)
+    alltests = unittest.TestSuite([suite1])
+    unittest.TextTestRunner(verbosity=2).run(alltests)
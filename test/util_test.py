@@ -6,9 +6,16 @@ Unit-test module for the kaipy.util module.
 
 import os
 import unittest
+from unittest import mock
 import numpy as np
 import h5py
-from kaipy.util import h5md_pos
+from kaipy.util import h5md_pos, h5md_pos_iter, h5md_pos_particle_blocks,\
+    h5md_box, h5md_read_count, _sort_frames, _split_frames
+
+try:
+    from mpi4py import MPI
+except ImportError:
+    MPI = None
 
 pos_unfolded = np.array([
     [[11.11, 1.21, 1.31],
@@ -174,6 +181,23 @@ class H5mdPos(unittest.TestCase):
                                                  folded=False),
                                         pos_unfolded[i]))
 
+    def test_negative_single(self):
+        """
+        Test the h5md_pos method for negative timesteps, which count from
+        the last timestep.
+        """
+        for folded, reference in ((True, pos_folded),
+                                  (False, pos_unfolded)):
+            self.assertTrue(np.allclose(h5md_pos(self.h5_fh, -1,
+                                                 folded=folded),
+                                        reference[-1]))
+            self.assertTrue(np.allclose(h5md_pos(self.h5_fh,
+                                                 -reference.shape[0],
+                                                 folded=folded),
+                                        reference[0]))
+        with self.assertRaises(IndexError):
+            h5md_pos(self.h5_fh, pos_folded.shape[0])
+
     def test_folded_array(self):
         """
         Test the h5md_pos method for multiple timesteps and folded
@@ -194,11 +218,207 @@ class H5mdPos(unittest.TestCase):
                                              folded=False),
                                     pos_unfolded))
 
+    def test_iter(self):
+        """
+        Test the h5md_pos_iter method for different chunk sizes and
+        timestep selections.
+        """
+        for chunk_size in (None, 1, 3):
+            for ts in (None, np.arange(4), np.array([0, 2, 3])):
+                for folded, reference in ((True, pos_folded),
+                                          (False, pos_unfolded)):
+                    chunks = list(h5md_pos_iter(self.h5_fh, ts, folded=folded,
+                                                chunk_size=chunk_size))
+                    expected_ts = np.arange(4) if ts is None else ts
+                    self.assertTrue(np.array_equal(
+                        np.concatenate([c[0] for c in chunks]), expected_ts))
+                    self.assertTrue(np.allclose(
+                        np.concatenate([c[1] for c in chunks]),
+                        reference[expected_ts]))
+
+    def test_prefetch(self):
+        """
+        Test reading ahead on a background thread.
+        """
+        for depth in (1, 2):
+            chunks = [(c[0], c[1].copy()) for c in h5md_pos_iter(
+                self.h5_fh, folded=False, chunk_size=1, prefetch=depth)]
+            self.assertTrue(np.array_equal(
+                np.concatenate([c[0] for c in chunks]), np.arange(4)))
+            self.assertTrue(np.allclose(
+                np.concatenate([c[1] for c in chunks]), pos_unfolded))
+        iterator = h5md_pos_iter(self.h5_fh, prefetch=2)
+        next(iterator)
+        iterator.close()
+
+    @unittest.skipIf(MPI is None, "mpi4py is not available")
+    def test_prefetch_collective(self):
+        """
+        Test that collective reads are not prefetched without
+        MPI_THREAD_MULTIPLE.
+        """
+        with mock.patch.object(MPI, 'Query_thread',
+                               return_value=MPI.THREAD_SERIALIZED):
+            with self.assertRaises(ValueError):
+                h5md_pos_iter(self.h5_fh, collective=True, prefetch=2)
+
+    def test_read_count(self):
+        """
+        Test that strided timesteps are combined into few reads.
+        """
+        self.assertEqual(h5md_read_count(self.h5_fh, np.array([0, 3])), 1)
+        reads = _split_frames(np.arange(0, 100, 7), 4)
+        self.assertEqual([len(r) for r in reads], [4, 4, 4, 3])
+        reads = _split_frames(np.arange(2, 40, 2), 8)
+        self.assertEqual([r[0] for r in reads], [2, 16, 32])
+
+    def test_particle_blocks(self):
+        """
+        Test the h5md_pos_particle_blocks method for trajectories with
+        changing id order.
+        """
+        ts = np.array([0, 1, 3])
+        blocks = list(h5md_pos_particle_blocks(self.h5_fh, ts, folded=False,
+                                               block_size=2))
+        self.assertTrue(np.array_equal(
+            np.concatenate([b[0] for b in blocks]), np.arange(5)))
+        self.assertTrue(np.allclose(np.concatenate([b[1] for b in blocks],
+                                                   axis=1),
+                                    pos_unfolded[ts]))
+
+    def test_particle_blocks_static(self):
+        """
+        Test the h5md_pos_particle_blocks method for a permuted id order
+        that does not change, where only the columns of a block are read.
+        """
+        rng = np.random.RandomState(42)
+        order = rng.permutation(12)
+        pos = rng.uniform(0., 10., (6, 12, 3))
+        image = rng.randint(-2, 3, (6, 12, 3))
+        with h5py.File("static_test.h5", "w") as h5_file:
+            h5_file.create_dataset("particles/atoms/position/value",
+                                   data=pos[:, order], chunks=(2, 3, 3))
+            h5_file.create_dataset("particles/atoms/image/value",
+                                   data=image[:, order], chunks=(2, 3, 3))
+            h5_file["particles/atoms/id/value"] = np.tile(order, (6, 1))
+            h5_file["particles/atoms/box/edges"] = np.full(3, 10.)
+            # equally spaced (slice) and irregular (list) timesteps
+            for ts in (np.arange(6), np.array([0, 1, 3, 4])):
+                blocks = list(h5md_pos_particle_blocks(
+                    h5_file, ts, folded=False, block_size=3))
+                self.assertEqual(len(blocks), 4)
+                self.assertTrue(np.allclose(
+                    np.concatenate([b[1] for b in blocks], axis=1),
+                    (pos + 10. * image)[ts]))
+        os.remove("static_test.h5")
+
     @classmethod
     def tearDownClass(cls):
         os.remove("test.h5")
 
 
+class SortFrames(unittest.TestCase):
+    """
+    Test the batched sorting and unfolding of timesteps.
+    """
+
+    def setUp(self):
+        rng = np.random.RandomState(42)
+        self.pos = rng.uniform(0., 10., (6, 20, 3))
+        self.image = rng.randint(-3, 3, (6, 20, 3))
+        self.box = np.array([10., 11., 12.])
+
+    def test_sorted_ids(self):
+        ids = np.tile(np.arange(20), (6, 1))[:, :, np.newaxis]
+        self.assertTrue(np.allclose(
+            _sort_frames(self.pos, ids, self.image, self.box),
+            self.pos + self.image * self.box))
+
+    def test_unsorted_ids(self):
+        rng = np.random.RandomState(1)
+        ids = np.array([rng.permutation(20) for _ in range(6)])
+        result = _sort_frames(self.pos, ids[:, :, np.newaxis], self.image,
+                              self.box)
+        for i in range(6):
+            order = np.argsort(ids[i])
+            self.assertTrue(np.allclose(
+                result[i], self.pos[i, order] + self.image[i, order] * self.box))
+
+    def test_triclinic(self):
+        edges = np.array([[10., 0., 0.], [2., 11., 0.], [1., -3., 12.]])
+        result = _sort_frames(self.pos, None, self.image, edges)
+        self.assertTrue(np.allclose(
+            result, self.pos + self.image[..., 0:1] * edges[0] +
+            self.image[..., 1:2] * edges[1] + self.image[..., 2:3] * edges[2]))
+
+
+class H5mdBox(unittest.TestCase):
+    """
+    Test reading fixed and time-dependent boxes.
+    """
+
+    def setUp(self):
+        self.h5_file = h5py.File("box_test.h5", "w")
+
+    def tearDown(self):
+        self.h5_file.close()
+        os.remove("box_test.h5")
+
+    def test_fixed(self):
+        edges = np.diag([4., 5., 6.])
+        self.h5_file.create_dataset("particles/atoms/box/edges", data=edges)
+        self.assertTrue(np.allclose(h5md_box(self.h5_file), edges))
+        self.assertTrue(np.allclose(h5md_box(self.h5_file, 3), edges))
+
+    def test_time_dependent(self):
+        edges = np.arange(12.).reshape(4, 3)
+        self.h5_file.create_dataset("particles/atoms/box/edges/value",
+                                    data=edges)
+        self.assertTrue(np.allclose(h5md_box(self.h5_file, 2), edges[2]))
+        self.assertTrue(np.allclose(h5md_box(self.h5_file, [1, 3]),
+                                    edges[[1, 3]]))
+        with self.assertRaises(ValueError):
+            h5md_box(self.h5_file)
+
+    def test_unfold_time_dependent(self):
+        """
+        Test unfolding with the box of every timestep.
+        """
+        rng = np.random.RandomState(42)
+        pos = rng.uniform(0., 4., (6, 5, 3))
+        image = rng.randint(-2, 3, (6, 5, 3))
+        orthorhombic = rng.uniform(4., 6., (6, 3))
+        triclinic = np.array([np.diag(edges) + np.triu(np.ones((3, 3)), 1)
+                              for edges in orthorhombic])
+        self.h5_file.create_dataset("particles/atoms/position/value",
+                                    data=pos, chunks=(2, 5, 3))
+        self.h5_file["particles/atoms/image/value"] = image
+        self.h5_file["particles/atoms/id/value"] = np.tile(np.arange(5),
+                                                           (6, 1))
+        for box, reference in (
+                (orthorhombic, pos + image * orthorhombic[:, np.newaxis]),
+                (triclinic, pos + np.matmul(image, triclinic))):
+            if "particles/atoms/box" in self.h5_file:
+                del self.h5_file["particles/atoms/box"]
+            self.h5_file["particles/atoms/box/edges/value"] = box
+            ts = np.array([0, 1, 2, 4, 5])
+            self.assertTrue(np.allclose(
+                h5md_pos(self.h5_file, ts, folded=False), reference[0:6]))
+            self.assertTrue(np.allclose(
+                h5md_pos(self.h5_file, -2, folded=False), reference[4]))
+            result = np.concatenate([chunk for _, chunk in h5md_pos_iter(
+                self.h5_file, ts, folded=False, chunk_size=2, prefetch=2)])
+            self.assertTrue(np.allclose(result, reference[ts]))
+            blocks = list(h5md_pos_particle_blocks(
+                self.h5_file, ts, folded=False, block_size=2))
+            self.assertTrue(np.allclose(
+                np.concatenate([b[1] for b in blocks], axis=1),
+                reference[ts]))
+
+
 if __name__ == "__main__":
-    suite = unittest.TestLoader().loadTestsFromTestCase(H5mdPos)
-    unittest.TextTestRunner(verbosity=2).run(suite)
+    suite1 = unittest.TestLoader().loadTestsFromTestCase(H5mdPos)
+    suite2 = unittest.TestLoader().loadTestsFromTestCase(SortFrames)
+    suite3 = unittest.TestLoader().loadTestsFromTestCase(H5mdBox)
+    alltests = unittest.TestSuite([suite1, suite2, suite3])
+    unittest.TextTestRunner(verbosity=2).run(alltests)